@@ -0,0 +1,191 @@
+import contextlib
+import glob
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from cache import CompileCache, DEFAULT_MAX_BYTES
+from compiler import compile_script
+from diagnostics import CompileError
+from include import Includes, ParseCache
+
+class BatchResult:
+    def __init__(self, inp_path, out_path, ok, message, n_bytes, duration):
+        self.inp_path = inp_path
+        self.out_path = out_path
+        self.ok = ok
+        self.message = message
+        self.n_bytes = n_bytes
+        self.duration = duration
+
+    def __str__(self):
+        return f"BatchResult(inp_path={repr(self.inp_path)}, ok={self.ok}, n_bytes={self.n_bytes})"
+
+    __repr__ = __str__
+
+def glob_base(pattern):
+    # The directories of a pattern before its first wildcard
+    parts = []
+    for part in pattern.split(os.sep):
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+
+    base = os.sep.join(parts)
+    if base == "" and pattern.startswith(os.sep):
+        return os.sep
+    return base if base != "" else os.curdir
+
+def collect_jobs(inputs, out_dir=None):
+    # Returns (input path, output path) pairs. Inputs can be files, directories (searched
+    # recursively for .dig files) or glob patterns. Files found in a directory or by a pattern keep
+    # their path below it in out_dir. Raises ValueError if two inputs would be written to the same
+    # output
+    jobs = []
+    seen = set()
+    written_by = {}
+
+    def add(inp_path, rel_path):
+        if inp_path in seen:
+            return
+        seen.add(inp_path)
+
+        out_rel = os.path.splitext(rel_path)[0] + ".act"
+        if out_dir is None:
+            out_path = os.path.splitext(inp_path)[0] + ".act"
+        else:
+            out_path = os.path.join(out_dir, out_rel)
+
+        other = written_by.setdefault(os.path.normpath(out_path), inp_path)
+        if other != inp_path:
+            raise ValueError(f"{other} and {inp_path} would both be written to {out_path}")
+        jobs.append((inp_path, out_path))
+
+    for inp in inputs:
+        if os.path.isdir(inp):
+            for path in sorted(glob.glob(os.path.join(inp, "**", "*.dig"), recursive=True)):
+                add(path, os.path.relpath(path, inp))
+        elif os.path.exists(inp):
+            add(inp, os.path.basename(inp))
+        else:
+            base = glob_base(inp)
+            for path in sorted(glob.glob(inp, recursive=True)):
+                add(path, os.path.relpath(path, base))
+
+    return jobs
+
+WORKER_CACHE = None
+WORKER_INCLUDES = None
+WORKER_OPTIMIZE = False
+WORKER_COMPACT = False
+
+def init_worker(cache_dir, cache_size, use_cache, optimize=False, compact=False):
+    # Files included by many inputs are parsed once per worker, and with the cache, once
+    global WORKER_CACHE, WORKER_INCLUDES, WORKER_OPTIMIZE, WORKER_COMPACT
+    WORKER_CACHE = CompileCache(cache_dir, cache_size) if use_cache else None
+    WORKER_INCLUDES = Includes(ParseCache(cache_dir, cache_size) if use_cache else None)
+    WORKER_OPTIMIZE = optimize
+    WORKER_COMPACT = compact
+
+def assemble_one(inp_path, out_path):
+    # Never raises, so one bad file can't take down the batch. Diagnostics and anything else the
+    # assembler prints are captured and reported as the failure message
+    start = time.perf_counter()
+    captured = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(captured):
+            with open(inp_path, "r") as inp_f:
+                out = compile_script(inp_f.read(), WORKER_CACHE, optimize=WORKER_OPTIMIZE, compact=WORKER_COMPACT, inp_path=inp_path, includes=WORKER_INCLUDES)
+
+        out_parent = os.path.dirname(out_path)
+        if out_parent != "":
+            os.makedirs(out_parent, exist_ok=True)
+        with open(out_path, "wb") as out_f:
+            out_f.write(out)
+
+        return BatchResult(inp_path, out_path, True, captured.getvalue(), len(out), time.perf_counter() - start)
+    except CompileError as e:
+        with contextlib.redirect_stdout(captured):
+            e.print_aa()
+    except Exception as e:
+        captured.write(f"{type(e).__name__}: {e}\n")
+
+    return BatchResult(inp_path, out_path, False, captured.getvalue(), 0, time.perf_counter() - start)
+
+def run_batch(jobs, n_workers=None, cache_dir=None, cache_size=DEFAULT_MAX_BYTES, use_cache=True, on_result=None, optimize=False, compact=False):
+    results = []
+
+    def finish(result):
+        results.append(result)
+        if on_result is not None:
+            on_result(result)
+
+    if n_workers == 1:
+        init_worker(cache_dir, cache_size, use_cache, optimize, compact)
+        for inp_path, out_path in jobs:
+            finish(assemble_one(inp_path, out_path))
+        return results
+
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        initializer=init_worker,
+        initargs=(cache_dir, cache_size, use_cache, optimize, compact),
+    ) as executor:
+        futures = {executor.submit(assemble_one, inp_path, out_path): (inp_path, out_path) for inp_path, out_path in jobs}
+        for future in as_completed(futures):
+            inp_path, out_path = futures[future]
+            try:
+                result = future.result()
+            except BaseException as e:
+                # The worker itself died
+                result = BatchResult(inp_path, out_path, False, f"{type(e).__name__}: {e}\n", 0, 0.0)
+            finish(result)
+
+    return results
+
+def print_result(result):
+    if result.ok:
+        print(f"ok     {result.inp_path} -> {result.out_path} ({result.n_bytes} bytes, {result.duration * 1000:.1f} ms)")
+    else:
+        print(f"FAILED {result.inp_path}")
+        for line in result.message.rstrip("\n").split("\n"):
+            print("    " + line)
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    arg_parser = argparse.ArgumentParser(description="Assemble many .dig files in parallel")
+    arg_parser.add_argument("inputs", nargs="+", help=".dig files, directories or glob patterns")
+    arg_parser.add_argument("-o", "--out-dir", help="Directory to write .act files to. Defaults to next to each input")
+    arg_parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of worker processes. Defaults to the number of cores")
+    arg_parser.add_argument("--cache-dir", help="Directory of the compile cache")
+    arg_parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_BYTES, help="Maximum size of the compile cache in bytes")
+    arg_parser.add_argument("--no-cache", action="store_true", help="Always compile, without reading or writing the cache")
+    arg_parser.add_argument("-O", "--optimize", action="store_true", help="Run the peephole optimizer and share repeated data")
+    arg_parser.add_argument("--compact", action="store_true", help="Write the compact v2 format")
+    arg_parser.add_argument("-q", "--quiet", action="store_true", help="Only report failures")
+    args = arg_parser.parse_args()
+
+    try:
+        jobs = collect_jobs(args.inputs, args.out_dir)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    if len(jobs) == 0:
+        print("No input files found")
+        sys.exit(1)
+
+    def report(result):
+        if not (args.quiet and result.ok):
+            print_result(result)
+
+    start = time.perf_counter()
+    results = run_batch(jobs, args.jobs, args.cache_dir, args.cache_size, not args.no_cache, report, args.optimize, args.compact)
+    duration = time.perf_counter() - start
+
+    n_failed = sum(1 for result in results if not result.ok)
+    print(f"{len(results) - n_failed} succeeded, {n_failed} failed, {len(results)} total in {duration:.2f} s")
+    if n_failed > 0:
+        sys.exit(1)
@@ -0,0 +1,149 @@
+import json
+import random
+
+from profiling import Instrumentation
+import tokenizer
+import compiler
+
+def generate_program(n_handlers=100, chain_length=4, n_strings=4, n_floats=4, comment_lines=8, seed=0):
+    # Generates an actor base laid out like examples/test.dig: a program table, handler names,
+    # then one program per handler
+    rng = random.Random(seed)
+    lines = []
+
+    lines.append("dw @=('functions')")
+    lines.append("")
+    lines.append("@declare('functions' 0)")
+    lines.append("@declare('atoms' 3355392)")
+    lines.append("")
+
+    for i in range(n_handlers):
+        lines.append(f"@inc('functions' 'h{i}-func')")
+        lines.append(f"@inc('atoms' 'h{i}-atom')")
+        lines.append(f"dw @=('h{i}-start')")
+        lines.append(f"dw @=('h{i}-end')")
+    lines.append("")
+
+    for i in range(n_handlers):
+        lines.append(f"@label('h{i}-name') ds 'handler-{i}'")
+    lines.append("")
+
+    for i in range(n_handlers):
+        lines.append(f"@label('h{i}-start')")
+        for j in range(comment_lines):
+            lines.append(f"    ; handler {i}, comment line {j}: " + "x" * rng.randint(10, 60))
+
+        # A chain of references to handlers later in the file, so most are forward references
+        for j in range(chain_length):
+            target = (i + 1 + j * 7) % n_handlers
+            lines.append(f"    set_integer r{j % 200} @=('h{target}-atom')")
+            lines.append(f"    integer_to_atom r{j % 200}")
+
+        for j in range(n_strings):
+            text = "".join(rng.choice("abcdefghij klmnop") for _ in range(rng.randint(5, 40)))
+            lines.append(f"    set_string r{200 + j % 50} '{text}\\n\\'{j}\\''")
+
+        for j in range(n_floats):
+            lines.append(f"    set_float r{100 + j % 50} {rng.randint(0, 100000)}.{rng.randint(0, 999)} ; delay")
+
+        lines.append("    set_self_addr r250")
+        lines.append("    copy r251 r250")
+        lines.append("    send_message r250 r100 r0 2")
+        lines.append("        r250 r251")
+        lines.append(f"    add_handler r0 @=('h{i}-func') @=('h{i}-name') 1")
+        lines.append("        r255 r251")
+        lines.append(f"@label('h{i}-end')")
+        lines.append("")
+
+    return "\n".join(lines)
+
+def run_stages(inp_text, combinator=False):
+    # Times one compile, with every stage run to completion on its own
+    instrumentation = Instrumentation(trace_memory=False)
+
+    previous_lexer = tokenizer.USE_COMBINATOR_LEXER
+    tokenizer.USE_COMBINATOR_LEXER = combinator
+    try:
+        compiler.compile_script(inp_text, instrumentation=instrumentation)
+    finally:
+        tokenizer.USE_COMBINATOR_LEXER = previous_lexer
+
+    stage_times = {stage.name: stage.wall_time for stage in instrumentation.stages}
+
+    stages = {stage.name: stage for stage in instrumentation.stages}
+    counts = {
+        "tokens": stages["tokenize"].counts["items"],
+        "instructions": stages["parse_instructions"].counts["items"],
+        "bytes": stages["compile_to_bytecode"].counts["bytes"],
+        "relocations": stages["compile_to_bytecode"].counts["relocations"],
+    }
+    return stage_times, counts
+
+def benchmark(inp_text, repeat=3, combinator=False):
+    # Keeps the fastest run of every stage, which is the least disturbed by noise
+    best = None
+    for _ in range(repeat):
+        stage_times, counts = run_stages(inp_text, combinator)
+        if best is None:
+            best = stage_times
+        else:
+            best = {stage: min(best[stage], stage_times[stage]) for stage in best}
+
+    return {
+        "source_bytes": len(inp_text.encode("utf-8")),
+        "source_lines": inp_text.count("\n") + 1,
+        "counts": counts,
+        "stages": best,
+        "total": sum(best.values()),
+    }
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    arg_parser = argparse.ArgumentParser(description="Time every stage of the assembler")
+    arg_parser.add_argument("inputs", nargs="*", help=".dig files to benchmark. Defaults to synthetic programs")
+    arg_parser.add_argument("--handlers", default="100,200,400", help="Comma separated handler counts of the synthetic programs")
+    arg_parser.add_argument("--chain-length", type=int, default=4, help="@= references per handler")
+    arg_parser.add_argument("--strings", type=int, default=4, help="String literals per handler")
+    arg_parser.add_argument("--floats", type=int, default=4, help="Float literals per handler")
+    arg_parser.add_argument("--comment-lines", type=int, default=8, help="Comment lines per handler")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--repeat", type=int, default=3, help="Runs per program, the fastest is reported")
+    arg_parser.add_argument("--combinator", action="store_true", help="Use the combinator lexer")
+    arg_parser.add_argument("-o", "--output", help="Write the JSON results here instead of stdout")
+    args = arg_parser.parse_args()
+
+    results = []
+    if len(args.inputs) > 0:
+        for inp_path in args.inputs:
+            with open(inp_path, "r") as inp_f:
+                result = benchmark(inp_f.read(), args.repeat, args.combinator)
+            result["input"] = inp_path
+            results.append(result)
+    else:
+        for n_handlers in [int(n) for n in args.handlers.split(",")]:
+            inp_text = generate_program(
+                n_handlers,
+                args.chain_length,
+                args.strings,
+                args.floats,
+                args.comment_lines,
+                args.seed,
+            )
+            result = benchmark(inp_text, args.repeat, args.combinator)
+            result["handlers"] = n_handlers
+            results.append(result)
+
+    report = {
+        "python": sys.version.split()[0],
+        "lexer": "combinator" if args.combinator else "fast",
+        "results": results,
+    }
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as out_f:
+            json.dump(report, out_f, indent=2)
@@ -0,0 +1,147 @@
+import hashlib
+import os
+import tempfile
+
+from instructions import INSTRUCTION_PATTERNS
+
+# Bump when a change to the assembler changes its output for the same source. The sources of the
+# modules in TOOLCHAIN_MODULES are part of the fingerprint too, so editing them is enough on its own
+TOOLCHAIN_VERSION = 2
+
+# Every module that has a say in the output for a source
+TOOLCHAIN_MODULES = [
+    "compiler.py",
+    "span.py",
+    "tokenizer.py",
+    "macro.py",
+    "values.py",
+    "instructions.py",
+    "include.py",
+    "liveness.py",
+    "regalloc.py",
+    "optimizer.py",
+    "compact.py",
+    "objfile.py",
+]
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "acta-dig")
+
+def update_with_sources(hasher, modules):
+    # Modules are looked up next to this one
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    for module in modules:
+        with open(os.path.join(base_dir, module), "rb") as f:
+            source = f.read()
+        hasher.update(f"source {module} {len(source)}\n".encode("utf-8"))
+        hasher.update(source)
+
+def toolchain_fingerprint():
+    hasher = hashlib.sha256()
+    hasher.update(f"toolchain {TOOLCHAIN_VERSION}\n".encode("utf-8"))
+    for inst in INSTRUCTION_PATTERNS:
+        operands = " ".join(kind.name for kind in inst.operands)
+        hasher.update(f"{inst.mnemonic} {inst.bytecode.hex()} {operands}\n".encode("utf-8"))
+    update_with_sources(hasher, TOOLCHAIN_MODULES)
+
+    return hasher.hexdigest()
+
+TOOLCHAIN_FINGERPRINT = toolchain_fingerprint()
+
+class CompileCache:
+    SUFFIX = ".act"
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir if cache_dir is not None else default_cache_dir()
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, inp_text, optimize=False, compact=False, object_file=False, dependencies=()):
+        # dependencies are (path, content hash) of every file included by the source
+        hasher = hashlib.sha256(TOOLCHAIN_FINGERPRINT.encode("utf-8"))
+        if optimize:
+            hasher.update(b"optimize\n")
+        if compact:
+            hasher.update(b"compact\n")
+        if object_file:
+            hasher.update(b"object\n")
+        for path, digest in dependencies:
+            hasher.update(f"include {path} {digest}\n".encode("utf-8"))
+        hasher.update(inp_text.encode("utf-8"))
+        return hasher.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + self.SUFFIX)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        # The modification time doubles as the last-used time for LRU eviction
+        os.utime(path)
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Write to a temporary file first so concurrent readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path(key))
+
+        self.evict()
+
+    def entries(self):
+        result = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith(self.SUFFIX):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    result.append((stat.st_mtime, stat.st_size, entry.path))
+
+        return result
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            return
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        if not os.path.isdir(self.cache_dir):
+            return
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def __str__(self):
+        return f"CompileCache(cache_dir={repr(self.cache_dir)}, hits={self.hits}, misses={self.misses})"
+
+    __repr__ = __str__
@@ -0,0 +1,100 @@
+import json
+import os
+import socket
+
+# The thin client of the assembler daemon (daemon.py). It only talks JSON lines over the daemon's
+# socket and never imports the assembler, so starting it is as cheap as starting Python.
+
+def default_socket_path():
+    base = os.environ.get("XDG_RUNTIME_DIR")
+    if base is None:
+        return os.path.join("/tmp", f"acta-dig-{os.getuid()}.sock")
+    return os.path.join(base, "acta-dig.sock")
+
+class DaemonClient:
+    def __init__(self, socket_path=None):
+        self.socket_path = socket_path if socket_path is not None else default_socket_path()
+        self.sock = None
+        self.reader = None
+        self.next_id = 0
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+        self.reader = sock.makefile("r", encoding="utf-8")
+
+    def close(self):
+        if self.sock is not None:
+            self.reader.close()
+            self.sock.close()
+            self.sock = None
+
+    def request(self, op, **fields):
+        if self.sock is None:
+            self.connect()
+
+        self.next_id += 1
+        message = dict(fields, id=self.next_id, op=op)
+        self.sock.sendall(json.dumps(message).encode("utf-8") + b"\n")
+
+        line = self.reader.readline()
+        if line == "":
+            raise ConnectionError("The daemon closed the connection")
+        return json.loads(line)
+
+    def compile(self, inp_path, out_path, optimize=False, compact=False):
+        # Paths are sent absolute, as the daemon runs in another directory
+        return self.request(
+            "compile",
+            input=os.path.abspath(inp_path),
+            output=os.path.abspath(out_path),
+            optimize=optimize,
+            compact=compact,
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    arg_parser = argparse.ArgumentParser(description="Assemble through a running assembler daemon")
+    arg_parser.add_argument("--socket", help="Socket of the daemon")
+    subparsers = arg_parser.add_subparsers(dest="command", required=True)
+
+    compile_parser = subparsers.add_parser("compile", help="Assemble a file, like compiler.py")
+    compile_parser.add_argument("input_path")
+    compile_parser.add_argument("output_path")
+    compile_parser.add_argument("-O", "--optimize", action="store_true", help="Remove redundant loads and dead stores, and share repeated data")
+    compile_parser.add_argument("--compact", action="store_true", help="Write the compact v2 format, with varints and a string pool")
+
+    subparsers.add_parser("stats", help="Show what the daemon has done and has cached")
+    subparsers.add_parser("shutdown", help="Stop the daemon")
+    args = arg_parser.parse_args()
+
+    with DaemonClient(args.socket) as client:
+        try:
+            if args.command == "compile":
+                response = client.compile(args.input_path, args.output_path, args.optimize, args.compact)
+            else:
+                response = client.request(args.command)
+        except OSError as e:
+            print(f"Can't reach the assembler daemon at {client.socket_path}: {e}")
+            sys.exit(2)
+
+    if args.command == "stats":
+        print(json.dumps(response, indent=2))
+    elif not response["ok"]:
+        print(response["message"], end="")
+        if len(response.get("errors", [])) > 0:
+            print(f"{len(response['errors'])} error(s)")
+        sys.exit(1)
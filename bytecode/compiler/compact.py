@@ -0,0 +1,190 @@
+from values import CompileOutput, ConstantPool, Relocation, Reference, String
+
+# The compact v2 .act format, see vm.txt. A file starts with MAGIC and the format version, then a
+# pool of every string in the file, then the same layout as a v1 file where integers are LEB128
+# varints and strings are varint indices into the pool. Offsets are from the start of the file.
+#
+# An @= slot is as wide as its value needs, but label values depend on the widths of the slots
+# before them. Every slot starts out one byte wide, and slots are widened until every value fits.
+# Slots only ever grow, so this stops after a few rounds, and values that end up narrower than
+# their slot are padded with continuation bytes.
+
+MAGIC = b"\xffACT"
+VERSION = 2
+
+U64_LIMIT = 1 << 64
+
+def varint_size(value):
+    size = 1
+    while value >= 0x80:
+        value >>= 7
+        size += 1
+    return size
+
+def encode_varint(value, size=None):
+    # LEB128, padded to size bytes if given
+    if not 0 <= value < U64_LIMIT:
+        raise ValueError(f"{value} doesn't fit in 64 bits")
+    if size is None:
+        size = varint_size(value)
+
+    out = bytearray()
+    for _ in range(size - 1):
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def decode_varint(data, pos, end):
+    # Returns (value, position after it), or None if the varint runs past end or past 64 bits
+    value = 0
+    shift = 0
+    while pos < end and shift < 64:
+        byte = data[pos]
+        value |= (byte & 0x7f) << shift
+        pos += 1
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+    return None
+
+def is_compact(data):
+    return bytes(data[:len(MAGIC)]) == MAGIC
+
+class VarintRelocation(Relocation):
+    def __init__(self, offset, symbol, span):
+        super(VarintRelocation, self).__init__(offset, None, symbol, span)
+        self.size = 1
+
+    def width(self):
+        return self.size
+
+    def __str__(self):
+        return f"VarintRelocation(offset={self.offset}, size={self.size}, symbol={repr(self.symbol)})"
+
+    __repr__ = __str__
+
+class CompactOutput(CompileOutput):
+    # While compiling, output holds everything but the header and the @= slots, and relocation
+    # offsets are positions in it. resolve_relocations lays the file out, replaces output with it
+    # and moves the relocations to their place in the file
+    def __init__(self, share_data=False, debug=False):
+        super(CompactOutput, self).__init__(share_data, debug)
+
+        # Text to index in the string pool
+        self.strings = ConstantPool()
+        # Label name to (position in output, number of relocations before it)
+        self.labels = {}
+        self.rounds = 0
+        self.header_size = 0
+
+    def write_integer(self, value):
+        self.write_bytes(encode_varint(value))
+
+    def string_index(self, text):
+        idx = self.strings.lookup(text)
+        if idx is None:
+            idx = len(self.strings)
+            self.strings.add(text, idx)
+        else:
+            # What a v1 file would have spent on writing it again
+            self.strings.share(8 + len(text.encode("utf-8")))
+        return idx
+
+    def write_string(self, text):
+        self.write_bytes(encode_varint(self.string_index(text)))
+
+    def encoded_size(self, value):
+        if isinstance(value, Reference):
+            # A slot is at least one byte
+            return 1
+        if isinstance(value, String):
+            return varint_size(self.strings.lookup(value.inner.value))
+        return varint_size(value.inner.value)
+
+    def add_relocation(self, fmt, symbol, span):
+        relocation = VarintRelocation(len(self.output), symbol, span)
+        self.relocations.append(relocation)
+        self.labels_here = []
+
+        return relocation
+
+    def define_label(self, name):
+        self.end_data_run()
+        self.labels[name] = (len(self.output), len(self.relocations))
+        self.labels_here.append(name)
+
+    def alias_label(self, name, target):
+        self.labels[name] = self.labels[target]
+
+    def counts(self):
+        counts = super(CompactOutput, self).counts()
+        counts["pooled_strings"] = len(self.strings)
+        counts["pool_bytes_saved"] = self.strings.bytes_saved
+        return counts
+
+    def header(self):
+        header = bytearray(MAGIC)
+        header.append(VERSION)
+        header += encode_varint(len(self.strings))
+        for text in self.strings.entries:
+            enc_text = text.encode("utf-8")
+            header += encode_varint(len(enc_text)) + enc_text
+
+        return header
+
+    def slot_bytes(self):
+        # Bytes taken by the slots before every relocation, and by all of them
+        slot_bytes = [0]
+        for relocation in self.relocations:
+            slot_bytes.append(slot_bytes[-1] + relocation.size)
+        return slot_bytes
+
+    def place_labels(self, base):
+        slot_bytes = self.slot_bytes()
+        for name, (position, n_before) in self.labels.items():
+            self.variables[name] = base + position + slot_bytes[n_before]
+
+    def debug_entries(self):
+        slot_bytes = self.slot_bytes()
+        return [(self.header_size + position + slot_bytes[n_before], span) for position, n_before, span in self.marks]
+
+    def resolve_relocations(self, diagnostics):
+        self.report_undeclared(diagnostics)
+        header = self.header()
+        self.header_size = len(header)
+
+        known = []
+        for relocation in self.relocations:
+            if relocation.symbol in self.variables or relocation.symbol in self.labels:
+                known.append(relocation)
+            else:
+                diagnostics.error("Variable not found", relocation.span)
+
+        while True:
+            self.rounds += 1
+            self.place_labels(len(header))
+
+            grown = False
+            for relocation in known:
+                size = varint_size(self.variables[relocation.symbol])
+                if size > relocation.size:
+                    relocation.size = size
+                    grown = True
+
+            if not grown:
+                break
+
+        out = header
+        position = 0
+        for relocation in self.relocations:
+            out += self.output[position:relocation.offset]
+            position = relocation.offset
+            relocation.offset = len(out)
+            out += encode_varint(self.variables.get(relocation.symbol, 0), relocation.size)
+        out += self.output[position:]
+
+        self.output = out
+
+    def __repr__(self):
+        return f"CompactOutput(output={self.output}, strings={list(self.strings)}, relocations={self.relocations}, variables={self.variables})"
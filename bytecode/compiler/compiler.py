@@ -1,27 +1,43 @@
 from abc import ABC, abstractmethod
+import os
 
-from tokenizer import MacroToken, MacroEndToken, AssemblyInstructionToken, CommentToken, ParseInput, parse_all, ParseException
+from tokenizer import MacroToken, MacroEndToken, AssemblyInstructionToken, CommentToken, ParseInput, parse_all
 
-from macro import construct_macro, Macro
+from diagnostics import Diagnostics, CompileError
+
+from profiling import NULL_INSTRUMENTATION
+
+from macro import construct_macro, Macro, ExportPseudoInstruction
 
 import values
 
 from instructions import construct_instruction, Instruction
 
-def preproc_tokens(token_list):
-    return [token for token in token_list if not isinstance(token, CommentToken)]
+from regalloc import allocate_registers, AllocatorStats
+
+from optimizer import optimize_instructions, OptimizerStats
+
+from compact import CompactOutput
+
+from objfile import ObjectOutput
+
+from include import Includes, uses_include
 
-def group_macros(token_list):
-    token_list.append(MacroToken(None, "dummy"))
+# Every stage up to compile_to_bytecode takes and returns an iterable, so tokens stream through the
+# pipeline one at a time instead of being collected into a list between stages.
 
-    result = []
+def preproc_tokens(token_list):
+    return (token for token in token_list if not isinstance(token, CommentToken))
 
+def group_macros(token_list, diagnostics):
     macro_processing = None # (macro_token, [arguments])
 
     for token in token_list:
         if macro_processing is not None:
             if isinstance(token, MacroEndToken):
-                result.append(construct_macro(*macro_processing))
+                macro = construct_macro(*macro_processing, diagnostics)
+                if macro is not None:
+                    yield macro
 
                 macro_processing = None
             else:
@@ -31,56 +47,102 @@ def group_macros(token_list):
             if isinstance(token, MacroToken):
                 macro_processing = (token, [])
             else:
-                result.append(token)
+                yield token
 
-    return result
+    if macro_processing is not None:
+        diagnostics.error("Macro is never closed", macro_processing[0].span)
 
 def upgrade_values(element_list):
-    return [values.upgrade(element) for element in element_list]
+    return (values.upgrade(element) for element in element_list)
 
 def pseudo_expand_macros(element_list):
+    # The macro list is filled in as the result is consumed
     macros = []
-    result = []
 
-    for thing in element_list:
-        if isinstance(thing, Macro):
-            result.extend(thing.into_pseudo_values())
-            macros.append(thing)
-        else:
-            result.append(thing)
+    def expand():
+        for thing in element_list:
+            if isinstance(thing, Macro):
+                yield from thing.into_pseudo_values()
+                macros.append(thing)
+            else:
+                yield thing
 
-    return result, macros
+    return expand(), macros
 
-def parse_instructions(element_list):
-    element_list.append(AssemblyInstructionToken(None, "dummy"))
+def reported_between(diagnostics, start, end):
+    # Whether an error was already reported after the span start and before the span end, like an
+    # argument of an instruction that didn't lex. Without end, anything after start counts
+    for error in diagnostics.errors:
+        span = error.span
+        if span is None or span.source is not start.source or span.start <= start.start:
+            continue
+        if end is None or end.source is not span.source or span.start < end.start:
+            return True
+    return False
 
-    result = []
+def construct_parsed(parsing_instruction, diagnostics, end):
+    # An argument that already failed to parse is missing from the arguments, so the instruction
+    # isn't checked against them, as that would report the same mistake again
+    token, arguments = parsing_instruction
+    if reported_between(diagnostics, token.span, end):
+        return construct_instruction(token, arguments, Diagnostics())
+    return construct_instruction(token, arguments, diagnostics)
+
+def parse_instructions(element_list, diagnostics):
     parsing_instruction = None
     for thing in element_list:
         if isinstance(thing, AssemblyInstructionToken) or isinstance(thing, Instruction):
             if parsing_instruction is not None:
                 # Write previous
-                result.append(construct_instruction(*parsing_instruction))
+                inst = construct_parsed(parsing_instruction, diagnostics, thing.span)
+                if inst is not None:
+                    yield inst
                 parsing_instruction = None
             if isinstance(thing, AssemblyInstructionToken):
                 parsing_instruction = (thing, [])
             else:
                 parsing_instruction = None
-                result.append(thing)
+                yield thing
         else:
             if parsing_instruction is not None:
                 parsing_instruction[1].append(thing)
             else:
-                print(thing)
-                print("Argument to no function")
-                exit()
+                span = thing.inner.span if isinstance(thing, values.Value) else thing.span
+                diagnostics.error("Argument to no function", span)
 
-    return result
+    if parsing_instruction is not None:
+        inst = construct_parsed(parsing_instruction, diagnostics, None)
+        if inst is not None:
+            yield inst
 
-def compile_to_bytecode(instructions):
-    output = values.CompileOutput()
+def pinned_labels(instructions):
+    # Labels that are positions in the file rather than pointers to the data after them: those
+    # written out with dw @=, like the start and end of every program in the table, and exported
+    # ones, which another object file may use that way
+    pinned = set()
+    for inst in instructions:
+        if isinstance(inst, ExportPseudoInstruction):
+            pinned.add(inst.variable_name)
+        elif len(inst.bytecode) == 0 and len(inst.arguments) > 0 and isinstance(inst.arguments[0], values.Reference):
+            pinned.add(inst.arguments[0].symbol)
+
+    return pinned
+
+def compile_to_bytecode(instructions, compact=False, share_data=False, object_file=False, debug=False):
+    if object_file:
+        output = ObjectOutput(share_data)
+    elif compact:
+        output = CompactOutput(share_data, debug)
+    else:
+        output = values.CompileOutput(share_data, debug)
+    if share_data:
+        # Whether data can be shared depends on how its labels are used anywhere in the file, so
+        # the instructions are collected first
+        instructions = list(instructions)
+        output.pinned = pinned_labels(instructions)
     for inst in instructions:
         inst.compile_to_bytecode(output)
+    output.end_data_run()
 
     return output
 
@@ -88,37 +150,144 @@ def postproc_macro(output, macros):
     for macro in macros:
         macro.post_process(output)
 
-def compile_script(inp_text):
+def compile_script(inp_text, cache=None, instrumentation=None, optimize=False, compact=False, object_file=False, inp_path=None, includes=None, line_table=None):
+    # With an instrumentation sink (see profiling.Instrumentation) every stage runs to completion
+    # before the next starts, so that it can be measured on its own. Virtual registers are given
+    # physical registers by regalloc.py after parse_instructions, and with optimize, the peephole
+    # optimizer in optimizer.py runs after that and repeated dw and ds data is shared, see
+    # values.CompileOutput. With compact, the output is in the v2 format from compact.py, and with
+    # object_file it is an object file for linker.py, see objfile.py. @include's are resolved
+    # relative to inp_path, and the files they include are memoized by includes, see include.py.
+    # A debugmap.LineTable given as line_table is filled with the source of every instruction,
+    # which bypasses the cache
+    if compact and object_file:
+        raise ValueError("Object files are always in the v1 format")
+    if object_file and line_table is not None:
+        raise ValueError("Object files don't have a debug line table")
+    if instrumentation is None:
+        instrumentation = NULL_INSTRUMENTATION
+    if inp_path is not None:
+        inp_path = os.path.abspath(inp_path)
+    if includes is None:
+        includes = Includes()
+    has_includes = uses_include(inp_text)
+
+    if line_table is not None:
+        cache = None
+    if cache is not None:
+        dependencies = includes.dependencies(inp_text, inp_path) if has_includes else ()
+        key = cache.key(inp_text, optimize, compact, object_file, dependencies)
+        cached = instrumentation.stage("cache_lookup", lambda: cache.get(key))
+        if cached is not None:
+            return memoryview(cached)
+
+    # Errors are collected as the pipeline runs, and raised together as one CompileError at the end
+    diagnostics = Diagnostics()
+
     inp_pi = ParseInput(inp_text)
-    tokens = parse_all(inp_pi)
-    tokens = preproc_tokens(tokens)
-    parsed = group_macros(tokens)
-    parsed = upgrade_values(parsed)
+    tokens = instrumentation.stage(
+        "tokenize",
+        lambda: preproc_tokens(parse_all(inp_pi, diagnostics=diagnostics)),
+    )
+    parsed = instrumentation.stage("group_macros", lambda: group_macros(tokens, diagnostics))
+    parsed = instrumentation.stage("upgrade_values", lambda: upgrade_values(parsed))
+    if has_includes:
+        parsed = instrumentation.stage("expand_includes", lambda: includes.expand(parsed, diagnostics, inp_path))
+
+    expanded, macros = pseudo_expand_macros(parsed)
+    parsed = instrumentation.stage("pseudo_expand_macros", lambda: expanded)
 
-    parsed, macros = pseudo_expand_macros(parsed)
+    parsed = instrumentation.stage("parse_instructions", lambda: parse_instructions(parsed, diagnostics))
+    allocator_stats = AllocatorStats()
+    parsed = instrumentation.stage(
+        "allocate_registers",
+        lambda: allocate_registers(parsed, diagnostics, allocator_stats),
+        lambda _: allocator_stats.counts(),
+    )
+    if optimize:
+        stats = OptimizerStats()
+        parsed = instrumentation.stage(
+            "optimize",
+            lambda: optimize_instructions(parsed, stats),
+            lambda _: stats.counts(),
+        )
+    output = instrumentation.stage(
+        "compile_to_bytecode",
+        lambda: compile_to_bytecode(parsed, compact, optimize, object_file, line_table is not None),
+        lambda output: output.counts(),
+    )
 
-    parsed = parse_instructions(parsed)
-    output = compile_to_bytecode(parsed)
+    instrumentation.stage("resolve_relocations", lambda: output.resolve_relocations(diagnostics))
+    instrumentation.stage("postproc_macro", lambda: postproc_macro(output, macros))
+    diagnostics.raise_if_errors()
 
-    postproc_macro(output, macros)
-    return output.output
+    if line_table is not None:
+        line_table.add_entries(output.debug_entries(), inp_path if inp_path is not None else "<input>", len(output.output))
+    if cache is not None:
+        cache.put(key, output.output)
+    return output.getvalue()
 
 
 if __name__ == "__main__":
+    import argparse
     import sys
 
-    if len(sys.argv) == 3:
-        inp_path = sys.argv[1]
-        out_path = sys.argv[2]
-
-        with open(inp_path, "r") as inp_f:
-            try:
-                out = compile_script(inp_f.read())
-                with open(out_path, "wb") as out_f:
-                    out_f.write(out)
-            except ParseException as e:
-                e.span.print_aa()
-                print(e.reason)
-                raise e
-    else:
-        print(f"Run as {sys.argv[0]} <input path> <output_path>")
+    from cache import CompileCache, DEFAULT_MAX_BYTES
+    from debugmap import LineTable, append_section
+    from include import ParseCache
+    from profiling import Instrumentation
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("input_path")
+    arg_parser.add_argument("output_path")
+    arg_parser.add_argument("--cache-dir", help="Directory of the compile cache")
+    arg_parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_BYTES, help="Maximum size of the compile cache in bytes")
+    arg_parser.add_argument("--no-cache", action="store_true", help="Always compile, without reading or writing the cache")
+    arg_parser.add_argument("-O", "--optimize", action="store_true", help="Remove redundant loads and dead stores, and share repeated data")
+    arg_parser.add_argument("--compact", action="store_true", help="Write the compact v2 format, with varints and a string pool")
+    arg_parser.add_argument("-c", "--object", action="store_true", help="Write an object file to link with linker.py instead of an actor base")
+    arg_parser.add_argument("--debug-map", help="Write a table of the source line of every instruction to this path, see debugmap.py")
+    arg_parser.add_argument("--debug-section", action="store_true", help="Append the table of source lines to the output instead. The VM ignores it")
+    arg_parser.add_argument("--profile", action="store_true", help="Report time, counts and peak memory of every stage. Memory tracing slows every stage down. Implies --no-cache")
+    arg_parser.add_argument("--profile-dump", help="With --profile, write cProfile stats of the slowest stage to this path")
+    args = arg_parser.parse_args()
+    if args.compact and args.object:
+        arg_parser.error("object files are always in the v1 format, link them to get a v1 file")
+    if args.object and (args.debug_map is not None or args.debug_section):
+        arg_parser.error("object files don't have a debug line table")
+
+    cache = None
+    includes = Includes()
+    if not args.no_cache and not args.profile:
+        cache = CompileCache(args.cache_dir, args.cache_size)
+        includes = Includes(ParseCache(args.cache_dir, args.cache_size))
+
+    instrumentation = None
+    if args.profile:
+        instrumentation = Instrumentation(profile=args.profile_dump is not None)
+
+    line_table = None
+    if args.debug_map is not None or args.debug_section:
+        line_table = LineTable()
+
+    with open(args.input_path, "r") as inp_f:
+        try:
+            out = compile_script(inp_f.read(), cache, instrumentation, args.optimize, args.compact, args.object, args.input_path, includes, line_table)
+        except CompileError as e:
+            e.print_aa()
+            print(f"{len(e.diagnostics)} error(s)")
+            sys.exit(1)
+        finally:
+            if instrumentation is not None:
+                print(instrumentation.format_report())
+                if args.profile_dump is not None:
+                    stage = instrumentation.dump_slowest_profile(args.profile_dump)
+                    print(f"Wrote profile of slowest stage {stage.name} to {args.profile_dump}")
+
+    if args.debug_section:
+        out = append_section(out, line_table)
+    with open(args.output_path, "wb") as out_f:
+        out_f.write(out)
+    if args.debug_map is not None:
+        with open(args.debug_map, "wb") as map_f:
+            map_f.write(line_table.encode())
@@ -0,0 +1,337 @@
+import base64
+import contextlib
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from batch import BatchResult, collect_jobs, print_result
+from cache import CompileCache, DEFAULT_MAX_BYTES
+from client import default_socket_path
+from diagnostics import CompileError
+from include import Includes, ParseCache, uses_include
+from incremental import IncrementalAssembler
+
+# A long-lived assembler, so that build steps calling it hundreds of times only pay for imports and
+# instruction tables once. It keeps an IncrementalAssembler for every file it has seen, so
+# assembling an edited file again only redoes the programs that changed, and can sit in front of
+# the compile cache.
+#
+# Requests and responses are JSON objects, one per line, over a Unix socket or stdin/stdout:
+#
+#   {"id": 1, "op": "compile", "input": "/abs/in.dig", "output": "/abs/out.act", "optimize": false, "compact": false}
+#   {"id": 1, "ok": true, "n_bytes": 447, "duration": 0.0012}
+#
+# Without "output" the response has the assembled file in "data", base64 encoded, and "source"
+# can be given instead of "input", with "name" naming it. A failed compile has ok false, the
+# diagnostics as they would be printed in "message" and each of them in "errors". "stats" reports
+# what the daemon has done, and "shutdown" stops it.
+
+MAX_ASSEMBLERS = 64
+
+def diagnostic_json(diagnostic):
+    span = diagnostic.span
+    if span is None:
+        return {"message": diagnostic.message}
+
+    line_idx, column = span.source.line_col(span.start)
+    return {
+        "message": diagnostic.message,
+        "start": span.start,
+        "end": span.end,
+        "line": line_idx + 1,
+        "column": column + 1,
+    }
+
+def path_of(name):
+    # Inline sources are named by the client, and have no path to resolve @include's against
+    return name if os.path.isabs(name) else None
+
+class AssemblerState:
+    # Everything the daemon keeps warm. Requests can come from several connections at once, but
+    # only one is assembled at a time
+    def __init__(self, cache=None, max_assemblers=MAX_ASSEMBLERS, includes=None):
+        self.cache = cache
+        self.max_assemblers = max_assemblers
+        self.includes = includes if includes is not None else Includes()
+        self.lock = threading.Lock()
+
+        # (name, optimize, compact) to IncrementalAssembler, least recently used first
+        self.assemblers = OrderedDict()
+
+        self.started = time.time()
+        self.compiles = 0
+        self.failures = 0
+
+    def assembler(self, name, optimize, compact):
+        key = (name, optimize, compact)
+        assembler = self.assemblers.get(key)
+        if assembler is None:
+            assembler = self.assemblers[key] = IncrementalAssembler(optimize, compact, path_of(name), self.includes)
+            while len(self.assemblers) > self.max_assemblers:
+                self.assemblers.popitem(last=False)
+        else:
+            self.assemblers.move_to_end(key)
+        return assembler
+
+    def build(self, name, inp_text, optimize, compact):
+        key = None
+        if self.cache is not None:
+            dependencies = self.includes.dependencies(inp_text, path_of(name)) if uses_include(inp_text) else ()
+            key = self.cache.key(inp_text, optimize, compact, dependencies=dependencies)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+
+        out = self.assembler(name, optimize, compact).build(inp_text)
+        if key is not None:
+            self.cache.put(key, out)
+        return out
+
+    def compile(self, request):
+        start = time.perf_counter()
+        inp_path = request.get("input")
+        out_path = request.get("output")
+        optimize = bool(request.get("optimize", False))
+        compact = bool(request.get("compact", False))
+
+        try:
+            inp_text = request.get("source")
+            if inp_text is None:
+                with open(inp_path, "r") as inp_f:
+                    inp_text = inp_f.read()
+            name = inp_path if inp_path is not None else request.get("name", "<source>")
+
+            with self.lock:
+                self.compiles += 1
+                out = self.build(name, inp_text, optimize, compact)
+
+            response = {"ok": True, "n_bytes": len(out)}
+            if out_path is None:
+                response["data"] = base64.b64encode(out).decode("ascii")
+            else:
+                out_parent = os.path.dirname(out_path)
+                if out_parent != "":
+                    os.makedirs(out_parent, exist_ok=True)
+                with open(out_path, "wb") as out_f:
+                    out_f.write(out)
+        except CompileError as e:
+            captured = io.StringIO()
+            with contextlib.redirect_stdout(captured):
+                e.print_aa()
+            response = {
+                "ok": False,
+                "message": captured.getvalue(),
+                "errors": [diagnostic_json(diagnostic) for diagnostic in e.diagnostics],
+            }
+        except Exception as e:
+            response = {"ok": False, "message": f"{type(e).__name__}: {e}\n"}
+
+        if not response["ok"]:
+            self.failures += 1
+        response["duration"] = time.perf_counter() - start
+        return response
+
+    def stats(self):
+        assemblers = {}
+        for (name, optimize, compact), assembler in self.assemblers.items():
+            flags = "".join([" -O" if optimize else "", " --compact" if compact else ""])
+            assemblers[name + flags] = assembler.stats.counts()
+
+        stats = {
+            "ok": True,
+            "uptime": time.time() - self.started,
+            "compiles": self.compiles,
+            "failures": self.failures,
+            "assemblers": assemblers,
+            "includes": self.includes.stats.counts(),
+        }
+        if self.cache is not None:
+            stats["cache_hits"] = self.cache.hits
+            stats["cache_misses"] = self.cache.misses
+        return stats
+
+    def handle_line(self, line):
+        # Returns (response line, whether to shut down)
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("a request is a JSON object")
+        except ValueError as e:
+            return self.encode({"ok": False, "message": f"Bad request: {e}\n"}), False
+
+        op = request.get("op", "compile")
+        if op == "compile":
+            response = self.compile(request)
+        elif op == "stats":
+            response = self.stats()
+        elif op == "shutdown":
+            response = {"ok": True}
+        else:
+            response = {"ok": False, "message": f"Unknown op {repr(op)}\n"}
+
+        if "id" in request:
+            response["id"] = request["id"]
+        return self.encode(response), op == "shutdown"
+
+    def encode(self, response):
+        return json.dumps(response) + "\n"
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            response, shutdown = self.server.state.handle_line(line.decode("utf-8"))
+            self.wfile.write(response.encode("utf-8"))
+            self.wfile.flush()
+            if shutdown:
+                # shutdown() waits for serve_forever, which runs in another thread
+                threading.Thread(target=self.server.shutdown).start()
+                return
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, state):
+        self.state = state
+        super(DaemonServer, self).__init__(socket_path, RequestHandler)
+
+class DaemonRunningError(Exception):
+    def __init__(self, socket_path):
+        super(DaemonRunningError, self).__init__(socket_path)
+        self.socket_path = socket_path
+
+    def __str__(self):
+        return f"A daemon is already listening on {self.socket_path}"
+
+def is_listening(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        return False
+    finally:
+        sock.close()
+    return True
+
+def serve_socket(state, socket_path):
+    # Raises DaemonRunningError rather than taking over the socket of a daemon that is still running
+    if os.path.exists(socket_path):
+        if is_listening(socket_path):
+            raise DaemonRunningError(socket_path)
+        # A socket left behind by a daemon that didn't stop cleanly
+        os.unlink(socket_path)
+
+    with DaemonServer(socket_path, state) as server:
+        print(f"Listening on {socket_path}", flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(socket_path)
+
+def serve_stdio(state):
+    for line in sys.stdin:
+        if line.strip() == "":
+            continue
+        response, shutdown = state.handle_line(line)
+        sys.stdout.write(response)
+        sys.stdout.flush()
+        if shutdown:
+            return
+
+def mtime_of(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def watch(state, inputs, out_dir=None, optimize=False, compact=False, interval=0.5):
+    # Assembles every input once, then again whenever it or a file it @include's changes. Files
+    # appearing in watched directories or matching watched patterns are picked up too. An input
+    # included by another input is a fragment, and is only assembled as part of the files
+    # including it
+    # Absolute input path to (absolute paths of the files it includes, their mtimes and its own)
+    known = {}
+    while True:
+        jobs = collect_jobs(inputs, out_dir)
+
+        changed = []
+        for inp_path, out_path in jobs:
+            abs_path = os.path.abspath(inp_path)
+            previous = known.get(abs_path)
+            if previous is not None:
+                dependencies, stamp = previous
+                if stamp == tuple(mtime_of(path) for path in (abs_path,) + dependencies):
+                    continue
+
+            mtime = mtime_of(abs_path)
+            try:
+                with open(abs_path, "r") as inp_f:
+                    inp_text = inp_f.read()
+            except OSError:
+                known.pop(abs_path, None)
+                continue
+
+            dependencies = ()
+            if uses_include(inp_text):
+                dependencies = tuple(path for path, _ in state.includes.dependencies(inp_text, abs_path))
+            known[abs_path] = (dependencies, (mtime,) + tuple(mtime_of(path) for path in dependencies))
+            changed.append((inp_path, abs_path, out_path))
+
+        fragments = {path for dependencies, _ in known.values() for path in dependencies}
+        for inp_path, abs_path, out_path in changed:
+            if abs_path in fragments:
+                continue
+
+            response = state.compile({"input": abs_path, "output": out_path, "optimize": optimize, "compact": compact})
+            print_result(BatchResult(inp_path, out_path, response["ok"], response.get("message", ""), response.get("n_bytes", 0), response["duration"]))
+            sys.stdout.flush()
+
+        time.sleep(interval)
+
+if __name__ == "__main__":
+    import argparse
+
+    arg_parser = argparse.ArgumentParser(description="Run the assembler as a long-lived daemon, or rebuild .dig files as they change")
+    arg_parser.add_argument("--socket", help="Unix socket to listen on. Defaults to one per user in XDG_RUNTIME_DIR or /tmp")
+    arg_parser.add_argument("--stdio", action="store_true", help="Read requests from stdin and answer on stdout instead")
+    arg_parser.add_argument("--watch", nargs="+", metavar="INPUT", help="Rebuild these .dig files, directories or glob patterns whenever they change")
+    arg_parser.add_argument("-o", "--out-dir", help="With --watch, directory to write .act files to. Defaults to next to each input")
+    arg_parser.add_argument("--interval", type=float, default=0.5, help="With --watch, seconds between checks for changes")
+    arg_parser.add_argument("-O", "--optimize", action="store_true", help="With --watch, remove redundant loads and dead stores, and share repeated data")
+    arg_parser.add_argument("--compact", action="store_true", help="With --watch, write the compact v2 format")
+    arg_parser.add_argument("--cache-dir", help="Directory of the compile cache")
+    arg_parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_BYTES, help="Maximum size of the compile cache in bytes")
+    arg_parser.add_argument("--no-cache", action="store_true", help="Always compile, without reading or writing the cache")
+    args = arg_parser.parse_args()
+
+    cache = None
+    includes = Includes()
+    if not args.no_cache:
+        cache = CompileCache(args.cache_dir, args.cache_size)
+        includes = Includes(ParseCache(args.cache_dir, args.cache_size))
+    state = AssemblerState(cache, includes=includes)
+
+    if args.watch is not None:
+        try:
+            watch(state, args.watch, args.out_dir, args.optimize, args.compact, args.interval)
+        except KeyboardInterrupt:
+            pass
+        except ValueError as e:
+            # Two inputs with the same output, see batch.collect_jobs
+            print(e)
+            sys.exit(1)
+    elif args.stdio:
+        serve_stdio(state)
+    else:
+        try:
+            serve_socket(state, args.socket if args.socket is not None else default_socket_path())
+        except DaemonRunningError as e:
+            print(e)
+            sys.exit(1)
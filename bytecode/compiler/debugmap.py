@@ -0,0 +1,264 @@
+from array import array
+from bisect import bisect_right
+import struct
+
+from compact import encode_varint, decode_varint
+
+# The debug line table maps every byte of an assembled file back to the instruction it came from,
+# as a file, line and column. Every instruction (dw and ds included) starts an entry, which covers
+# the bytes up to the next one. Instructions on the same position as the one before them share its
+# entry, and an instruction that wrote nothing, like shared data, gives way to the one after it.
+#
+# The table is written as a sidecar file, or appended to the .act file as a trailing section.
+# Both are delta encoded with LEB128 varints:
+#
+#   MAGIC [version:1]
+#   [length of the code]
+#   [n files] then for every file [length] [UTF-8 name]
+#   [n entries] then for every entry
+#       [offset delta * 2 + 1 if the file changed] ([file index] if it changed)
+#       [line delta, zigzag encoded] [column]
+#
+# A trailing section is followed by its length as 8 bytes and TRAILER_MAGIC, so that it can be
+# found from the end of the file. Lines and columns count from 1, like in the assembler's errors.
+
+MAGIC = b"\xffACD"
+VERSION = 2
+
+TRAILER_MAGIC = b"ACDT"
+TRAILER = struct.Struct("<Q4s")
+
+class DebugMapError(Exception):
+    def __init__(self, message, offset=None):
+        super(DebugMapError, self).__init__(message)
+        self.message = message
+        self.offset = offset
+
+    def __str__(self):
+        if self.offset is None:
+            return self.message
+        return f"{self.message} at 0x{self.offset:x}"
+
+def zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+def unzigzag(value):
+    return value // 2 if value % 2 == 0 else -(value + 1) // 2
+
+class LineTable:
+    def __init__(self):
+        self.files = []
+        self.file_ids = {}
+        # Offsets at or past this aren't in the code, like those of a trailing debug section
+        self.code_end = 0
+
+        # One entry per index, with offsets increasing
+        self.offsets = array("Q")
+        self.file_idxs = array("I")
+        self.lines = array("I")
+        self.columns = array("I")
+
+    def file_id(self, name):
+        file_id = self.file_ids.get(name)
+        if file_id is None:
+            file_id = self.file_ids[name] = len(self.files)
+            self.files.append(name)
+        return file_id
+
+    def add(self, offset, name, line, column):
+        file_idx = self.file_id(name)
+        if len(self.offsets) > 0 and self.offsets[-1] == offset:
+            # The instruction before wrote nothing
+            self.offsets.pop()
+            self.file_idxs.pop()
+            self.lines.pop()
+            self.columns.pop()
+
+        if len(self.offsets) > 0 and (self.file_idxs[-1], self.lines[-1], self.columns[-1]) == (file_idx, line, column):
+            return
+
+        self.offsets.append(offset)
+        self.file_idxs.append(file_idx)
+        self.lines.append(line)
+        self.columns.append(column)
+
+    def add_entries(self, entries, root_name, code_end):
+        # From CompileOutput.debug_entries. Spans in the file being assembled have no name
+        self.code_end = code_end
+        for offset, span in entries:
+            if span is None:
+                continue
+            source = span.source
+            line_idx, column = source.line_col(span.start)
+            name = source.name if source.name is not None else root_name
+            self.add(offset, name, line_idx + 1, column + 1)
+
+    def lookup(self, offset):
+        # (file, line, column) of the instruction the byte at offset belongs to, or None before the
+        # first instruction and past the end of the code. A binary search, so O(log n) in the
+        # number of entries
+        if offset >= self.code_end:
+            return None
+        idx = bisect_right(self.offsets, offset) - 1
+        if idx < 0:
+            return None
+        return self.files[self.file_idxs[idx]], self.lines[idx], self.columns[idx]
+
+    def entries(self):
+        for idx in range(len(self.offsets)):
+            yield self.offsets[idx], self.files[self.file_idxs[idx]], self.lines[idx], self.columns[idx]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def encode(self):
+        out = bytearray(MAGIC)
+        out.append(VERSION)
+        out += encode_varint(self.code_end)
+
+        out += encode_varint(len(self.files))
+        for name in self.files:
+            enc_name = name.encode("utf-8")
+            out += encode_varint(len(enc_name)) + enc_name
+
+        out += encode_varint(len(self.offsets))
+        prev_offset, prev_file, prev_line = 0, 0, 0
+        for idx in range(len(self.offsets)):
+            file_idx = self.file_idxs[idx]
+            file_changed = file_idx != prev_file
+            out += encode_varint((self.offsets[idx] - prev_offset) * 2 + file_changed)
+            if file_changed:
+                out += encode_varint(file_idx)
+            out += encode_varint(zigzag(self.lines[idx] - prev_line))
+            out += encode_varint(self.columns[idx])
+
+            prev_offset, prev_file, prev_line = self.offsets[idx], file_idx, self.lines[idx]
+
+        return bytes(out)
+
+    @staticmethod
+    def decode(data):
+        if bytes(data[:len(MAGIC)]) != MAGIC:
+            raise DebugMapError("Not a debug line table")
+        if len(data) <= len(MAGIC) or data[len(MAGIC)] != VERSION:
+            raise DebugMapError("Unsupported debug line table version", len(MAGIC))
+
+        pos = len(MAGIC) + 1
+
+        def read_varint():
+            nonlocal pos
+            decoded = decode_varint(data, pos, len(data))
+            if decoded is None:
+                raise DebugMapError("Bad varint", pos)
+            value, pos = decoded
+            return value
+
+        table = LineTable()
+        table.code_end = read_varint()
+        for _ in range(read_varint()):
+            length = read_varint()
+            if length > len(data) - pos:
+                raise DebugMapError("File name runs past the end", pos)
+            try:
+                table.file_id(bytes(data[pos:pos + length]).decode("utf-8"))
+            except UnicodeDecodeError:
+                raise DebugMapError("File name isn't valid UTF-8", pos)
+            pos += length
+
+        offset, file_idx, line = 0, 0, 0
+        for _ in range(read_varint()):
+            offset_delta = read_varint()
+            offset += offset_delta >> 1
+            if offset_delta & 1:
+                file_idx = read_varint()
+                if file_idx >= len(table.files):
+                    raise DebugMapError(f"No file {file_idx}", pos)
+            line += unzigzag(read_varint())
+
+            table.offsets.append(offset)
+            table.file_idxs.append(file_idx)
+            table.lines.append(line)
+            table.columns.append(read_varint())
+
+        if pos != len(data):
+            raise DebugMapError("Trailing data after the entries", pos)
+        return table
+
+    def __str__(self):
+        return f"LineTable(files={self.files}, entries={len(self.offsets)})"
+
+    __repr__ = __str__
+
+def append_section(act_data, table):
+    section = table.encode()
+    return bytes(act_data) + section + TRAILER.pack(len(section), TRAILER_MAGIC)
+
+def find_section(data):
+    # Returns (where the trailing section starts, its LineTable), or (the length of data, None)
+    # without one. A v1 file can end in bytes that look like a trailer, like a ds 'ACDT', so the
+    # section has to decode as a line table too
+    if len(data) < TRAILER.size:
+        return len(data), None
+    length, magic = TRAILER.unpack_from(data, len(data) - TRAILER.size)
+    if magic != TRAILER_MAGIC or length > len(data) - TRAILER.size:
+        return len(data), None
+
+    start = len(data) - TRAILER.size - length
+    if bytes(data[start:start + len(MAGIC)]) != MAGIC:
+        return len(data), None
+    try:
+        table = LineTable.decode(data[start:len(data) - TRAILER.size])
+    except DebugMapError:
+        return len(data), None
+    if table.code_end != start:
+        return len(data), None
+    return start, table
+
+def section_start(data):
+    # Where the trailing section starts, or the length of data without one
+    return find_section(data)[0]
+
+def split_section(data):
+    # Returns (the file without its trailing section, LineTable or None)
+    start, table = find_section(data)
+    return data[:start], table
+
+def load_table(data):
+    # From a sidecar file, or an .act file with a trailing section
+    if bytes(data[:len(MAGIC)]) == MAGIC:
+        return LineTable.decode(data)
+    _, table = split_section(data)
+    if table is None:
+        raise DebugMapError("No debug line table in the file")
+    return table
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    arg_parser = argparse.ArgumentParser(description="Find the source lines of offsets in an assembled file")
+    arg_parser.add_argument("path", help="A sidecar debug map, or an .act file with a debug section")
+    arg_parser.add_argument("offsets", nargs="*", help="Offsets into the .act file, like 0x1f2. Without any, the whole table is shown")
+    args = arg_parser.parse_args()
+
+    with open(args.path, "rb") as inp_f:
+        try:
+            table = load_table(inp_f.read())
+        except DebugMapError as e:
+            print(f"{args.path}: {e}")
+            sys.exit(1)
+
+    if len(args.offsets) == 0:
+        for offset, name, line, column in table.entries():
+            print(f"0x{offset:x}: {name}:{line}:{column}")
+        sys.exit(0)
+
+    for text in args.offsets:
+        offset = int(text, 0)
+        location = table.lookup(offset)
+        if offset >= table.code_end:
+            print(f"0x{offset:x}: past the end of the code")
+        elif location is None:
+            print(f"0x{offset:x}: before the first instruction")
+        else:
+            print(f"0x{offset:x}: {location[0]}:{location[1]}:{location[2]}")
@@ -0,0 +1,51 @@
+class Diagnostic:
+    def __init__(self, message, span):
+        self.message = message
+        self.span = span
+
+    def print_aa(self):
+        if self.span is not None:
+            self.span.print_aa()
+        print(self.message)
+
+    def __str__(self):
+        return f"Diagnostic(message={repr(self.message)}, span={self.span})"
+
+    __repr__ = __str__
+
+class CompileError(Exception):
+    def __init__(self, diagnostics):
+        super(CompileError, self).__init__()
+        self.diagnostics = diagnostics
+
+    def print_aa(self):
+        for diagnostic in self.diagnostics:
+            diagnostic.print_aa()
+            print()
+
+    def __str__(self):
+        messages = "; ".join(diagnostic.message for diagnostic in self.diagnostics)
+        return f"{len(self.diagnostics)} error(s): {messages}"
+
+    __repr__ = __str__
+
+class Diagnostics:
+    def __init__(self):
+        self.errors = []
+
+    def error(self, message, span):
+        self.errors.append(Diagnostic(message, span))
+
+    def has_errors(self):
+        return len(self.errors) > 0
+
+    def raise_if_errors(self):
+        if self.has_errors():
+            # Stages report as they go, so sort to report in source order
+            errors = sorted(self.errors, key=lambda error: -1 if error.span is None else error.span.start)
+            raise CompileError(errors)
+
+    def __str__(self):
+        return f"Diagnostics(errors={self.errors})"
+
+    __repr__ = __str__
@@ -0,0 +1,401 @@
+from decimal import Decimal
+import math
+import mmap
+import struct
+
+from instructions import INSTRUCTIONS_BY_OPCODE, REG, IMM64, F64, STR
+from compact import MAGIC, VERSION, decode_varint
+from debugmap import section_start
+
+# Turns .act files back into assembly. The file is mapped rather than read, and programs are
+# decoded one instruction at a time as the output is consumed, so only the parts of a file that
+# are looked at are ever paged in.
+
+U64 = struct.Struct("<Q")
+F64_VALUE = struct.Struct("<d")
+RANGE = struct.Struct("<QQ")
+
+# Operands holding the offset of a length-prefixed string, shown with the string they point at
+STRING_REFS = {"add_handler": 2}
+
+class DisassemblyError(Exception):
+    def __init__(self, message, offset=None):
+        super(DisassemblyError, self).__init__(message)
+        self.message = message
+        self.offset = offset
+
+    def __str__(self):
+        if self.offset is None:
+            return self.message
+        return f"{self.message} at 0x{self.offset:x}"
+
+def escape_string(text):
+    return text.replace("\\", "\\\\").replace("'", "\\'").replace("\n", "\\n").replace("\t", "\\t")
+
+def has_float_literal(value):
+    # The assembler only reads floats like 1.5, with no sign or exponent
+    return math.isfinite(value) and math.copysign(1.0, value) > 0
+
+def format_float(value):
+    # The shortest digits that read back as the same float, written out without an exponent
+    if not has_float_literal(value):
+        return repr(value)
+
+    text = format(Decimal(repr(value)), "f")
+    if "." not in text:
+        text += ".0"
+    return text
+
+def format_operand(kind, value):
+    if kind is REG:
+        return f"r{value}"
+    if kind is F64:
+        return format_float(value)
+    if kind is STR:
+        return f"'{escape_string(value)}'"
+    return str(value)
+
+class DecodedInstruction:
+    def __init__(self, offset, end, pattern, operands, variadic, string_ref=None):
+        self.offset = offset
+        self.end = end
+        self.pattern = pattern
+        self.operands = operands
+        self.variadic = variadic
+        self.string_ref = string_ref
+
+    def format(self):
+        parts = [self.pattern.mnemonic]
+        for kind, value in zip(self.pattern.operands, self.operands):
+            parts.append(format_operand(kind, value))
+        for reg in self.variadic:
+            parts.append(format_operand(REG, reg))
+
+        text = " ".join(parts)
+        if self.string_ref is not None:
+            text += f" ; '{escape_string(self.string_ref)}'"
+        for kind, value in zip(self.pattern.operands, self.operands):
+            if kind is F64 and not has_float_literal(value):
+                text += " ; assembly has no literal for this float"
+        return text
+
+    def __str__(self):
+        return f"DecodedInstruction(offset=0x{self.offset:x}, {self.format()})"
+
+    __repr__ = __str__
+
+class InvalidInstruction:
+    def __init__(self, offset, reason):
+        self.offset = offset
+        self.end = offset
+        self.reason = reason
+
+    def format(self):
+        return f"; {self.reason}, rest of program not decoded"
+
+    __repr__ = __str__ = format
+
+class ActFile:
+    # An .act file mapped into memory: [n_programs:8], then n_programs pairs of [start:8] [end:8].
+    # Compact v2 files have a string pool and varints instead, and their program table is read
+    # when the file is opened
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            try:
+                self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise DisassemblyError("Empty file")
+        self.view = memoryview(self.mmap)
+        # A debug line table appended with --debug-section isn't part of the code
+        self.view = self.view[:section_start(self.view)]
+
+        self.strings = None
+        self.table = None
+        try:
+            if bytes(self.view[:len(MAGIC)]) == MAGIC:
+                self.read_compact_header()
+            else:
+                self.read_header()
+        except DisassemblyError:
+            self.close()
+            raise
+
+    def read_header(self):
+        if len(self.view) < U64.size:
+            raise DisassemblyError("File too short for a program table")
+        (self.n_programs,) = U64.unpack_from(self.view, 0)
+        self.table_start = 0
+        self.table_end = U64.size + RANGE.size * self.n_programs
+        if self.table_end > len(self.view):
+            raise DisassemblyError(f"Program table of {self.n_programs} programs doesn't fit in the file")
+
+    def read_compact_header(self):
+        pos = len(MAGIC)
+        if pos >= len(self.view) or self.view[pos] != VERSION:
+            raise DisassemblyError("Unsupported format version", pos)
+        pos += 1
+
+        n_strings, pos = self.read_varint(pos, len(self.view))
+        self.strings = []
+        for _ in range(n_strings):
+            length, pos = self.read_varint(pos, len(self.view))
+            if pos + length > len(self.view):
+                raise DisassemblyError("String runs past the end", pos)
+            self.strings.append(self.decode_utf8(pos, pos + length))
+            pos += length
+
+        self.table_start = pos
+        self.n_programs, pos = self.read_varint(pos, len(self.view))
+        self.table = []
+        for _ in range(self.n_programs):
+            start_offset = pos
+            start, pos = self.read_varint(pos, len(self.view))
+            end_offset = pos
+            end, pos = self.read_varint(pos, len(self.view))
+            # Where the start and the end are in the table, then their values
+            self.table.append((start_offset, end_offset, start, end))
+        self.table_end = pos
+
+    def is_compact(self):
+        return self.strings is not None
+
+    def close(self):
+        self.view.release()
+        self.mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.view)
+
+    def program_range(self, idx):
+        if not 0 <= idx < self.n_programs:
+            raise IndexError(f"Program {idx} out of range, the file has {self.n_programs}")
+        if self.table is not None:
+            return self.table[idx][2:]
+        return RANGE.unpack_from(self.view, U64.size + RANGE.size * idx)
+
+    def read_u64(self, pos, end):
+        if pos + U64.size > end:
+            raise DisassemblyError("Unexpected end of program", pos)
+        return U64.unpack_from(self.view, pos)[0], pos + U64.size
+
+    def read_varint(self, pos, end):
+        decoded = decode_varint(self.view, pos, end)
+        if decoded is None:
+            raise DisassemblyError("Bad varint", pos)
+        return decoded
+
+    def read_int(self, pos, end):
+        if self.is_compact():
+            return self.read_varint(pos, end)
+        return self.read_u64(pos, end)
+
+    def decode_utf8(self, start, end):
+        try:
+            return str(self.view[start:end], "utf-8")
+        except UnicodeDecodeError:
+            raise DisassemblyError("String isn't valid UTF-8", start)
+
+    def read_string(self, pos, end):
+        if self.is_compact():
+            idx, pos = self.read_varint(pos, end)
+            if idx >= len(self.strings):
+                raise DisassemblyError(f"No string {idx} in the pool", pos)
+            return self.strings[idx], pos
+
+        length, pos = self.read_u64(pos, end)
+        if pos + length > end:
+            raise DisassemblyError("String runs past the end", pos)
+        return self.decode_utf8(pos, pos + length), pos + length
+
+    def read_operand(self, kind, pos, end):
+        if kind is REG:
+            if pos >= end:
+                raise DisassemblyError("Unexpected end of program", pos)
+            return self.view[pos], pos + 1
+        if kind is IMM64:
+            return self.read_int(pos, end)
+        if kind is F64:
+            if pos + F64_VALUE.size > end:
+                raise DisassemblyError("Unexpected end of program", pos)
+            return F64_VALUE.unpack_from(self.view, pos)[0], pos + F64_VALUE.size
+        return self.read_string(pos, end)
+
+    def decode_instruction(self, pos, end):
+        opcode = self.view[pos]
+        pattern = INSTRUCTIONS_BY_OPCODE.get(opcode)
+        if pattern is None:
+            raise DisassemblyError(f"No instruction with opcode 0x{opcode:02x}", pos)
+
+        start = pos
+        pos += 1
+        operands = []
+        for kind in pattern.operands:
+            value, pos = self.read_operand(kind, pos, end)
+            operands.append(value)
+
+        variadic = []
+        if pattern.variadic is not None:
+            count = operands[pattern.variadic.count_idx] * pattern.variadic.group_size
+            if pos + count > end:
+                raise DisassemblyError("Register arguments run past the end", pos)
+            variadic = list(self.view[pos:pos + count])
+            pos += count
+
+        string_ref = None
+        ref_idx = STRING_REFS.get(pattern.mnemonic)
+        if ref_idx is not None:
+            try:
+                string_ref, _ = self.read_string(operands[ref_idx], len(self.view))
+            except DisassemblyError:
+                pass
+
+        return DecodedInstruction(start, pos, pattern, operands, variadic, string_ref)
+
+    def program(self, idx):
+        # Decodes one program lazily, without touching the rest of the file. A malformed
+        # instruction ends the program with an InvalidInstruction, like the VM stops there
+        start, end = self.program_range(idx)
+        end = min(end, len(self.view))
+
+        pos = start
+        while pos < end:
+            try:
+                inst = self.decode_instruction(pos, end)
+            except DisassemblyError as e:
+                yield InvalidInstruction(pos, str(e))
+                return
+            yield inst
+            pos = inst.end
+
+    def regions(self):
+        # The programs and the bytes between them in file order, as (start, end, program index or
+        # None). Only the program table is read to work this out
+        programs = sorted((*self.program_range(idx), idx) for idx in range(self.n_programs))
+
+        pos = self.table_end
+        for start, end, idx in programs:
+            if start > pos:
+                yield pos, start, None
+            yield start, end, idx
+            pos = max(pos, end)
+
+        if pos < len(self.view):
+            yield pos, len(self.view), None
+
+    def data(self, start, end):
+        # Bytes outside of every program, shown as ds strings where they look like one and dw
+        # otherwise
+        if self.is_compact():
+            yield from self.compact_data(start, end)
+            return
+
+        pos = start
+        while pos < end:
+            try:
+                text, next_pos = self.read_string(pos, end)
+                if next_pos > pos + U64.size:
+                    yield pos, f"ds '{escape_string(text)}'"
+                    pos = next_pos
+                    continue
+            except DisassemblyError:
+                pass
+
+            if pos + U64.size <= end:
+                value, pos_after = self.read_u64(pos, end)
+                yield pos, f"dw {value}"
+                pos = pos_after
+            else:
+                yield pos, f"; {end - pos} trailing bytes: {bytes(self.view[pos:end]).hex()}"
+                pos = end
+
+    def compact_data(self, start, end):
+        # A varint could be either, so every one is shown as a dw, with the pool string it would
+        # refer to as a ds
+        pos = start
+        while pos < end:
+            try:
+                value, next_pos = self.read_varint(pos, end)
+            except DisassemblyError:
+                yield pos, f"; {end - pos} trailing bytes: {bytes(self.view[pos:end]).hex()}"
+                return
+
+            if value < len(self.strings):
+                yield pos, f"dw {value} ; or ds '{escape_string(self.strings[value])}'"
+            else:
+                yield pos, f"dw {value}"
+            pos = next_pos
+
+    def program_lines(self, idx, offsets=False):
+        start, end = self.program_range(idx)
+        yield f"; program {idx} (0x{start:x}-0x{end:x})"
+        for inst in self.program(idx):
+            yield format_line(inst.offset, "    " + inst.format(), offsets)
+
+    def lines(self, offsets=False):
+        if self.is_compact():
+            yield format_line(0, f"; compact v{VERSION} format with {len(self.strings)} pooled strings", offsets)
+            for idx, text in enumerate(self.strings):
+                yield format_line(0, f";   {idx}: '{escape_string(text)}'", offsets)
+            yield ""
+
+        yield format_line(self.table_start, f"dw {self.n_programs} ; number of programs", offsets)
+        for idx in range(self.n_programs):
+            start, end = self.program_range(idx)
+            if self.table is None:
+                start_offset = U64.size + RANGE.size * idx
+                end_offset = start_offset + U64.size
+            else:
+                start_offset, end_offset = self.table[idx][:2]
+            yield format_line(start_offset, f"dw {start} ; program {idx} start", offsets)
+            yield format_line(end_offset, f"dw {end} ; program {idx} end", offsets)
+
+        for start, end, idx in self.regions():
+            yield ""
+            if idx is None:
+                for offset, line in self.data(start, end):
+                    yield format_line(offset, line, offsets)
+            else:
+                yield from self.program_lines(idx, offsets)
+
+def format_line(offset, line, offsets):
+    if offsets:
+        return f"{offset:08x}  {line}"
+    return line
+
+if __name__ == "__main__":
+    import argparse
+    import os
+    import sys
+
+    arg_parser = argparse.ArgumentParser(description="Disassemble an .act file")
+    arg_parser.add_argument("input_path", help="Path to an .act file")
+    arg_parser.add_argument("-p", "--program", type=int, action="append", help="Only disassemble the program with this index")
+    arg_parser.add_argument("--offsets", action="store_true", help="Prefix every line with its offset in the file")
+    args = arg_parser.parse_args()
+
+    try:
+        act = ActFile(args.input_path)
+    except DisassemblyError as e:
+        print(f"Can't disassemble {args.input_path}: {e}")
+        sys.exit(1)
+
+    with act:
+        try:
+            if args.program is None:
+                lines = act.lines(args.offsets)
+            else:
+                lines = (line for idx in args.program for line in act.program_lines(idx, args.offsets))
+            for line in lines:
+                print(line)
+        except IndexError as e:
+            print(e)
+            sys.exit(1)
+        except BrokenPipeError:
+            # Output piped into something like head that stopped reading
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
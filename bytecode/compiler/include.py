@@ -0,0 +1,275 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import re
+
+from cache import CompileCache, update_with_sources
+from diagnostics import Diagnostics
+from macro import Label, Eq, Declare, Inc, Export, Include
+from span import Source, Span
+import tokenizer
+from tokenizer import ParseInput, parse_all, unescape_string
+import values
+
+# @include('path') splices another .dig file into the one being assembled. Paths are relative to
+# the file with the @include, and for the file being assembled, to its directory.
+#
+# Included files are lexed and parsed up to upgrade_values on their own, with the @include's in
+# them left as they are. That stream is kept by path and content hash in memory and, with a
+# ParseCache, on disk, so a fragment included by hundreds of files is only lexed when it changes.
+# The @include's are expanded when the stream is spliced in, so a changed file never leaves a
+# stale copy inside the streams of the files including it.
+
+MAX_MEMOIZED_FILES = 1024
+
+# Modules defining what a parsed stream is made of and how it is stored. Streams stored before a
+# change to any of them are never read back
+PARSE_MODULES = ["compiler.py", "span.py", "tokenizer.py", "macro.py", "values.py", "instructions.py", "include.py"]
+
+def parse_fingerprint():
+    hasher = hashlib.sha256(b"parse\n")
+    update_with_sources(hasher, PARSE_MODULES)
+    return hasher.hexdigest()
+
+PARSE_FINGERPRINT = parse_fingerprint()
+
+# Finds what a source includes without lexing it, to key the compile cache. Anything it finds in
+# a comment only makes the key more specific
+RE_INCLUDE = re.compile(r"@include\(\s*'((?:[^'\\]|\\[nt\\'])*)'")
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+# A parsed stream is stored as a JSON list with one [kind, start, end, fields...] per element,
+# where start and end are its span in the included file. Kinds are the classes a stream can hold
+# after upgrade_values, with the types of their fields. Anything else in a stream, or in a stored
+# entry, means it isn't stored or read back. Unlike pickle, reading an entry can't run anything,
+# so a cache directory shared with others is safe to use
+STREAM_KINDS = {
+    "inst": (lambda span, inst: tokenizer.AssemblyInstructionToken(span, inst), (str,)),
+    "string": (lambda span, value: values.String(tokenizer.StringToken(span, value)), (str,)),
+    "int": (lambda span, value: values.Integer(tokenizer.IntegerToken(span, value)), (int,)),
+    "float": (lambda span, value: values.Float(tokenizer.FloatToken(span, value)), (float,)),
+    "reg": (lambda span, reg_idx: values.Register(tokenizer.RegisterToken(span, reg_idx)), (int,)),
+    "vreg": (lambda span, name: values.VirtualRegister(tokenizer.VirtualRegisterToken(span, name)), (str,)),
+    "label": (Label, (str,)),
+    "eq": (Eq, (str,)),
+    "declare": (Declare, (str, int)),
+    "inc": (Inc, (str, str)),
+    "export": (Export, (str,)),
+    "include": (Include, (str,)),
+}
+
+def stream_fields(element):
+    # (kind, span, fields) of an element, or None if it has no kind
+    if type(element) is tokenizer.AssemblyInstructionToken:
+        return "inst", element.span, [element.inst]
+    if type(element) is values.String:
+        return "string", element.inner.span, [element.inner.value]
+    if type(element) is values.Integer:
+        return "int", element.inner.span, [element.inner.value]
+    if type(element) is values.Float:
+        return "float", element.inner.span, [element.inner.value]
+    if type(element) is values.Register:
+        return "reg", element.inner.span, [element.inner.reg_idx]
+    if type(element) is values.VirtualRegister:
+        return "vreg", element.inner.span, [element.inner.name]
+    if type(element) is Label:
+        return "label", element.span, [element.name]
+    if type(element) is Eq:
+        return "eq", element.span, [element.name]
+    if type(element) is Declare:
+        return "declare", element.span, [element.name, element.value]
+    if type(element) is Inc:
+        return "inc", element.span, [element.category, element.variable]
+    if type(element) is Export:
+        return "export", element.span, [element.name]
+    if type(element) is Include:
+        return "include", element.span, [element.path]
+    return None
+
+def encode_stream(elements):
+    # Returns None if the stream holds something that can't be stored
+    encoded = []
+    for element in elements:
+        fields = stream_fields(element)
+        if fields is None:
+            return None
+        kind, span, args = fields
+        encoded.append([kind, span.start, span.end] + args)
+
+    return json.dumps(encoded, separators=(",", ":")).encode("utf-8")
+
+def decode_stream(data, source):
+    # Raises ValueError if data isn't a stream stored by encode_stream for this source
+    try:
+        encoded = json.loads(data)
+    except RecursionError:
+        raise ValueError("Nested too deeply")
+    if type(encoded) is not list:
+        raise ValueError("A stream is a list")
+
+    elements = []
+    for item in encoded:
+        if type(item) is not list or len(item) < 3 or item[0] not in STREAM_KINDS:
+            raise ValueError(f"Not a stream element: {item!r}")
+        make, field_types = STREAM_KINDS[item[0]]
+        start, end, args = item[1], item[2], item[3:]
+        if type(start) is not int or type(end) is not int or not 0 <= start <= end <= len(source.text):
+            raise ValueError(f"Span outside the file: {item!r}")
+        if len(args) != len(field_types) or any(type(arg) is not field_type for arg, field_type in zip(args, field_types)):
+            raise ValueError(f"Wrong fields for {item[0]}: {item!r}")
+        if any(type(arg) is int and not 0 <= arg < tokenizer.INTEGER_LIMIT for arg in args) or (item[0] == "reg" and args[0] >= 256):
+            raise ValueError(f"Value out of range: {item!r}")
+        elements.append(make(Span(start, end, source), *args))
+
+    return elements
+
+class ParseCache(CompileCache):
+    # Parsed streams of included files, stored with encode_stream
+    SUFFIX = ".parsed"
+
+    def key(self, path, digest):
+        hasher = hashlib.sha256(PARSE_FINGERPRINT.encode("utf-8"))
+        hasher.update(f"parsed {path} {digest}\n".encode("utf-8"))
+        return hasher.hexdigest()
+
+class IncludeStats:
+    def __init__(self):
+        self.includes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.parsed = 0
+
+    def counts(self):
+        return {
+            "includes": self.includes,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "files_parsed": self.parsed,
+        }
+
+    def __str__(self):
+        return f"IncludeStats(includes={self.includes}, memory_hits={self.memory_hits}, disk_hits={self.disk_hits}, parsed={self.parsed})"
+
+    __repr__ = __str__
+
+class Includes:
+    # Can be shared by any number of compiles, like the files of a batch or a daemon
+    def __init__(self, cache=None, max_files=MAX_MEMOIZED_FILES):
+        self.cache = cache
+        self.max_files = max_files
+        self.stats = IncludeStats()
+
+        # (path, content hash) to the parsed stream, least recently used first
+        self.memoized = OrderedDict()
+
+    def resolve(self, path, including_path):
+        base_dir = os.path.dirname(including_path) if including_path is not None else os.getcwd()
+        return os.path.normpath(os.path.join(base_dir, path))
+
+    def read(self, path):
+        with open(path, "r") as inp_f:
+            return inp_f.read()
+
+    def parse(self, path, text, diagnostics):
+        # Returns the stream of the file, or None after reporting its errors. compiler imports
+        # this module, so its stages are only imported once both are loaded
+        from compiler import preproc_tokens, group_macros, upgrade_values
+
+        file_diagnostics = Diagnostics()
+        tokens = preproc_tokens(parse_all(ParseInput(Source(text, path)), diagnostics=file_diagnostics))
+        elements = list(upgrade_values(group_macros(tokens, file_diagnostics)))
+        if file_diagnostics.has_errors():
+            diagnostics.errors.extend(file_diagnostics.errors)
+            return None
+        return elements
+
+    def load(self, path, text, diagnostics):
+        key = (path, content_hash(text))
+        elements = self.memoized.get(key)
+        if elements is not None:
+            self.memoized.move_to_end(key)
+            self.stats.memory_hits += 1
+            return elements
+
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.key(*key)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                try:
+                    elements = decode_stream(cached, Source(text, path))
+                    self.stats.disk_hits += 1
+                except ValueError:
+                    # Written by an older assembler, cut short or not written by the assembler
+                    elements = None
+
+        if elements is None:
+            elements = self.parse(path, text, diagnostics)
+            if elements is None:
+                return None
+            self.stats.parsed += 1
+            if cache_key is not None:
+                encoded = encode_stream(elements)
+                if encoded is not None:
+                    self.cache.put(cache_key, encoded)
+
+        self.memoized[key] = elements
+        while len(self.memoized) > self.max_files:
+            self.memoized.popitem(last=False)
+        return elements
+
+    def expand(self, element_list, diagnostics, inp_path=None, chain=()):
+        # chain is the path of every file being included, outermost first
+        including_path = chain[-1] if len(chain) > 0 else inp_path
+        for element in element_list:
+            if not isinstance(element, Include):
+                yield element
+                continue
+
+            self.stats.includes += 1
+            path = self.resolve(element.path, including_path)
+            if path in chain or path == inp_path:
+                files = ([inp_path] if inp_path is not None else ["<input>"]) + list(chain) + [path]
+                diagnostics.error(f"Include cycle: {' -> '.join(files)}", element.span)
+                continue
+
+            try:
+                text = self.read(path)
+            except OSError as e:
+                diagnostics.error(f"Can't include {element.path}: {e.strerror}", element.span)
+                continue
+
+            elements = self.load(path, text, diagnostics)
+            if elements is not None:
+                yield from self.expand(elements, diagnostics, inp_path, chain + (path,))
+
+    def dependencies(self, inp_text, inp_path=None):
+        # (path, content hash) of every file the source includes, directly or not, found without
+        # lexing anything. Files that can't be read are left out, as they fail the compile anyway
+        found = {}
+
+        def scan(text, including_path):
+            for match in RE_INCLUDE.finditer(text):
+                path = self.resolve(unescape_string(match.group(1)), including_path)
+                if path in found:
+                    continue
+                try:
+                    included = self.read(path)
+                except OSError:
+                    continue
+                found[path] = content_hash(included)
+                scan(included, path)
+
+        scan(inp_text, inp_path)
+        return sorted(found.items())
+
+def uses_include(inp_text):
+    return "@include(" in inp_text
+
+def expand_includes(element_list, diagnostics, includes=None, inp_path=None):
+    if includes is None:
+        includes = Includes()
+    return includes.expand(element_list, diagnostics, inp_path)
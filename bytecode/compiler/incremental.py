@@ -0,0 +1,300 @@
+import re
+
+from compiler import compile_script, pinned_labels, preproc_tokens, group_macros, upgrade_values, pseudo_expand_macros, parse_instructions, postproc_macro
+from compact import CompactOutput, encode_varint
+from diagnostics import Diagnostics
+from include import uses_include
+from liveness import ControlFlow
+from optimizer import optimize_instructions
+from regalloc import allocate_registers, has_virtual
+from tokenizer import ParseInput, parse_all
+import values
+
+# Re-assembles a file after an edit, redoing only the parts of it that changed. The source is cut
+# into chunks at every line starting with @label(, so a program from its start label to its end
+# label is one or more chunks. Every chunk is lexed and parsed on its own, and what it writes to
+# the output is recorded by a ChunkOutput. A build looks every chunk up by its text, and only
+# chunks that weren't in the previous build are lexed and emitted again. The recordings are then
+# replayed into one output, which puts every chunk at its new offset, and the @= relocations are
+# resolved as in a full build.
+#
+# The output is the same as compile_script's. Errors are always reported by a full build, as the
+# spans of a chunk point into the chunk rather than the file. Files with @include's are always
+# fully built too, as a chunk depends on the files it includes, but those are memoized by the
+# Includes given.
+
+CHUNK_START = re.compile(r"^[ \t]*@label\(", re.MULTILINE)
+
+def split_chunks(text):
+    starts = [m.start() for m in CHUNK_START.finditer(text)]
+    if len(starts) == 0 or starts[0] != 0:
+        starts.insert(0, 0)
+    ends = starts[1:] + [len(text)]
+    return [text[start:end] for start, end in zip(starts, ends)]
+
+class ParsedChunk:
+    def __init__(self, text):
+        self.text = text
+        self.diagnostics = Diagnostics()
+
+        tokens = preproc_tokens(parse_all(ParseInput(text), diagnostics=self.diagnostics))
+        parsed = upgrade_values(group_macros(tokens, self.diagnostics))
+        expanded, self.macros = pseudo_expand_macros(parsed)
+        self.instructions = list(parse_instructions(expanded, self.diagnostics))
+
+        self.has_virtual = any(has_virtual(inst) for inst in self.instructions)
+        self.live_ins = {}
+
+    def live_in(self, live_out):
+        # Registers live before the chunk, given those live after it
+        live_in = self.live_ins.get(live_out)
+        if live_in is None:
+            live_in = self.live_ins[live_out] = frozenset(ControlFlow(self.instructions, live_out).live_in())
+        return live_in
+
+class ChunkOutput(values.CompileOutput):
+    # Records what a chunk writes so that it can be replayed at any offset of another output. Runs
+    # of bytes are kept as they are, and everything depending on the rest of the file (labels,
+    # variables, relocations, pooled strings and data that might be shared) is kept as the call
+    # that wrote it
+    def __init__(self, share_data=False, compact=False):
+        super(ChunkOutput, self).__init__(share_data)
+        self.compact = compact
+
+        self.ops = []
+        self.run_start = 0
+
+    def end_run(self):
+        if len(self.output) > self.run_start:
+            self.ops.append(("bytes", bytes(self.output[self.run_start:])))
+            self.run_start = len(self.output)
+
+    def record(self, *op):
+        self.end_run()
+        self.ops.append(op)
+
+    def write_integer(self, value):
+        if self.compact:
+            self.write_bytes(encode_varint(value))
+        else:
+            super(ChunkOutput, self).write_integer(value)
+
+    def write_string(self, text):
+        self.record("string", text)
+
+    def write_data(self, value):
+        if self.share_data:
+            self.record("data", value)
+        else:
+            super(ChunkOutput, self).write_data(value)
+
+    def add_relocation(self, fmt, symbol, span):
+        self.record("relocation", fmt, symbol, span)
+
+    def define_label(self, name):
+        self.record("label", name)
+
+    def declare(self, name, value):
+        self.record("declare", name, value)
+
+    def inc(self, category, name, span=None):
+        self.record("inc", category, name, span)
+
+    def export(self, name):
+        self.record("export", name)
+
+    def replay(self, output):
+        # With shared data, dw and ds are replayed as calls, so runs are only code
+        write_run = output.write_opcode if output.share_data else output.write_bytes
+        for op in self.ops:
+            kind = op[0]
+            if kind == "bytes":
+                write_run(op[1])
+            elif kind == "string":
+                output.write_string(op[1])
+            elif kind == "data":
+                output.write_data(op[1])
+            elif kind == "relocation":
+                output.add_relocation(op[1], op[2], op[3])
+            elif kind == "label":
+                output.define_label(op[1])
+            elif kind == "declare":
+                output.declare(op[1], op[2])
+            elif kind == "export":
+                output.export(op[1])
+            else:
+                output.inc(op[1], op[2], op[3])
+
+class IncrementalStats:
+    def __init__(self):
+        self.builds = 0
+        self.full_builds = 0
+        self.chunks = 0
+        self.chunks_parsed = 0
+        self.chunks_emitted = 0
+
+    def counts(self):
+        return {
+            "builds": self.builds,
+            "full_builds": self.full_builds,
+            "chunks": self.chunks,
+            "chunks_parsed": self.chunks_parsed,
+            "chunks_emitted": self.chunks_emitted,
+        }
+
+    def __str__(self):
+        return f"IncrementalStats(builds={self.builds}, full_builds={self.full_builds}, chunks={self.chunks}, chunks_parsed={self.chunks_parsed}, chunks_emitted={self.chunks_emitted})"
+
+    __repr__ = __str__
+
+class IncrementalAssembler:
+    # Assembles successive versions of one file with the same options. Only the chunks of the
+    # latest build are remembered
+    def __init__(self, optimize=False, compact=False, inp_path=None, includes=None):
+        self.optimize = optimize
+        self.compact = compact
+        self.inp_path = inp_path
+        self.includes = includes
+        self.stats = IncrementalStats()
+
+        # Chunk text to ParsedChunk
+        self.parsed = {}
+        # (chunk text, registers live after it) to ChunkOutput
+        self.emitted = {}
+
+    def full_build(self, inp_text):
+        self.stats.full_builds += 1
+        return compile_script(inp_text, optimize=self.optimize, compact=self.compact, inp_path=self.inp_path, includes=self.includes)
+
+    def parse(self, texts):
+        parsed = {}
+        chunks = []
+        for text in texts:
+            chunk = parsed.get(text)
+            if chunk is None:
+                chunk = self.parsed.get(text)
+                if chunk is None:
+                    chunk = ParsedChunk(text)
+                    self.stats.chunks_parsed += 1
+                parsed[text] = chunk
+            chunks.append(chunk)
+
+        self.parsed = parsed
+        return chunks
+
+    def live_outs(self, chunks):
+        # Registers live after every chunk, needed where the register allocator runs. Liveness
+        # flows backward, so it is worked out from the end up to the first chunk that needs it
+        live_outs = [None] * len(chunks)
+        first = next((idx for idx, chunk in enumerate(chunks) if chunk.has_virtual), None)
+        if first is None:
+            return live_outs
+
+        live = frozenset()
+        for idx in range(len(chunks) - 1, first - 1, -1):
+            live_outs[idx] = live
+            live = chunks[idx].live_in(live)
+        return live_outs
+
+    def emit(self, chunk, live_out):
+        # Returns None if the chunk doesn't assemble, so that errors are never cached
+        instructions = chunk.instructions
+        if chunk.has_virtual:
+            diagnostics = Diagnostics()
+            instructions = allocate_registers(instructions, diagnostics, live_out=live_out)
+            if diagnostics.has_errors():
+                return None
+        if self.optimize:
+            instructions = optimize_instructions(instructions)
+
+        output = ChunkOutput(self.optimize, self.compact)
+        for inst in instructions:
+            inst.compile_to_bytecode(output)
+        output.end_run()
+        output.output = None
+
+        self.stats.chunks_emitted += 1
+        return output
+
+    def build(self, inp_text):
+        self.stats.builds += 1
+        if uses_include(inp_text):
+            return self.full_build(inp_text)
+
+        chunks = self.parse(split_chunks(inp_text))
+        self.stats.chunks = len(chunks)
+        if any(chunk.diagnostics.has_errors() for chunk in chunks):
+            return self.full_build(inp_text)
+
+        output = CompactOutput(self.optimize) if self.compact else values.CompileOutput(self.optimize)
+        if self.optimize:
+            output.pinned = pinned_labels(inst for chunk in chunks for inst in chunk.instructions)
+        emitted = {}
+        macros = []
+        for chunk, live_out in zip(chunks, self.live_outs(chunks)):
+            key = (chunk.text, live_out if chunk.has_virtual else None)
+            recorded = emitted.get(key)
+            if recorded is None:
+                recorded = self.emitted.get(key)
+                if recorded is None:
+                    recorded = self.emit(chunk, live_out)
+                    if recorded is None:
+                        return self.full_build(inp_text)
+                emitted[key] = recorded
+
+            recorded.replay(output)
+            macros.extend(chunk.macros)
+        output.end_data_run()
+        self.emitted = emitted
+
+        diagnostics = Diagnostics()
+        output.resolve_relocations(diagnostics)
+        postproc_macro(output, macros)
+        if diagnostics.has_errors():
+            return self.full_build(inp_text)
+
+        return output.getvalue()
+
+if __name__ == "__main__":
+    import argparse
+    import random
+    import time
+
+    arg_parser = argparse.ArgumentParser(description="Check and time incremental builds of a file against full builds, editing one program at a time")
+    arg_parser.add_argument("input_path")
+    arg_parser.add_argument("--edits", type=int, default=20, help="Number of edits to make")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("-O", "--optimize", action="store_true")
+    arg_parser.add_argument("--compact", action="store_true")
+    args = arg_parser.parse_args()
+
+    with open(args.input_path, "r") as inp_f:
+        inp_text = inp_f.read()
+
+    rng = random.Random(args.seed)
+    assembler = IncrementalAssembler(args.optimize, args.compact)
+    assembler.build(inp_text)
+
+    incremental_time = 0.0
+    full_time = 0.0
+    mismatches = 0
+    for _ in range(args.edits):
+        # Adds an instruction after a random label, which moves everything after it
+        labels = [m.end() for m in CHUNK_START.finditer(inp_text)]
+        pos = inp_text.index("\n", rng.choice(labels)) + 1 if len(labels) > 0 else 0
+        inp_text = inp_text[:pos] + f"    set_integer r{rng.randrange(256)} {rng.randrange(1 << 20)}\n" + inp_text[pos:]
+
+        start = time.perf_counter()
+        incremental = bytes(assembler.build(inp_text))
+        incremental_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        full = bytes(compile_script(inp_text, optimize=args.optimize, compact=args.compact))
+        full_time += time.perf_counter() - start
+
+        if incremental != full:
+            mismatches += 1
+
+    print(assembler.stats)
+    print(f"{args.edits} edits, {mismatches} mismatches against full builds")
+    print(f"incremental {incremental_time / args.edits * 1000:.2f} ms, full {full_time / args.edits * 1000:.2f} ms per build")
@@ -2,141 +2,151 @@ from values import Register, String, Integer, Float
 
 DISPLAY_ALL = None
 
+ORDINALS = ["one", "two", "three", "four"]
+
+def ordinal(idx):
+    if idx < len(ORDINALS):
+        return ORDINALS[idx]
+    return str(idx + 1)
+
+class OperandKind:
+    def __init__(self, name, value_class):
+        self.name = name
+        self.value_class = value_class
+
+    def __str__(self):
+        return f"OperandKind(name={repr(self.name)})"
+
+    __repr__ = __str__
+
+REG = OperandKind("register", Register)
+IMM64 = OperandKind("int", Integer)
+F64 = OperandKind("float", Float)
+STR = OperandKind("string", String)
+
+class Variadic:
+    # A tail of registers after the fixed operands. The operand at count_idx gives the number of
+    # groups, each group_size registers long.
+    def __init__(self, count_idx, group_size):
+        self.count_idx = count_idx
+        self.group_size = group_size
+
 class InstructionPattern:
-    def __init__(self, mnemonic, bytecode):
+    def __init__(self, mnemonic, bytecode, operands, variadic=None):
         self.mnemonic = mnemonic
         self.bytecode = bytecode
-        self.argument_verifiers = []
+        self.operands = operands
+        self.variadic = variadic
+
+        n_operands = len(operands)
+        if variadic is not None:
+            self.arity_error = f"needs at least {n_operands} arguments"
+        elif n_operands == 1:
+            self.arity_error = "needs one argument"
+        else:
+            self.arity_error = f"needs {ordinal(n_operands - 1)} arguments"
+
+        self.type_errors = [
+            f"argument {ordinal(idx)} has to be {kind.name}"
+            for idx, kind in enumerate(operands)
+        ]
+        self.operand_classes = [kind.value_class for kind in operands]
+
+    def check(self, arguments):
+        # Returns None if the arguments match, otherwise (error message, argument to display)
+        n_operands = len(self.operands)
+        if self.variadic is None:
+            if len(arguments) != n_operands:
+                return self.arity_error, DISPLAY_ALL
+        elif len(arguments) < n_operands:
+            return self.arity_error, DISPLAY_ALL
 
-    def verify(self, message, display, fn):
-        new = InstructionPattern(self.mnemonic, self.bytecode)
-        new.argument_verifiers = self.argument_verifiers[:]
-        new.argument_verifiers.append((message, display, fn))
-        return new
+        for idx, value_class in enumerate(self.operand_classes):
+            if not isinstance(arguments[idx], value_class):
+                return self.type_errors[idx], idx
+
+        if self.variadic is not None:
+            count_idx = self.variadic.count_idx
+            expected = n_operands + arguments[count_idx].inner.value * self.variadic.group_size
+            if len(arguments) != expected:
+                return "needs this many register-arguments", count_idx
+
+            for idx in range(n_operands, len(arguments)):
+                if not isinstance(arguments[idx], Register):
+                    return f"argument {ordinal(idx)} has to be register", idx
+
+        return None
 
 class Instruction:
-    def __init__(self, bytecode, arguments):
+    def __init__(self, bytecode, arguments, span=None):
         self.bytecode = bytecode
         self.arguments = arguments
+        # The mnemonic in the source, for the debug line table
+        self.span = span
 
     def __str__(self):
         return f"Instruction(bytecode={self.bytecode}, arguments={self.arguments})"
 
     def compile_to_bytecode(self, output):
-        output.write_bytes(self.bytecode)
+        if output.marks is not None:
+            output.mark(self.span)
+
+        if len(self.bytecode) == 0:
+            # dw and ds
+            output.write_data(self.arguments[0])
+            return
+
+        output.write_opcode(self.bytecode)
         for argument in self.arguments:
             argument.compile_to_bytecode(output)
 
     __repr__ = __str__
 
 INSTRUCTION_PATTERNS = \
-    [ InstructionPattern("dw", bytes([]))
-        .verify("needs one argument", DISPLAY_ALL, lambda args: len(args) == 1)
-        .verify("argument one has to be int", 0, lambda args: isinstance(args[0], Integer))
-    , InstructionPattern("ds", bytes([]))
-        .verify("needs one argument", DISPLAY_ALL, lambda args: len(args) == 1)
-        .verify("argument one has to be string", 0, lambda args: isinstance(args[0], String))
-    , InstructionPattern("set_self_addr", bytes([0x00]))
-        .verify("needs one argument", DISPLAY_ALL, lambda args: len(args) == 1)
-        .verify("argument one has to be register", 0, lambda args: isinstance(args[0], Register))
-    , InstructionPattern("set_float", bytes([0x01]))
-        .verify("needs two arguments", DISPLAY_ALL, lambda args: len(args) == 2)
-        .verify("argument one has to be register", 0, lambda args: isinstance(args[0], Register))
-        .verify("argument two has to be float", 1, lambda args: isinstance(args[1], Float))
-    , InstructionPattern("set_integer", bytes([0x02]))
-        .verify("needs two arguments", DISPLAY_ALL, lambda args: len(args) == 2)
-        .verify("argument one has to be register", 0, lambda args: isinstance(args[0], Register))
-        .verify("argument two has to be int", 1, lambda args: isinstance(args[1], Integer))
-    , InstructionPattern("set_string", bytes([0x03]))
-        .verify("needs two arguments", DISPLAY_ALL, lambda args: len(args) == 2)
-        .verify("argument one has to be register", 0, lambda args: isinstance(args[0], Register))
-        .verify("argument two has to be string", 1, lambda args: isinstance(args[1], String))
-    , InstructionPattern("copy", bytes([0x04]))
-        .verify("needs two arguments", DISPLAY_ALL, lambda args: len(args) == 2)
-        .verify("argument one has to be register", 0, lambda args: isinstance(args[0], Register))
-        .verify("argument two has to be register", 1, lambda args: isinstance(args[1], Register))
-    , InstructionPattern("generate_atom", bytes([0x05]))
-        .verify("needs one argument", DISPLAY_ALL, lambda args: len(args) == 1)
-        .verify("argument one has to be register", 0, lambda args: isinstance(args[0], Register))
-    , InstructionPattern("integer_to_atom", bytes([0x06]))
-        .verify("needs one argument", DISPLAY_ALL, lambda args: len(args) == 1)
-        .verify("argument one has to be register", 0, lambda args: isinstance(args[0], Register))
-
-    , InstructionPattern("add_int", bytes([0x10]))
-        .verify("needs two arguments", DISPLAY_ALL, lambda args: len(args) == 2)
-        .verify("argument one has to be register", 0, lambda args: isinstance(args[0], Register))
-        .verify("argument two has to be register", 1, lambda args: isinstance(args[1], Register))
-    , InstructionPattern("sub_int", bytes([0x11]))
-        .verify("needs two arguments", DISPLAY_ALL, lambda args: len(args) == 2)
-        .verify("argument one has to be register", 0, lambda args: isinstance(args[0], Register))
-        .verify("argument two has to be register", 1, lambda args: isinstance(args[1], Register))
-    , InstructionPattern("mul_int", bytes([0x12]))
-        .verify("needs two arguments", DISPLAY_ALL, lambda args: len(args) == 2)
-        .verify("argument one has to be register", 0, lambda args: isinstance(args[0], Register))
-        .verify("argument two has to be register", 1, lambda args: isinstance(args[1], Register))
-
-    , InstructionPattern("add_float", bytes([0x20]))
-        .verify("needs two arguments", DISPLAY_ALL, lambda args: len(args) == 2)
-        .verify("argument one has to be register", 0, lambda args: isinstance(args[0], Register))
-        .verify("argument two has to be register", 1, lambda args: isinstance(args[1], Register))
-    , InstructionPattern("sub_float", bytes([0x21]))
-        .verify("needs two arguments", DISPLAY_ALL, lambda args: len(args) == 2)
-        .verify("argument one has to be register", 0, lambda args: isinstance(args[0], Register))
-        .verify("argument two has to be register", 1, lambda args: isinstance(args[1], Register))
-    , InstructionPattern("mul_float", bytes([0x22]))
-        .verify("needs two arguments", DISPLAY_ALL, lambda args: len(args) == 2)
-        .verify("argument one has to be register", 0, lambda args: isinstance(args[0], Register))
-        .verify("argument two has to be register", 1, lambda args: isinstance(args[1], Register))
-    , InstructionPattern("div_float", bytes([0x23]))
-        .verify("needs two arguments", DISPLAY_ALL, lambda args: len(args) == 2)
-        .verify("argument one has to be register", 0, lambda args: isinstance(args[0], Register))
-        .verify("argument two has to be register", 1, lambda args: isinstance(args[1], Register))
-
-    , InstructionPattern("send_message", bytes([0x80]))
-        .verify("needs at least 4 arguments", DISPLAY_ALL, lambda args: len(args) >= 4)
-        .verify("argument one has to be register", 0, lambda args: isinstance(args[0], Register))
-        .verify("argument two has to be register", 1, lambda args: isinstance(args[1], Register))
-        .verify("argument three has to be register", 2, lambda args: isinstance(args[2], Register))
-        .verify("argument four has to be int", 3, lambda args: isinstance(args[3], Integer))
-        .verify(
-            "needs this many register-arguments",
-            3,
-            lambda args: len(args) == args[3].inner.value + 4
-        )
-        # TODO: Check that all register-arguments are registers, with good errors
-    , InstructionPattern("add_handler", bytes([0x81]))
-        .verify("needs at least 4 arguments", DISPLAY_ALL, lambda args: len(args) >= 3)
-        .verify("argument one has to be register", 0, lambda args: isinstance(args[0], Register))
-        .verify("argument two has to be integer", 1, lambda args: isinstance(args[1], Integer))
-        .verify("argument three has to be integer", 2, lambda args: isinstance(args[2], Integer))
-        .verify("argument four has to be integer reference", 3, lambda args: isinstance(args[3], Integer))
-        .verify(
-            "needs this many register-arguments",
-            2,
-            lambda args: len(args) == args[3].inner.value * 2 + 4
-        )
-    , InstructionPattern("remove_handler", bytes([0x82]))
-        .verify("needs one argument", DISPLAY_ALL, lambda args: len(args) == 1)
-        .verify("argument one has to be register", 0, lambda args: isinstance(args[0], Register))
-        # TODO: Check that all register-arguments are registers, with good errors
+    [ InstructionPattern("dw", bytes([]), [IMM64])
+    , InstructionPattern("ds", bytes([]), [STR])
+    , InstructionPattern("set_self_addr", bytes([0x00]), [REG])
+    , InstructionPattern("set_float", bytes([0x01]), [REG, F64])
+    , InstructionPattern("set_integer", bytes([0x02]), [REG, IMM64])
+    , InstructionPattern("set_string", bytes([0x03]), [REG, STR])
+    , InstructionPattern("copy", bytes([0x04]), [REG, REG])
+    , InstructionPattern("generate_atom", bytes([0x05]), [REG])
+    , InstructionPattern("integer_to_atom", bytes([0x06]), [REG])
+
+    , InstructionPattern("add_int", bytes([0x10]), [REG, REG])
+    , InstructionPattern("sub_int", bytes([0x11]), [REG, REG])
+    , InstructionPattern("mul_int", bytes([0x12]), [REG, REG])
+
+    , InstructionPattern("add_float", bytes([0x20]), [REG, REG])
+    , InstructionPattern("sub_float", bytes([0x21]), [REG, REG])
+    , InstructionPattern("mul_float", bytes([0x22]), [REG, REG])
+    , InstructionPattern("div_float", bytes([0x23]), [REG, REG])
+
+    , InstructionPattern("send_message", bytes([0x80]), [REG, REG, REG, IMM64], Variadic(3, 1))
+    , InstructionPattern("add_handler", bytes([0x81]), [REG, IMM64, IMM64, IMM64], Variadic(3, 2))
+    , InstructionPattern("remove_handler", bytes([0x82]), [REG])
     # TODO: More instructions
     ]
 
-def construct_instruction(assembly_instruction_token, arguments):
-    for inst in INSTRUCTION_PATTERNS:
-        if inst.mnemonic == assembly_instruction_token.inst:
-            for (err_msg, displayer, verifier) in inst.argument_verifiers:
-                if not verifier(arguments):
-                    span = assembly_instruction_token.span
-                    if displayer == DISPLAY_ALL and len(arguments) > 0:
-                        span = arguments[0].inner.span.combine_nonadjacent(arguments[-1].inner.span)
-                    elif displayer < len(arguments):
-                        span = arguments[displayer].inner.span
-                    span.print_aa()
-                    print(err_msg)
-                    exit()
-            return Instruction(inst.bytecode, arguments)
-
-    assembly_instruction_token.span.print_aa()
-    print("No such instruction!")
-    exit()
+INSTRUCTIONS_BY_MNEMONIC = {inst.mnemonic: inst for inst in INSTRUCTION_PATTERNS}
+INSTRUCTIONS_BY_OPCODE = {inst.bytecode[0]: inst for inst in INSTRUCTION_PATTERNS if len(inst.bytecode) > 0}
+
+def construct_instruction(assembly_instruction_token, arguments, diagnostics):
+    # Returns None after reporting to diagnostics if the instruction is malformed
+    inst = INSTRUCTIONS_BY_MNEMONIC.get(assembly_instruction_token.inst)
+    if inst is None:
+        diagnostics.error("No such instruction!", assembly_instruction_token.span)
+        return None
+
+    error = inst.check(arguments)
+    if error is not None:
+        err_msg, displayer = error
+        span = assembly_instruction_token.span
+        if displayer == DISPLAY_ALL and len(arguments) > 0:
+            span = arguments[0].inner.span.combine_nonadjacent(arguments[-1].inner.span)
+        elif displayer is not None and displayer < len(arguments):
+            span = arguments[displayer].inner.span
+        diagnostics.error(err_msg, span)
+        return None
+
+    return Instruction(inst.bytecode, arguments, assembly_instruction_token.span)
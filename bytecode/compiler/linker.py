@@ -0,0 +1,169 @@
+import struct
+
+from diagnostics import Diagnostics
+from objfile import LABEL, ObjectFile
+
+# Combines object files (see objfile.py) into one v1 .act file. The output starts with a program
+# table holding the programs of every object in link order, followed by the code of every object
+# in link order.
+#
+# Every category is numbered across all objects: it starts at the value it has in the first
+# object that declares it, and the @inc's of every object follow those of the objects before it.
+# So the programs of the second object come after those of the first in the table, and its
+# 'functions' numbers move along with them.
+
+def category_names(objects):
+    categories = {}
+    for obj in objects:
+        for category in obj.bases:
+            categories[category] = None
+        for category, _, _ in obj.incs:
+            categories[category] = None
+    return list(categories)
+
+class Linker:
+    def __init__(self, objects, names=None):
+        self.objects = objects
+        # Names of the objects for errors, like their paths
+        self.names = names if names is not None else [f"object {idx}" for idx in range(len(objects))]
+        self.diagnostics = Diagnostics()
+
+        self.categories = category_names(objects)
+        # Value of every category before the first object, and after the last
+        self.bases = {}
+        self.finals = {}
+        # Symbols of every object, and those exported to the others
+        self.local_symbols = []
+        self.exported = {}
+
+    def table_category(self):
+        table_categories = {obj.table_category for obj in self.objects if obj.table_category is not None}
+        if len(table_categories) > 1:
+            self.diagnostics.error(f"Objects number their programs with different categories: {', '.join(sorted(table_categories))}", None)
+        return next(iter(table_categories), None)
+
+    def number_categories(self):
+        for category in self.categories:
+            for obj in self.objects:
+                if category in obj.bases:
+                    self.bases[category] = obj.bases[category]
+                    break
+                if category in obj.symbols:
+                    self.bases[category] = obj.symbols[category][1]
+                    break
+            else:
+                self.diagnostics.error(f"{category} is @inc'd but no object @declare's it", None)
+                self.bases[category] = 0
+
+        counts = dict(self.bases)
+        numbered = []
+        for obj in self.objects:
+            values = {}
+            used = {}
+            for category, variable, index in obj.incs:
+                values[variable] = counts[category] + index
+                used[category] = max(used.get(category, 0), index + 1)
+            for category, n_used in used.items():
+                counts[category] += n_used
+            numbered.append(values)
+
+        self.finals = counts
+        return numbered
+
+    def place(self, table_size):
+        # Returns where the code of every object starts
+        starts = []
+        position = table_size
+        for obj in self.objects:
+            starts.append(position)
+            position += len(obj.code)
+        return starts
+
+    def collect_symbols(self, starts, numbered):
+        for obj, name, start, values in zip(self.objects, self.names, starts, numbered):
+            symbols = {}
+            for symbol, (kind, value) in obj.symbols.items():
+                symbols[symbol] = start + value if kind == LABEL else value
+            symbols.update(values)
+            symbols.update(self.finals)
+            self.local_symbols.append(symbols)
+
+            for symbol in obj.exports:
+                if symbol in self.categories:
+                    continue
+                if symbol in self.exported:
+                    self.diagnostics.error(f"{symbol} is exported by both {self.exported[symbol][0]} and {name}", None)
+                    continue
+                self.exported[symbol] = (name, symbols[symbol])
+
+    def resolve(self, idx, symbol):
+        value = self.local_symbols[idx].get(symbol)
+        if value is None:
+            exported = self.exported.get(symbol)
+            if exported is None:
+                self.diagnostics.error(f"{symbol}, used by {self.names[idx]}, isn't defined or exported by any object", None)
+                return 0
+            value = exported[1]
+        return value
+
+    def link(self):
+        table_category = self.table_category()
+        n_programs = sum(len(obj.programs) for obj in self.objects)
+        table_size = 8 + 16 * n_programs if table_category is not None else 0
+
+        numbered = self.number_categories()
+        starts = self.place(table_size)
+        self.collect_symbols(starts, numbered)
+
+        out = bytearray()
+        if table_category is not None:
+            out += struct.pack("Q", n_programs)
+            for idx, obj in enumerate(self.objects):
+                for start, end in obj.programs:
+                    out += struct.pack("QQ", self.resolve(idx, start), self.resolve(idx, end))
+
+        for idx, (obj, start) in enumerate(zip(self.objects, starts)):
+            out += obj.code
+            for offset, width, symbol in obj.relocations:
+                value = self.resolve(idx, symbol)
+                if value >= 1 << (8 * width):
+                    self.diagnostics.error(f"{symbol} doesn't fit in {width} bytes in {self.names[idx]}", None)
+                    continue
+                out[start + offset:start + offset + width] = value.to_bytes(width, "little")
+
+        self.diagnostics.raise_if_errors()
+        return bytes(out)
+
+def link(objects, names=None):
+    return Linker(objects, names).link()
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    from diagnostics import CompileError
+    from objfile import ObjectFormatError
+
+    arg_parser = argparse.ArgumentParser(description="Link object files into an actor base")
+    arg_parser.add_argument("inputs", nargs="+", help="Object files, in the order their programs and code are laid out")
+    arg_parser.add_argument("-o", "--output", required=True, help="The .act file to write")
+    args = arg_parser.parse_args()
+
+    objects = []
+    for path in args.inputs:
+        with open(path, "rb") as inp_f:
+            try:
+                objects.append(ObjectFile.from_bytes(inp_f.read()))
+            except ObjectFormatError as e:
+                print(f"{path}: {e}")
+                sys.exit(1)
+
+    try:
+        out = link(objects, args.inputs)
+    except CompileError as e:
+        e.print_aa()
+        print(f"{len(e.diagnostics)} error(s)")
+        sys.exit(1)
+
+    with open(args.output, "wb") as out_f:
+        out_f.write(out)
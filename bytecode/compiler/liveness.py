@@ -0,0 +1,264 @@
+from instructions import Instruction, INSTRUCTIONS_BY_MNEMONIC, INSTRUCTIONS_BY_OPCODE
+from macro import LabelPseudoInstruction
+import values
+
+# Which registers every instruction reads and writes, and which of them are live where. There are
+# no jumps, so the control flow of a program is straight-line code: labels cut it into blocks, and
+# a block runs on into the one after it unless data (dw, ds) comes in between. A program can start
+# at any label, with message arguments in r0, r1, ... and add_handler presets in the registers
+# they name, so a physical register read before it is written in a block holds a value from
+# outside it and is live from the start of the block.
+#
+# Registers are identified by their index for physical registers, and by name (v_...) for virtual
+# registers. Virtual registers only live inside one block, so they are never live out of a block:
+# one read before it is set is live in at the start of the block reading it, and no further.
+
+READ = "read"
+WRITE = "write"
+READ_WRITE = "read-write"
+# The index of a register in the program a handler runs, which isn't read here
+PIN = "pin"
+
+OPERAND_ROLES = {
+    "set_self_addr": (WRITE,),
+    "set_float": (WRITE, None),
+    "set_integer": (WRITE, None),
+    "set_string": (WRITE, None),
+    "copy": (WRITE, READ),
+    "generate_atom": (WRITE,),
+    "integer_to_atom": (READ_WRITE,),
+    "add_int": (READ_WRITE, READ),
+    "sub_int": (READ_WRITE, READ),
+    "mul_int": (READ_WRITE, READ),
+    "add_float": (READ_WRITE, READ),
+    "sub_float": (READ_WRITE, READ),
+    "mul_float": (READ_WRITE, READ),
+    "div_float": (READ_WRITE, READ),
+    "send_message": (READ, READ, READ, None),
+    "add_handler": (READ, None, None, None),
+    "remove_handler": (READ,),
+}
+
+# Roles of each group of variadic registers
+VARIADIC_ROLES = {
+    "send_message": (READ,),
+    "add_handler": (PIN, READ),
+}
+
+ROLES_BY_OPCODE = {
+    INSTRUCTIONS_BY_MNEMONIC[mnemonic].bytecode: (roles, VARIADIC_ROLES.get(mnemonic))
+    for mnemonic, roles in OPERAND_ROLES.items()
+}
+
+COPY = INSTRUCTIONS_BY_MNEMONIC["copy"].bytecode
+
+def register_key(argument):
+    if isinstance(argument, values.VirtualRegister):
+        return argument.inner.name
+    return argument.inner.reg_idx
+
+def is_virtual(key):
+    return type(key) is str
+
+def is_code(inst):
+    return type(inst) is Instruction and len(inst.bytecode) > 0
+
+def is_data(inst):
+    return type(inst) is Instruction and len(inst.bytecode) == 0
+
+def operand_roles(inst):
+    # (argument index, role) of every register operand of a code instruction
+    roles, variadic = ROLES_BY_OPCODE[inst.bytecode]
+    for idx, role in enumerate(roles):
+        if role is not None:
+            yield idx, role
+
+    if variadic is not None:
+        for idx in range(len(roles), len(inst.arguments)):
+            yield idx, variadic[(idx - len(roles)) % len(variadic)]
+
+class Access:
+    # The registers one instruction reads and writes, and the register arguments that are pins
+    def __init__(self, inst):
+        self.reads = []
+        self.writes = []
+        self.pins = []
+        # The source of a copy can share a register with the destination
+        self.copy_source = None
+        if not is_code(inst):
+            return
+
+        for idx, role in operand_roles(inst):
+            argument = inst.arguments[idx]
+            if role is PIN:
+                self.pins.append(argument)
+                continue
+
+            key = register_key(argument)
+            if role is READ or role is READ_WRITE:
+                self.reads.append(key)
+            if role is WRITE or role is READ_WRITE:
+                self.writes.append(key)
+
+        if inst.bytecode == COPY:
+            self.copy_source = self.reads[0]
+
+class Block:
+    # Instructions between two labels, or between a label and data. Labels and other
+    # pseudo-instructions stay in the block, they don't touch registers
+    def __init__(self):
+        self.instructions = []
+        self.accesses = []
+        # The block this one runs on into, if any
+        self.successor = None
+
+        self.live_in = set()
+        self.live_out = set()
+        # Registers live after each instruction
+        self.live_after = []
+
+    def append(self, inst):
+        self.instructions.append(inst)
+        self.accesses.append(Access(inst))
+
+    def has_virtual(self):
+        return any(is_virtual(key) for access in self.accesses for key in access.writes + access.reads)
+
+    def analyze(self):
+        # Backward over the block, from what is live after it
+        live = set(self.live_out)
+        self.live_after = [None] * len(self.instructions)
+        for idx in range(len(self.instructions) - 1, -1, -1):
+            self.live_after[idx] = frozenset(live)
+            access = self.accesses[idx]
+            live.difference_update(access.writes)
+            live.update(access.reads)
+
+        self.live_in = live
+
+    def __str__(self):
+        return f"Block(instructions={len(self.instructions)}, live_in={sorted(map(str, self.live_in))}, live_out={sorted(map(str, self.live_out))})"
+
+    __repr__ = __str__
+
+class ControlFlow:
+    # The blocks of a list of instructions, with liveness worked out for every block. live_out is
+    # what is live after the instructions, if they end in code
+    def __init__(self, instructions, live_out=frozenset()):
+        self.live_out = live_out
+        # Blocks and the data between them, in order
+        self.items = []
+        self.blocks = []
+        # Whether the last block runs on into the next one
+        self.runs_on = False
+
+        block = Block()
+        for inst in instructions:
+            if is_data(inst):
+                self.end_block(block, runs_on=False)
+                self.items.append(inst)
+                block = Block()
+            elif isinstance(inst, LabelPseudoInstruction) and any(is_code(other) for other in block.instructions):
+                self.end_block(block, runs_on=True)
+                block = Block()
+                block.append(inst)
+            else:
+                block.append(inst)
+        self.end_block(block, runs_on=False)
+
+        self.analyze()
+
+    def end_block(self, block, runs_on):
+        if len(block.instructions) == 0:
+            return
+        if self.runs_on:
+            self.blocks[-1].successor = block
+        self.runs_on = runs_on
+        self.blocks.append(block)
+        self.items.append(block)
+
+    def analyze(self):
+        # A single backward pass is enough, as blocks only run on forward
+        for block in reversed(self.blocks):
+            if block.successor is not None:
+                block.live_out = {key for key in block.successor.live_in if not is_virtual(key)}
+            elif block is self.items[-1]:
+                block.live_out = {key for key in self.live_out if not is_virtual(key)}
+            else:
+                block.live_out = set()
+            block.analyze()
+
+    def live_in(self):
+        # What is live before the instructions
+        if len(self.items) == 0:
+            return set(self.live_out)
+        if isinstance(self.items[0], Block):
+            return self.items[0].live_in
+        return set()
+
+    def instructions(self):
+        for item in self.items:
+            if isinstance(item, Block):
+                yield from item.instructions
+            else:
+                yield item
+
+def format_key(key):
+    return key if is_virtual(key) else f"r{key}"
+
+def format_live(live):
+    physical = sorted(key for key in live if not is_virtual(key))
+    virtual = sorted(key for key in live if is_virtual(key))
+    return " ".join([format_key(key) for key in physical] + virtual)
+
+def format_instruction(inst):
+    if isinstance(inst, LabelPseudoInstruction):
+        return f"@label('{inst.variable_name}')"
+    if not is_code(inst):
+        return type(inst).__name__
+
+    parts = [INSTRUCTIONS_BY_OPCODE[inst.bytecode[0]].mnemonic]
+    for argument in inst.arguments:
+        if isinstance(argument, values.Register):
+            parts.append(format_key(register_key(argument)))
+        elif isinstance(argument, values.Reference):
+            parts.append(f"@=('{argument.symbol}')")
+        else:
+            parts.append(repr(argument.inner.value))
+    return " ".join(parts)
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    import compiler
+    from diagnostics import Diagnostics
+    from tokenizer import ParseInput, parse_all
+
+    arg_parser = argparse.ArgumentParser(description="Show the blocks of an assembly file and the registers live in them")
+    arg_parser.add_argument("input_path")
+    args = arg_parser.parse_args()
+
+    with open(args.input_path, "r") as inp_f:
+        inp_text = inp_f.read()
+
+    diagnostics = Diagnostics()
+    tokens = compiler.preproc_tokens(parse_all(ParseInput(inp_text), diagnostics=diagnostics))
+    parsed = compiler.upgrade_values(compiler.group_macros(tokens, diagnostics))
+    expanded, _ = compiler.pseudo_expand_macros(parsed)
+    flow = ControlFlow(compiler.parse_instructions(expanded, diagnostics))
+    if diagnostics.has_errors():
+        for error in diagnostics.errors:
+            error.print_aa()
+        sys.exit(1)
+
+    for block_idx, block in enumerate(flow.blocks):
+        if not any(is_code(inst) for inst in block.instructions):
+            continue
+
+        successor = "end" if block.successor is None else f"block {flow.blocks.index(block.successor)}"
+        print(f"; block {block_idx}, runs on into {successor}")
+        print(f";   live in: {format_live(block.live_in)}")
+        for inst, live in zip(block.instructions, block.live_after):
+            print(f"    {format_instruction(inst):<48} ; {format_live(live)}")
+        print()
@@ -1,7 +1,6 @@
 from abc import ABC, abstractmethod
-import struct
 
-from values import String, Integer, Float
+from values import String, Integer, Float, Reference
 import tokenizer
 
 from instructions import Instruction
@@ -26,13 +25,13 @@ class Macro(ABC):
         pass
 
 class LabelPseudoInstruction(Instruction):
-    def __init__(self, variable_name):
-        super(LabelPseudoInstruction, self).__init__(bytes([]), [])
+    def __init__(self, variable_name, span=None):
+        super(LabelPseudoInstruction, self).__init__(bytes([]), [], span)
 
         self.variable_name = variable_name
 
     def compile_to_bytecode(self, output):
-        output.variables[self.variable_name] = len(output.output)
+        output.define_label(self.variable_name)
 
     def __str__(self):
         return f"LabelPseudoInstruction(variable_name={self.variable_name})"
@@ -49,7 +48,7 @@ class Label(Macro):
         return f"Label(name={repr(self.name)})"
 
     def into_pseudo_values(self):
-        return [LabelPseudoInstruction(self.name)]
+        return [LabelPseudoInstruction(self.name, self.span)]
 
     def post_process(self, output):
         pass
@@ -60,7 +59,7 @@ class Eq(Macro):
 
         self.name = name
 
-        self.equal = Integer(tokenizer.IntegerToken(span, 0))
+        self.equal = Reference(tokenizer.IntegerToken(span, 0), name)
 
     def __repr__(self):
         return f"Eq(name={repr(self.name)})"
@@ -69,27 +68,18 @@ class Eq(Macro):
         return [self.equal]
 
     def post_process(self, output):
-        if self.name not in output.variables:
-            self.span.print_aa()
-            print("Variable not found")
-            exit()
-
-        value = output.variables[self.name]
-
-        track_id = self.equal.track_id
-        position = output.tracked_ids[track_id]
-
-        output.override_inside(position, struct.pack("Q", value))
+        # The value is filled in by the relocation the placeholder registered when compiled
+        pass
 
 class DeclarePseudoInstruction(Instruction):
-    def __init__(self, variable_name, value):
-        super(DeclarePseudoInstruction, self).__init__(bytes([]), [])
+    def __init__(self, variable_name, value, span=None):
+        super(DeclarePseudoInstruction, self).__init__(bytes([]), [], span)
 
         self.variable_name = variable_name
         self.value = value
 
     def compile_to_bytecode(self, output):
-        output.variables[self.variable_name] = self.value
+        output.declare(self.variable_name, self.value)
 
     def __str__(self):
         return f"DeclarePseudoInstruction(variable_name={self.variable_name}, value={self.value})"
@@ -107,21 +97,20 @@ class Declare(Macro):
         return f"Declare(name={repr(self.name)}, value={self.value})"
 
     def into_pseudo_values(self):
-        return [DeclarePseudoInstruction(self.name, self.value)]
+        return [DeclarePseudoInstruction(self.name, self.value, self.span)]
 
     def post_process(self, output):
         pass
 
 class IncPseudoInstruction(Instruction):
-    def __init__(self, category, variable):
-        super(IncPseudoInstruction, self).__init__(bytes([]), [])
+    def __init__(self, category, variable, span=None):
+        super(IncPseudoInstruction, self).__init__(bytes([]), [], span)
 
         self.category = category
         self.variable = variable
 
     def compile_to_bytecode(self, output):
-        output.variables[self.variable] = output.variables[self.category]
-        output.variables[self.category] += 1
+        output.inc(self.category, self.variable, self.span)
 
     def __str__(self):
         return f"IncPseudoInstruction(category={self.category}, variable={self.variable})"
@@ -139,92 +128,115 @@ class Inc(Macro):
         return f"Inc(category={self.category}, variable={self.variable})"
 
     def into_pseudo_values(self):
-        return [IncPseudoInstruction(self.category, self.variable)]
+        return [IncPseudoInstruction(self.category, self.variable, self.span)]
+
+    def post_process(self, output):
+        pass
+
+class ExportPseudoInstruction(Instruction):
+    def __init__(self, variable_name, span=None):
+        super(ExportPseudoInstruction, self).__init__(bytes([]), [], span)
+
+        self.variable_name = variable_name
+
+    def compile_to_bytecode(self, output):
+        output.export(self.variable_name)
+
+    def __str__(self):
+        return f"ExportPseudoInstruction(variable_name={self.variable_name})"
+
+    __repr__ = __str__
+
+class Export(Macro):
+    def __init__(self, span, name):
+        super(Export, self).__init__(span)
+
+        self.name = name
+
+    def __repr__(self):
+        return f"Export(name={repr(self.name)})"
+
+    def into_pseudo_values(self):
+        return [ExportPseudoInstruction(self.name, self.span)]
 
     def post_process(self, output):
         pass
 
-def construct_macro(macro_token, argument_tokens):
+class Include(Macro):
+    # Replaced by the contents of the file by include.expand_includes, before macros are expanded
+    def __init__(self, span, path):
+        super(Include, self).__init__(span)
+
+        self.path = path
+
+    def __repr__(self):
+        return f"Include(path={repr(self.path)})"
+
+    def into_pseudo_values(self):
+        return []
+
+    def post_process(self, output):
+        pass
+
+def argument_span(macro_token, argument_tokens):
+    if len(argument_tokens) == 0:
+        return macro_token.span
+    return argument_tokens[0].span.combine_nonadjacent(argument_tokens[-1].span)
+
+def construct_macro(macro_token, argument_tokens, diagnostics):
+    # Returns None after reporting to diagnostics if the macro is malformed
     if len(argument_tokens) == 0:
         full_span = macro_token.span
     else:
         full_span = macro_token.span.combine_nonadjacent(argument_tokens[-1].span)
 
     if macro_token.macro_name == "label":
-        if len(argument_tokens) == 1:
-            if isinstance(argument_tokens[0], tokenizer.StringToken):
-                return Label(full_span, argument_tokens[0].value)
-            else:
-                argument_tokens[0].span.print_aa()
-                print("@label needs a string")
-                exit()
+        if len(argument_tokens) != 1:
+            diagnostics.error("@label needs exactly one argument", argument_span(macro_token, argument_tokens))
+        elif not isinstance(argument_tokens[0], tokenizer.StringToken):
+            diagnostics.error("@label needs a string", argument_tokens[0].span)
         else:
-            if len(argument_tokens) == 0:
-                macro_token.span.print_aa()
-            else:
-                argument_span = argument_tokens[0].span.combine_nonadjacent(argument_tokens[-1].span)
-                argument_span.print_aa()
-            print("@label needs exactly one argument")
-            exit()
-    if macro_token.macro_name == "declare":
-        if len(argument_tokens) == 2:
-            if isinstance(argument_tokens[0], tokenizer.StringToken):
-                if isinstance(argument_tokens[1], tokenizer.IntegerToken):
-                    return Declare(full_span, argument_tokens[0].value, argument_tokens[1].value)
-                else:
-                    argument_tokens[1].span.print_aa()
-                    print("@declare's second argument is an integer")
-                    exit()
-            else:
-                argument_tokens[0].span.print_aa()
-                print("@declare's first argument is a string")
-                exit()
+            return Label(full_span, argument_tokens[0].value)
+    elif macro_token.macro_name == "declare":
+        if len(argument_tokens) != 2:
+            diagnostics.error("@declare needs exactly two argument", argument_span(macro_token, argument_tokens))
+        elif not isinstance(argument_tokens[0], tokenizer.StringToken):
+            diagnostics.error("@declare's first argument is a string", argument_tokens[0].span)
+        elif not isinstance(argument_tokens[1], tokenizer.IntegerToken):
+            diagnostics.error("@declare's second argument is an integer", argument_tokens[1].span)
         else:
-            if len(argument_tokens) == 0:
-                macro_token.span.print_aa()
-            else:
-                argument_span = argument_tokens[0].span.combine_nonadjacent(argument_tokens[-1].span)
-                argument_span.print_aa()
-            print("@declare needs exactly two argument")
-            exit()
-    if macro_token.macro_name == "inc":
-        if len(argument_tokens) == 2:
-            if isinstance(argument_tokens[0], tokenizer.StringToken):
-                if isinstance(argument_tokens[0], tokenizer.StringToken):
-                    return Inc(full_span, argument_tokens[0].value, argument_tokens[1].value)
-                else:
-                    argument_tokens[1].span.print_aa()
-                    print("@inc's second argument is a string")
-                    exit()
-            else:
-                argument_tokens[0].span.print_aa()
-                print("@inc's first argument is a string")
-                exit()
+            return Declare(full_span, argument_tokens[0].value, argument_tokens[1].value)
+    elif macro_token.macro_name == "inc":
+        if len(argument_tokens) != 2:
+            diagnostics.error("@inc needs exactly two argument", argument_span(macro_token, argument_tokens))
+        elif not isinstance(argument_tokens[0], tokenizer.StringToken):
+            diagnostics.error("@inc's first argument is a string", argument_tokens[0].span)
+        elif not isinstance(argument_tokens[1], tokenizer.StringToken):
+            diagnostics.error("@inc's second argument is a string", argument_tokens[1].span)
         else:
-            if len(argument_tokens) == 0:
-                macro_token.span.print_aa()
-            else:
-                argument_span = argument_tokens[0].span.combine_nonadjacent(argument_tokens[-1].span)
-                argument_span.print_aa()
-            print("@inc needs exactly two argument")
-            exit()
+            return Inc(full_span, argument_tokens[0].value, argument_tokens[1].value)
     elif macro_token.macro_name == "=":
-        if len(argument_tokens) == 1:
-            if isinstance(argument_tokens[0], tokenizer.StringToken):
-                return Eq(full_span, argument_tokens[0].value)
-            else:
-                argument_tokens[0].span.print_aa()
-                print("@= needs a string")
-                exit()
+        if len(argument_tokens) != 1:
+            diagnostics.error("@= needs exactly one argument", argument_span(macro_token, argument_tokens))
+        elif not isinstance(argument_tokens[0], tokenizer.StringToken):
+            diagnostics.error("@= needs a string", argument_tokens[0].span)
+        else:
+            return Eq(full_span, argument_tokens[0].value)
+    elif macro_token.macro_name == "export":
+        if len(argument_tokens) != 1:
+            diagnostics.error("@export needs exactly one argument", argument_span(macro_token, argument_tokens))
+        elif not isinstance(argument_tokens[0], tokenizer.StringToken):
+            diagnostics.error("@export needs a string", argument_tokens[0].span)
         else:
-            if len(argument_tokens) == 0:
-                macro_token.span.print_aa()
-            else:
-                argument_span = argument_tokens[0].span.combine_nonadjacent(argument_tokens[-1].span)
-                argument_span.print_aa()
-            print("@= needs exactly one argument")
-            exit()
+            return Export(full_span, argument_tokens[0].value)
+    elif macro_token.macro_name == "include":
+        if len(argument_tokens) != 1:
+            diagnostics.error("@include needs exactly one argument", argument_span(macro_token, argument_tokens))
+        elif not isinstance(argument_tokens[0], tokenizer.StringToken):
+            diagnostics.error("@include needs a string", argument_tokens[0].span)
+        else:
+            return Include(full_span, argument_tokens[0].value)
     else:
-        macro_token.span.print_aa()
-        print("Unknown macro", macro_token.macro_name)
-        exit()
+        diagnostics.error(f"Unknown macro {macro_token.macro_name}", macro_token.span)
+
+    return None
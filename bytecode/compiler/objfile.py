@@ -0,0 +1,338 @@
+import struct
+
+from values import CompileOutput
+
+# Object files, assembled from one .dig file on their own and combined into an actor base by
+# linker.py. An object keeps everything that depends on the other files it is linked with as
+# symbols instead of values:
+#
+# - Labels, as offsets into the object's code.
+# - @declare'd variables, with their final value.
+# - Every @inc, as its category and its index among the object's @inc's of that category. The
+#   linker numbers categories like 'functions' and 'atoms' across all objects, so an object can
+#   @inc a category that only another object @declare's.
+# - The program table. A file starting with dw @=('functions') and the start and end of every
+#   program, as every actor base does, has its table taken out of its code and kept as pairs of
+#   symbols, so the linker can write one table for all objects.
+# - Every @= as a relocation, none of them filled in.
+#
+# Symbols are local to their object unless exported with @export, except for categories, which
+# are shared by every object. A symbol an object uses but doesn't define is imported from the
+# object exporting it.
+#
+# Layout, with integers as 8 bytes and strings as [length:8] [UTF-8]:
+#
+#   MAGIC [version:1]
+#   [code length] [code]
+#   [n symbols] then for every symbol [kind:1] [value] [name]
+#   [n categories] then for every category [name] [value before its first @inc]
+#   [n incs] then for every @inc [category] [variable] [index]
+#   [n exports] then for every export [name]
+#   [table category, empty without a table] [n programs] then for every program [start] [end]
+#   [n relocations] then for every relocation [offset] [width:1] [symbol]
+
+MAGIC = b"\xffACO"
+VERSION = 1
+
+LABEL = 0
+DECLARED = 1
+
+U64 = struct.Struct("Q")
+
+class ObjectFormatError(Exception):
+    def __init__(self, message, offset=None):
+        super(ObjectFormatError, self).__init__(message)
+        self.message = message
+        self.offset = offset
+
+    def __str__(self):
+        if self.offset is None:
+            return self.message
+        return f"{self.message} at 0x{self.offset:x}"
+
+def is_object(data):
+    return bytes(data[:len(MAGIC)]) == MAGIC
+
+class ObjectFile:
+    def __init__(self, code=b"", symbols=None, bases=None, incs=None, exports=None, table_category=None, programs=None, relocations=None):
+        self.code = code
+        # Name to (kind, value)
+        self.symbols = symbols if symbols is not None else {}
+        # Category to its value before the object's first @inc of it
+        self.bases = bases if bases is not None else {}
+        # (category, variable, index) in order
+        self.incs = incs if incs is not None else []
+        self.exports = exports if exports is not None else []
+        self.table_category = table_category
+        # (start symbol, end symbol) of every program, in table order
+        self.programs = programs if programs is not None else []
+        # (offset into code, width, symbol)
+        self.relocations = relocations if relocations is not None else []
+
+    def defined(self):
+        return set(self.symbols) | set(self.bases) | {variable for _, variable, _ in self.incs}
+
+    def imports(self):
+        # Symbols used but not defined here, in the order they are first used
+        used = [symbol for _, _, symbol in self.relocations]
+        for start, end in self.programs:
+            used += [start, end]
+
+        defined = self.defined()
+        imports = {}
+        for symbol in used:
+            if symbol not in defined:
+                imports[symbol] = None
+        return list(imports)
+
+    def to_bytes(self):
+        out = bytearray(MAGIC)
+        out.append(VERSION)
+
+        def write_int(value):
+            out.extend(U64.pack(value))
+
+        def write_str(text):
+            enc_text = text.encode("utf-8")
+            write_int(len(enc_text))
+            out.extend(enc_text)
+
+        write_int(len(self.code))
+        out.extend(self.code)
+
+        write_int(len(self.symbols))
+        for name, (kind, value) in self.symbols.items():
+            out.append(kind)
+            write_int(value)
+            write_str(name)
+
+        write_int(len(self.bases))
+        for category, base in self.bases.items():
+            write_str(category)
+            write_int(base)
+
+        write_int(len(self.incs))
+        for category, variable, index in self.incs:
+            write_str(category)
+            write_str(variable)
+            write_int(index)
+
+        write_int(len(self.exports))
+        for name in self.exports:
+            write_str(name)
+
+        write_str(self.table_category if self.table_category is not None else "")
+        write_int(len(self.programs))
+        for start, end in self.programs:
+            write_str(start)
+            write_str(end)
+
+        write_int(len(self.relocations))
+        for offset, width, symbol in self.relocations:
+            write_int(offset)
+            out.append(width)
+            write_str(symbol)
+
+        return bytes(out)
+
+    @staticmethod
+    def from_bytes(data):
+        data = bytes(data)
+        if not is_object(data):
+            raise ObjectFormatError("Not an object file")
+        if len(data) <= len(MAGIC) or data[len(MAGIC)] != VERSION:
+            raise ObjectFormatError("Unsupported object file version", len(MAGIC))
+
+        pos = len(MAGIC) + 1
+
+        def read_int():
+            nonlocal pos
+            if pos + U64.size > len(data):
+                raise ObjectFormatError("Unexpected end of object file", pos)
+            value, = U64.unpack_from(data, pos)
+            pos += U64.size
+            return value
+
+        def read_byte():
+            nonlocal pos
+            if pos >= len(data):
+                raise ObjectFormatError("Unexpected end of object file", pos)
+            pos += 1
+            return data[pos - 1]
+
+        def read_bytes(length):
+            nonlocal pos
+            if length > len(data) - pos:
+                raise ObjectFormatError("Unexpected end of object file", pos)
+            pos += length
+            return data[pos - length:pos]
+
+        def read_str():
+            start = pos
+            try:
+                return read_bytes(read_int()).decode("utf-8")
+            except UnicodeDecodeError:
+                raise ObjectFormatError("String isn't valid UTF-8", start)
+
+        obj = ObjectFile()
+        obj.code = read_bytes(read_int())
+
+        for _ in range(read_int()):
+            kind = read_byte()
+            if kind not in (LABEL, DECLARED):
+                raise ObjectFormatError(f"Unknown symbol kind {kind}", pos - 1)
+            value = read_int()
+            obj.symbols[read_str()] = (kind, value)
+
+        for _ in range(read_int()):
+            category = read_str()
+            obj.bases[category] = read_int()
+
+        for _ in range(read_int()):
+            category, variable = read_str(), read_str()
+            obj.incs.append((category, variable, read_int()))
+
+        obj.exports = [read_str() for _ in range(read_int())]
+
+        table_category = read_str()
+        obj.table_category = table_category if table_category != "" else None
+        obj.programs = [(read_str(), read_str()) for _ in range(read_int())]
+
+        for _ in range(read_int()):
+            offset, width = read_int(), read_byte()
+            symbol = read_str()
+            if offset + width > len(obj.code):
+                raise ObjectFormatError(f"Relocation of {symbol} is outside the code", pos)
+            obj.relocations.append((offset, width, symbol))
+
+        if pos != len(data):
+            raise ObjectFormatError("Trailing data after the relocations", pos)
+        return obj
+
+    def __str__(self):
+        return f"ObjectFile(code={len(self.code)} bytes, symbols={len(self.symbols)}, incs={len(self.incs)}, exports={self.exports}, programs={len(self.programs)}, relocations={len(self.relocations)})"
+
+    __repr__ = __str__
+
+class ObjectOutput(CompileOutput):
+    # Compiles like a v1 file, but keeps track of what every variable is. resolve_relocations
+    # takes out the program table, checks what can be checked without the other objects, and
+    # replaces output with the object file
+    def __init__(self, share_data=False):
+        super(ObjectOutput, self).__init__(share_data)
+
+        self.label_names = set()
+        self.bases = {}
+        # Number of @inc's of every category this object doesn't @declare
+        self.undeclared = {}
+        self.incs = []
+        self.exports = {}
+
+    def define_label(self, name):
+        super(ObjectOutput, self).define_label(name)
+        self.label_names.add(name)
+
+    def alias_label(self, name, target):
+        super(ObjectOutput, self).alias_label(name, target)
+        self.label_names.add(name)
+
+    def inc(self, category, name, span=None):
+        if category not in self.variables:
+            # Declared by another object. Only the index is needed here, the linker gives it a value
+            index = self.undeclared.get(category, 0)
+            self.undeclared[category] = index + 1
+            self.incs.append((category, name, index))
+            self.variables[name] = index
+            return
+
+        base = self.bases.setdefault(category, self.variables[category])
+        self.incs.append((category, name, self.variables[category] - base))
+        super(ObjectOutput, self).inc(category, name, span)
+
+    def export(self, name):
+        self.exports[name] = None
+
+    def program_table(self, diagnostics):
+        # Returns (category, [(start, end)]), or (None, []) if the file doesn't start with a table
+        slots = {relocation.offset: relocation for relocation in self.relocations}
+        count = slots.get(0)
+        if count is None or count.width() != 8 or (count.symbol not in self.bases and count.symbol not in self.undeclared):
+            return None, []
+
+        programs = []
+        for idx in range(sum(1 for category, _, _ in self.incs if category == count.symbol)):
+            start = slots.get(8 + 16 * idx)
+            end = slots.get(16 + 16 * idx)
+            if start is None or end is None:
+                diagnostics.error(f"Every program in the table of an object file is written as dw @=(start) dw @=(end), but program {idx} isn't", count.span)
+                return None, []
+            programs.append((start.symbol, end.symbol))
+
+        return count.symbol, programs
+
+    def resolve_relocations(self, diagnostics):
+        table_category, programs = self.program_table(diagnostics)
+        table_size = 8 + 16 * len(programs) if table_category is not None else 0
+
+        inc_names = {variable for _, variable, _ in self.incs}
+        symbols = {}
+        for name, value in self.variables.items():
+            if name in self.label_names:
+                if value < table_size:
+                    diagnostics.error(f"Label {name} is inside the program table", None)
+                    continue
+                symbols[name] = (LABEL, value - table_size)
+            elif name not in inc_names and name not in self.bases:
+                symbols[name] = (DECLARED, value)
+
+        obj = ObjectFile(
+            bytes(self.output[table_size:]),
+            symbols,
+            dict(self.bases),
+            list(self.incs),
+            list(self.exports),
+            table_category,
+            programs,
+            [(relocation.offset - table_size, relocation.width(), relocation.symbol) for relocation in self.relocations if relocation.offset >= table_size],
+        )
+        defined = obj.defined()
+        for name in obj.exports:
+            if name not in defined:
+                diagnostics.error(f"Exported {name} isn't defined", None)
+
+        self.obj = obj
+        self.output = bytearray(obj.to_bytes())
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    arg_parser = argparse.ArgumentParser(description="Show the symbols, imports and relocations of an object file")
+    arg_parser.add_argument("input_path")
+    args = arg_parser.parse_args()
+
+    with open(args.input_path, "rb") as inp_f:
+        try:
+            obj = ObjectFile.from_bytes(inp_f.read())
+        except ObjectFormatError as e:
+            print(f"{args.input_path}: {e}")
+            sys.exit(1)
+
+    print(f"; {len(obj.code)} bytes of code")
+    if obj.table_category is not None:
+        print(f"; program table numbered by '{obj.table_category}'")
+        for idx, (start, end) in enumerate(obj.programs):
+            print(f";   {idx}: {start} - {end}")
+
+    exports = set(obj.exports)
+    for name, (kind, value) in obj.symbols.items():
+        kind_name = "label" if kind == LABEL else "declared"
+        print(f"{kind_name:<8} {value:>10} {name}{' (exported)' if name in exports else ''}")
+    for category, base in obj.bases.items():
+        print(f"category {base:>10} {category}")
+    for category, variable, index in obj.incs:
+        print(f"inc      {index:>10} {variable} in {category}{' (exported)' if variable in exports else ''}")
+    for name in obj.imports():
+        print(f"import              {name}")
+    for offset, width, symbol in obj.relocations:
+        print(f"reloc    {offset:>#10x} {symbol}")
@@ -0,0 +1,222 @@
+import struct
+
+from instructions import Instruction, INSTRUCTIONS_BY_MNEMONIC
+import values
+
+# Peephole optimizations between parse_instructions and compile_to_bytecode. Instructions are cut
+# into blocks at labels and at data (dw, ds), and every block is optimized on its own:
+#
+# - Register contents are tracked as symbolic values, so an instruction leaving its register as it
+#   was (a repeated set_float, copy rX rX, reloading the atom a register already holds with
+#   set_integer + integer_to_atom) is removed.
+# - A write that is overwritten before anything reads it is removed, as long as the instruction
+#   can't fail or has other effects.
+#
+# A program can start at any label, so nothing is known about the registers at the start of a
+# block, and a program can run on past a label, so every register counts as read after its end.
+# Labels are resolved after this pass, so they move with the removed instructions.
+
+N_REGISTERS = 256
+U64_MASK = (1 << 64) - 1
+
+def opcode_of(mnemonic):
+    return INSTRUCTIONS_BY_MNEMONIC[mnemonic].bytecode
+
+SET_SELF_ADDR = opcode_of("set_self_addr")
+SET_FLOAT = opcode_of("set_float")
+SET_INTEGER = opcode_of("set_integer")
+SET_STRING = opcode_of("set_string")
+COPY = opcode_of("copy")
+GENERATE_ATOM = opcode_of("generate_atom")
+INTEGER_TO_ATOM = opcode_of("integer_to_atom")
+
+INT_OPS = {
+    opcode_of("add_int"): lambda a, b: a + b,
+    opcode_of("sub_int"): lambda a, b: a - b,
+    opcode_of("mul_int"): lambda a, b: a * b,
+}
+FLOAT_OPS = {opcode_of(mnemonic) for mnemonic in ["add_float", "sub_float", "mul_float", "div_float"]}
+
+class OptimizerStats:
+    def __init__(self):
+        self.blocks = 0
+        self.instructions_in = 0
+        self.redundant = 0
+        self.dead_stores = 0
+        self.bytes_saved = 0
+
+    def counts(self):
+        return {
+            "blocks": self.blocks,
+            "redundant_removed": self.redundant,
+            "dead_stores_removed": self.dead_stores,
+            "bytes_saved": self.bytes_saved,
+        }
+
+    def __str__(self):
+        return f"OptimizerStats(blocks={self.blocks}, instructions_in={self.instructions_in}, redundant={self.redundant}, dead_stores={self.dead_stores}, bytes_saved={self.bytes_saved})"
+
+    __repr__ = __str__
+
+def instruction_size(inst):
+    return len(inst.bytecode) + sum(len(argument.get_bytecode()) for argument in inst.arguments)
+
+def is_code(inst):
+    # Pseudo-instructions and data end a block
+    return type(inst) is Instruction and len(inst.bytecode) > 0
+
+def register(inst, idx):
+    return inst.arguments[idx].inner.reg_idx
+
+def constant(argument):
+    # References are resolved later, but the same symbol always resolves to the same value
+    if isinstance(argument, values.Reference):
+        return ("ref", argument.symbol)
+    return argument.inner.value
+
+class Step:
+    # An instruction with the registers it reads and writes. Removable instructions have no effect
+    # but their write, and can't fail
+    def __init__(self, inst, reads, write, removable):
+        self.inst = inst
+        self.reads = reads
+        self.write = write
+        self.removable = removable
+
+class BlockOptimizer:
+    def __init__(self, stats):
+        self.stats = stats
+        self.state = {}
+        self.n_unknown = 0
+
+    def value_of(self, reg):
+        return self.state.get(reg, ("entry", reg))
+
+    def unknown(self):
+        self.n_unknown += 1
+        return ("unknown", self.n_unknown)
+
+    def evaluate(self, inst):
+        # Returns (step, value written or None)
+        op = inst.bytecode
+        if op == SET_SELF_ADDR:
+            return Step(inst, (), register(inst, 0), True), ("self",)
+        if op == SET_FLOAT:
+            bits = struct.pack("<d", inst.arguments[1].inner.value)
+            return Step(inst, (), register(inst, 0), True), ("float", bits)
+        if op == SET_INTEGER:
+            return Step(inst, (), register(inst, 0), True), ("int", constant(inst.arguments[1]))
+        if op == SET_STRING:
+            return Step(inst, (), register(inst, 0), True), ("str", inst.arguments[1].inner.value)
+        if op == COPY:
+            source = register(inst, 1)
+            return Step(inst, (source,), register(inst, 0), True), self.value_of(source)
+        if op == GENERATE_ATOM:
+            # Draws from the random generator, so never removable
+            return Step(inst, (), register(inst, 0), False), self.unknown()
+        if op == INTEGER_TO_ATOM:
+            reg = register(inst, 0)
+            value = self.value_of(reg)
+            if value[0] == "int":
+                return Step(inst, (reg,), reg, True), ("atom", value[1])
+            return Step(inst, (reg,), reg, False), self.unknown()
+
+        if op in INT_OPS:
+            dest, source = register(inst, 0), register(inst, 1)
+            dest_val, source_val = self.value_of(dest), self.value_of(source)
+            if dest_val[0] == "int" and source_val[0] == "int":
+                if type(dest_val[1]) is int and type(source_val[1]) is int:
+                    result = ("int", INT_OPS[op](dest_val[1], source_val[1]) & U64_MASK)
+                else:
+                    result = self.unknown()
+                return Step(inst, (dest, source), dest, True), result
+            return Step(inst, (dest, source), dest, False), self.unknown()
+
+        if op in FLOAT_OPS:
+            dest, source = register(inst, 0), register(inst, 1)
+            known = self.value_of(dest)[0] == "float" and self.value_of(source)[0] == "float"
+            return Step(inst, (dest, source), dest, known), self.unknown()
+
+        # send_message, add_handler and remove_handler only read registers
+        reads = tuple(argument.inner.reg_idx for argument in inst.arguments if isinstance(argument, values.Register))
+        return Step(inst, reads, None, False), None
+
+    def forward(self, block):
+        steps = []
+        idx = 0
+        while idx < len(block):
+            inst = block[idx]
+
+            # set_integer rN k + integer_to_atom rN is how an atom is loaded
+            if inst.bytecode == SET_INTEGER and idx + 1 < len(block):
+                following = block[idx + 1]
+                reg = register(inst, 0)
+                if following.bytecode == INTEGER_TO_ATOM and register(following, 0) == reg:
+                    atom = ("atom", constant(inst.arguments[1]))
+                    if self.value_of(reg) == atom:
+                        self.remove(inst)
+                        self.remove(following)
+                        self.stats.redundant += 2
+                    else:
+                        steps.append(Step(inst, (), reg, True))
+                        steps.append(Step(following, (reg,), reg, True))
+                        self.state[reg] = atom
+                    idx += 2
+                    continue
+
+            step, value = self.evaluate(inst)
+            if step.removable and step.write is not None and value == self.value_of(step.write):
+                self.remove(inst)
+                self.stats.redundant += 1
+            else:
+                steps.append(step)
+                if step.write is not None:
+                    self.state[step.write] = value
+            idx += 1
+
+        return steps
+
+    def backward(self, steps):
+        live = set(range(N_REGISTERS))
+        kept = []
+        for step in reversed(steps):
+            if step.removable and step.write is not None and step.write not in live:
+                self.remove(step.inst)
+                self.stats.dead_stores += 1
+                continue
+
+            if step.write is not None:
+                live.discard(step.write)
+            live.update(step.reads)
+            kept.append(step.inst)
+
+        kept.reverse()
+        return kept
+
+    def remove(self, inst):
+        self.stats.bytes_saved += instruction_size(inst)
+
+    def optimize(self, block):
+        return self.backward(self.forward(block))
+
+def optimize_instructions(instructions, stats=None):
+    # Streams like the other stages, holding back one block at a time
+    if stats is None:
+        stats = OptimizerStats()
+
+    block = []
+    for inst in instructions:
+        if is_code(inst):
+            block.append(inst)
+            stats.instructions_in += 1
+            continue
+
+        if len(block) > 0:
+            stats.blocks += 1
+            yield from BlockOptimizer(stats).optimize(block)
+            block = []
+        yield inst
+
+    if len(block) > 0:
+        stats.blocks += 1
+        yield from BlockOptimizer(stats).optimize(block)
@@ -0,0 +1,131 @@
+import cProfile
+import io
+import pstats
+import time
+import tracemalloc
+import types
+
+class StageRecord:
+    def __init__(self, name, wall_time, peak_memory, counts, profiler):
+        self.name = name
+        self.wall_time = wall_time
+        self.peak_memory = peak_memory
+        self.counts = counts
+        self.profiler = profiler
+
+    def to_json(self):
+        return {
+            "name": self.name,
+            "wall_time": self.wall_time,
+            "peak_memory": self.peak_memory,
+            "counts": self.counts,
+        }
+
+    def __str__(self):
+        return f"StageRecord(name={repr(self.name)}, wall_time={self.wall_time}, peak_memory={self.peak_memory}, counts={self.counts})"
+
+    __repr__ = __str__
+
+class NullInstrumentation:
+    # Runs stages as they are, so generator stages stay lazy and stream into each other
+    def stage(self, name, fn, counts=None):
+        return fn()
+
+NULL_INSTRUMENTATION = NullInstrumentation()
+
+class Instrumentation:
+    # Runs every stage to completion, collecting generator stages into lists, so each stage can be
+    # measured on its own
+    def __init__(self, trace_memory=True, profile=False):
+        self.trace_memory = trace_memory
+        self.profile = profile
+
+        self.stages = []
+
+    def stage(self, name, fn, counts=None):
+        started_tracing = False
+        memory_base = 0
+        if self.trace_memory:
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+                memory_base = tracemalloc.get_traced_memory()[0]
+            else:
+                tracemalloc.start()
+                started_tracing = True
+
+        profiler = cProfile.Profile() if self.profile else None
+
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+
+        result = fn()
+        if isinstance(result, types.GeneratorType):
+            result = list(result)
+
+        if profiler is not None:
+            profiler.disable()
+        wall_time = time.perf_counter() - start
+
+        peak_memory = None
+        if self.trace_memory:
+            peak_memory = tracemalloc.get_traced_memory()[1] - memory_base
+            if started_tracing:
+                tracemalloc.stop()
+
+        stage_counts = {}
+        if isinstance(result, list):
+            stage_counts["items"] = len(result)
+        if counts is not None:
+            stage_counts.update(counts(result))
+
+        self.stages.append(StageRecord(name, wall_time, peak_memory, stage_counts, profiler))
+        return result
+
+    def total_time(self):
+        return sum(stage.wall_time for stage in self.stages)
+
+    def slowest_stage(self):
+        if len(self.stages) == 0:
+            return None
+        return max(self.stages, key=lambda stage: stage.wall_time)
+
+    def to_json(self):
+        return {
+            "stages": [stage.to_json() for stage in self.stages],
+            "total_time": self.total_time(),
+        }
+
+    def format_report(self):
+        lines = [f"{'stage':<22} {'time (ms)':>10} {'peak mem (kB)':>14}  counts"]
+        for stage in self.stages:
+            peak = "-" if stage.peak_memory is None else f"{stage.peak_memory / 1024:.1f}"
+            counts = ", ".join(f"{name}={value}" for name, value in stage.counts.items())
+            lines.append(f"{stage.name:<22} {stage.wall_time * 1000:>10.2f} {peak:>14}  {counts}")
+        lines.append(f"{'total':<22} {self.total_time() * 1000:>10.2f}")
+
+        return "\n".join(lines)
+
+    def slowest_profile_report(self, n_lines=25):
+        stage = self.slowest_stage()
+        if stage is None or stage.profiler is None:
+            return None
+
+        stream = io.StringIO()
+        stream.write(f"Profile of slowest stage {stage.name}\n")
+        stats = pstats.Stats(stage.profiler, stream=stream)
+        stats.sort_stats("cumulative").print_stats(n_lines)
+        return stream.getvalue()
+
+    def dump_slowest_profile(self, path):
+        stage = self.slowest_stage()
+        if stage is None or stage.profiler is None:
+            return None
+
+        stage.profiler.dump_stats(path)
+        return stage
+
+    def __str__(self):
+        return f"Instrumentation(stages={self.stages})"
+
+    __repr__ = __str__
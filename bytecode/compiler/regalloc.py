@@ -0,0 +1,174 @@
+from instructions import Instruction
+from liveness import ControlFlow, COPY, is_virtual
+import tokenizer
+import values
+
+# Gives every virtual register (v_...) a physical register, between parse_instructions and the
+# optimizer. Two registers interfere when one is written while the other is live, except for the
+# source and destination of a copy, and virtual registers are colored greedily in the order they
+# are first used, onto the lowest register that doesn't interfere. A virtual register copied to or
+# from a register prefers that register, which turns the copy into copy rX rX, and those are
+# removed. Physical registers keep their meaning, so message arguments and presets that are read
+# in a block are live from its start and never handed out before their last use.
+#
+# Blocks without virtual registers are left as they are.
+
+N_REGISTERS = 256
+
+class AllocatorStats:
+    def __init__(self):
+        self.blocks = 0
+        self.virtual_registers = 0
+        self.registers_used = set()
+        self.copies_removed = 0
+
+    def counts(self):
+        return {
+            "blocks": self.blocks,
+            "virtual_registers": self.virtual_registers,
+            "registers_used": len(self.registers_used),
+            "copies_removed": self.copies_removed,
+        }
+
+    def __str__(self):
+        return f"AllocatorStats(blocks={self.blocks}, virtual_registers={self.virtual_registers}, registers_used={len(self.registers_used)}, copies_removed={self.copies_removed})"
+
+    __repr__ = __str__
+
+class BlockAllocator:
+    def __init__(self, block, diagnostics, stats):
+        self.block = block
+        self.diagnostics = diagnostics
+        self.stats = stats
+
+        # Where every virtual register is first used, in order
+        self.first_use = {}
+        for inst in block.instructions:
+            for argument in inst.arguments:
+                if isinstance(argument, values.VirtualRegister):
+                    self.first_use.setdefault(argument.inner.name, argument.inner.span)
+
+        self.interference = {name: set() for name in self.first_use}
+        self.hints = {name: [] for name in self.first_use}
+        self.assignment = {}
+
+    def check(self):
+        ok = True
+        for access in self.block.accesses:
+            for argument in access.pins:
+                if isinstance(argument, values.VirtualRegister):
+                    self.diagnostics.error("Preset register index can't be a virtual register", argument.inner.span)
+                    ok = False
+
+        for name in self.block.live_in:
+            if is_virtual(name):
+                self.diagnostics.error(f"Virtual register {name} is read before it is set", self.first_use[name])
+                ok = False
+
+        return ok
+
+    def interfere(self, a, b):
+        if is_virtual(a):
+            self.interference[a].add(b)
+        if is_virtual(b):
+            self.interference[b].add(a)
+
+    def build(self):
+        for access, live in zip(self.block.accesses, self.block.live_after):
+            for write in access.writes:
+                for other in live:
+                    if other != write and other != access.copy_source:
+                        self.interfere(write, other)
+
+            if access.copy_source is not None:
+                dest, source = access.writes[0], access.copy_source
+                if is_virtual(dest):
+                    self.hints[dest].append(source)
+                if is_virtual(source):
+                    self.hints[source].append(dest)
+
+    def color(self):
+        for name, span in self.first_use.items():
+            taken = set()
+            for other in self.interference[name]:
+                if not is_virtual(other):
+                    taken.add(other)
+                elif other in self.assignment:
+                    taken.add(self.assignment[other])
+
+            reg = None
+            for hint in self.hints[name]:
+                hinted = self.assignment.get(hint) if is_virtual(hint) else hint
+                if hinted is not None and hinted not in taken:
+                    reg = hinted
+                    break
+
+            if reg is None:
+                reg = next((idx for idx in range(N_REGISTERS) if idx not in taken), None)
+                if reg is None:
+                    self.diagnostics.error(f"No register left for {name}", span)
+                    return False
+
+            self.assignment[name] = reg
+            self.stats.registers_used.add(reg)
+
+        self.stats.virtual_registers += len(self.assignment)
+        return True
+
+    def physical(self, argument):
+        if not isinstance(argument, values.VirtualRegister):
+            return argument
+        token = tokenizer.RegisterToken(argument.inner.span, self.assignment[argument.inner.name])
+        return values.Register(token)
+
+    def rewrite(self):
+        instructions = []
+        for inst in self.block.instructions:
+            if not has_virtual(inst):
+                instructions.append(inst)
+                continue
+
+            inst = Instruction(inst.bytecode, [self.physical(argument) for argument in inst.arguments], inst.span)
+            if inst.bytecode == COPY and inst.arguments[0].inner.reg_idx == inst.arguments[1].inner.reg_idx:
+                self.stats.copies_removed += 1
+                continue
+            instructions.append(inst)
+
+        self.block.instructions = instructions
+
+    def drop_virtual(self):
+        # After an error, like an instruction that doesn't parse
+        self.block.instructions = [inst for inst in self.block.instructions if not has_virtual(inst)]
+
+    def allocate(self):
+        self.stats.blocks += 1
+        if not self.check():
+            self.drop_virtual()
+            return
+
+        self.build()
+        if self.color():
+            self.rewrite()
+        else:
+            self.drop_virtual()
+
+def has_virtual(inst):
+    return any(isinstance(argument, values.VirtualRegister) for argument in inst.arguments)
+
+def allocate_registers(instructions, diagnostics, stats=None, live_out=frozenset()):
+    # Liveness runs backward from the end of a chain of blocks, so unlike the other stages this
+    # one holds on to every instruction before passing them on. live_out is what is live after the
+    # instructions, for when they are only a part of a file
+    if stats is None:
+        stats = AllocatorStats()
+
+    instructions = list(instructions)
+    if not any(has_virtual(inst) for inst in instructions):
+        return instructions
+
+    flow = ControlFlow(instructions, live_out)
+    for block in flow.blocks:
+        if block.has_virtual():
+            BlockAllocator(block, diagnostics, stats).allocate()
+
+    return list(flow.instructions())
@@ -1,72 +1,106 @@
+from bisect import bisect_right
+from functools import lru_cache
+
 SPAN_COL = "\033[38;5;9m"
 RESET_COL = "\033[0m"
 
 def lpad(st, wanted_len, pad_ch=" "):
     return pad_ch * (wanted_len - len(st)) + st
 
+class Source:
+    def __init__(self, text, name=None):
+        self.text = text
+        # The path of the file, if it came from one other than the one being assembled
+        self.name = name
+
+        self.line_starts = [0]
+        idx = text.find("\n")
+        while idx != -1:
+            self.line_starts.append(idx + 1)
+            idx = text.find("\n", idx + 1)
+
+    def __len__(self):
+        return len(self.text)
+
+    def n_lines(self):
+        return len(self.line_starts)
+
+    def line_of(self, offset):
+        return bisect_right(self.line_starts, offset) - 1
+
+    def line_start(self, line_idx):
+        return self.line_starts[line_idx]
+
+    def line(self, line_idx):
+        start = self.line_starts[line_idx]
+        if line_idx + 1 < len(self.line_starts):
+            return self.text[start:self.line_starts[line_idx + 1] - 1]
+        return self.text[start:]
+
+    def line_col(self, offset):
+        line_idx = self.line_of(offset)
+        return line_idx, offset - self.line_starts[line_idx]
+
+    def __str__(self):
+        return f"Source(name={repr(self.name)}, length={len(self.text)}, lines={len(self.line_starts)})"
+
+    __repr__ = __str__
+
+@lru_cache(maxsize=64)
+def intern_source(text):
+    return Source(text)
+
+def as_source(source):
+    if isinstance(source, Source):
+        return source
+    return intern_source(source)
+
 class Span:
     def __init__(self, start, end, source):
         self.start = start
         self.end = end
-        self.source = source
-        self.source_lines = source.split("\n")
+        self.source = as_source(source)
 
     def combine(self, other):
-        if self.end == other.start and self.source_lines == other.source_lines:
+        if self.end == other.start and self.source is other.source:
             return Span(self.start, other.end, self.source)
         else:
             raise ValueError(f"Incompatible spans: {self} and {other}")
 
     def combine_nonadjacent(self, other):
-        if self.source_lines == other.source_lines:
+        if self.source is other.source:
             return Span(self.start, other.end, self.source)
         else:
             raise ValueError(f"Incompatible spans: {self} and {other}")
 
     def __str__(self):
-        return f"Span(start={self.start}, end={self.end}, source hash={hex(hash(self.source))})"
+        return f"Span(start={self.start}, end={self.end}, source hash={hex(hash(self.source.text))})"
 
     __repr__ = __str__
 
     def get(self):
-        return self.source[self.start:self.end]
+        return self.source.text[self.start:self.end]
 
     def print_aa(self):
-        # Find start line
-        line_start = 0
-        for i, line in enumerate(self.source_lines):
-            line += "\n"
-            if line_start + len(line) > self.start:
-                start_line = i
-                break
-
-            line_start += len(line)
-
-        # Find start line
-        line_end = 0
-        end_line = len(self.source_lines) - 1
-        for i, line in enumerate(self.source_lines):
-            line += "\n"
-
-            line_end += len(line)
-            if line_end > self.end:
-                end_line = i
-                break
+        source = self.source
 
+        start_line = source.line_of(self.start)
+        end_line = source.line_of(self.end)
 
-        offset_into_first_line = self.start - line_start
-        offset_into_last_line = self.end - line_end + len(self.source_lines[end_line])
+        offset_into_first_line = self.start - source.line_start(start_line)
+        offset_into_last_line = self.end - source.line_start(end_line) - 1
 
         linenr_len = len(str(end_line))
 
-        print(SPAN_COL + f"  At self.source_lines {start_line+1}-{end_line+1}")
+        of_file = f" of {source.name}" if source.name is not None else ""
+        print(SPAN_COL + f"  At lines {start_line+1}-{end_line+1}{of_file}")
 
         if start_line == end_line:
             print(
                 SPAN_COL +
                 lpad(str(start_line+1), linenr_len) +
                 " │",
-                RESET_COL + self.source_lines[start_line]
+                RESET_COL + source.line(start_line)
             )
             if offset_into_first_line == offset_into_last_line:
                 print(
@@ -98,7 +132,7 @@ class Span:
                     lpad(str(line_idx+1), linenr_len) +
                     " │",
                     RESET_COL +
-                    self.source_lines[line_idx]
+                    source.line(line_idx)
                 )
             print(
                 SPAN_COL +
@@ -1,20 +1,22 @@
 from abc import ABC, abstractmethod
+import re
 
-from span import Span
+from span import Span, as_source
 
 class ParseInput:
     def __init__(self, file_cont, cursor=0):
-        self.file_cont = file_cont
+        self.source = as_source(file_cont)
+        self.file_cont = self.source.text
         self.cursor = cursor
 
     def peek(self):
         if self.cursor == len(self.file_cont):
-            return Span(self.cursor, self.cursor, self.file_cont)
-        return Span(self.cursor, self.cursor + 1, self.file_cont)
+            return Span(self.cursor, self.cursor, self.source)
+        return Span(self.cursor, self.cursor + 1, self.source)
 
     def pop(self):
         span = self.peek()
-        return (span, ParseInput(self.file_cont, span.end))
+        return (span, ParseInput(self.source, span.end))
 
 class ParseException(Exception):
     def __init__(self, reason, span):
@@ -86,7 +88,7 @@ def take_while0(fn):
 
             return span, inp
         else:
-            return Span(inp.cursor, inp.cursor, inp.file_cont), inp
+            return Span(inp.cursor, inp.cursor, inp.source), inp
 
     return parse_one
 
@@ -95,7 +97,7 @@ parse_spaces = take_while0(lambda x: x in " \n")
 NONBREAKING_CHARS = "abcdefghijklmnopqrstuvwxyz_0123456789"
 def parse_spaces1(inp):
     if inp.peek().get() not in NONBREAKING_CHARS:
-        return Span(inp.cursor, inp.cursor, inp.file_cont), inp
+        return Span(inp.cursor, inp.cursor, inp.source), inp
 
     return take_while(lambda x: x in " \n", "Expected space")(inp)
 
@@ -120,6 +122,9 @@ def spaced_light(parse_fn):
 
     return parse_one
 
+# Integers are written as unsigned 64-bit values
+INTEGER_LIMIT = 1 << 64
+
 parse_int = map_res(
     lambda span: (span, int(span.get())),
     take_while(lambda x: x in "0123456789", "Expected integer")
@@ -130,7 +135,8 @@ def find_exact(st):
         if inp.file_cont[inp.cursor:inp.cursor + len(st)] == st:
             span, inp = inp.pop()
             for _ in range(len(st) - 1):
-                span, inp = span.combine(inp.pop())
+                next, inp = inp.pop()
+                span = span.combine(next)
             return span, inp
         raise ParseException(f"Expected {st}", inp.peek())
 
@@ -203,6 +209,25 @@ class RegisterToken(Token):
     def __repr__(self):
         return f"RegisterToken(reg_idx={self.reg_idx})"
 
+class VirtualRegisterToken(Token):
+    # A register named v_<name>, given a physical register by the register allocator
+    def __init__(self, span, name):
+        super(VirtualRegisterToken, self).__init__(span)
+        self.name = name
+
+    PREFIX = find_exact("v_")
+    PARSE_NAME = take_while(lambda ch: ch in NONBREAKING_CHARS, "Expected register name")
+    @spaced
+    def parse_one(inp):
+        span, inp = VirtualRegisterToken.PREFIX(inp)
+        nspan, inp = VirtualRegisterToken.PARSE_NAME(inp)
+
+        span = span.combine(nspan)
+        return VirtualRegisterToken(span, span.get()), inp
+
+    def __repr__(self):
+        return f"VirtualRegisterToken(name={repr(self.name)})"
+
 class CommentToken(Token):
     CommentTokenStart = find_exact(";")
     UntilEOL = take_while(lambda x: x != "\n", "Expected newline")
@@ -231,6 +256,8 @@ class Char(Token):
     }
     def parse_one(inp):
         ch, inp = inp.pop()
+        if ch.get() == '':
+            raise ParseException("Unexpected end of file", ch)
         if ch.get() == '\\':
             next, inp = inp.pop()
             if next.get() in Char.ESCAPE_TABLE:
@@ -278,6 +305,8 @@ class IntegerToken(Token):
     @spaced
     def parse_one(inp):
         (span, number), inp = parse_int(inp)
+        if number >= INTEGER_LIMIT:
+            raise ParseException("Integer doesn't fit in 64 bits", span)
 
         return IntegerToken(span, number), inp
 
@@ -296,10 +325,10 @@ class FloatToken(Token):
         # float is a valid float. '1e' is not a valid float
         longest_flength = 0
         value = None
-        for flength in range(1, len(inp.file_cont) - inp.cursor):
+        for flength in range(1, len(inp.file_cont) - inp.cursor + 1):
             try:
                 st = inp.file_cont[inp.cursor:inp.cursor+flength]
-                if " " in st or "\n" in st:
+                if st[-1].isspace():
                     raise ValueError()
                 value = float(st)
                 if "." in st:
@@ -308,10 +337,10 @@ class FloatToken(Token):
                 break
 
         if longest_flength == 0:
-            raise ParseException("Expected float", Span(inp.cursor, inp.cursor + 1, inp.file_cont))
+            raise ParseException("Expected float", Span(inp.cursor, inp.cursor + 1, inp.source))
 
-        span = Span(inp.cursor, inp.cursor + longest_flength, inp.file_cont)
-        inp.cursor += longest_flength
+        span = Span(inp.cursor, inp.cursor + longest_flength, inp.source)
+        inp = ParseInput(inp.source, inp.cursor + longest_flength)
 
         return FloatToken(span, value), inp
 
@@ -319,7 +348,7 @@ class FloatToken(Token):
         return f"FloatToken(value={self.value})"
 
 priority_order = [
-    MacroToken, MacroEndToken, RegisterToken, FloatToken, IntegerToken, StringToken, AssemblyInstructionToken, CommentToken,
+    MacroToken, MacroEndToken, RegisterToken, VirtualRegisterToken, FloatToken, IntegerToken, StringToken, AssemblyInstructionToken, CommentToken,
 ]
 
 def parse_one(inp):
@@ -333,17 +362,183 @@ def parse_one(inp):
 
     raise furthest_exception
 
-def parse_all(inp):
-    _, inp = parse_spaces(inp)
-    if inp.cursor == len(inp.file_cont):
-        return []
+USE_COMBINATOR_LEXER = False
+
+RE_NON_SPACES = re.compile(r"[^ \n]*")
+
+def recover(exception, diagnostics, text, pos):
+    # Without diagnostics the error is fatal. Otherwise it's recorded and lexing resumes at the
+    # next space
+    if diagnostics is None:
+        raise exception
 
-    thing, inp  = parse_one(inp)
-    rest = parse_all(inp)
-    return [thing] + rest
+    diagnostics.error(exception.reason, exception.span)
+    return max(RE_NON_SPACES.match(text, pos).end(), pos + 1)
+
+def parse_all_combinator(inp, diagnostics=None):
+    while True:
+        _, inp = parse_spaces(inp)
+        if inp.cursor == len(inp.file_cont):
+            return
+
+        try:
+            thing, inp = parse_one(inp)
+        except ParseException as e:
+            inp = ParseInput(inp.source, recover(e, diagnostics, inp.file_cont, inp.cursor))
+            continue
+        yield thing
+
+# Single-pass lexer. Dispatches on the first character of each token to the few token classes that
+# could start with it, tried in the same priority as priority_order. Anything the fast lexers
+# can't handle is handed to the combinator parse_one, which produces the error message.
+
+RE_SPACES = re.compile(r"[ \n]*")
+RE_MACRO = re.compile(r"@([a-z_=]+)\(")
+RE_REGISTER = re.compile(r"r([0-9]+)")
+RE_VIRTUAL_REGISTER = re.compile(r"v_[a-z0-9_]+")
+RE_FLOAT = re.compile(r"[0-9]+\.[0-9]*")
+RE_INTEGER = re.compile(r"[0-9]+")
+RE_STRING = re.compile(r"'((?:[^'\\]|\\[nt\\'])*)'")
+RE_STRING_ESCAPE = re.compile(r"\\(.)")
+RE_INSTRUCTION = re.compile(r"[a-z_]+")
+RE_COMMENT = re.compile(r";[^\n]+")
+
+def is_token_end(text, pos):
+    return pos == len(text) or text[pos] not in NONBREAKING_CHARS
+
+def lex_macro(text, pos, source):
+    m = RE_MACRO.match(text, pos)
+    if m is None:
+        return None
+    span = Span(pos, m.end(1), source)
+    return MacroToken(span, m.group(1)), RE_SPACES.match(text, m.end()).end()
+
+def lex_macro_end(text, pos, source):
+    return MacroEndToken(Span(pos, pos + 1, source)), RE_SPACES.match(text, pos + 1).end()
+
+def lex_register(text, pos, source):
+    m = RE_REGISTER.match(text, pos)
+    if m is None or not is_token_end(text, m.end()):
+        return None
+    reg_idx = int(m.group(1))
+    if not 0 <= reg_idx < 256:
+        return None
+    return RegisterToken(Span(pos, m.end(), source), reg_idx), m.end()
+
+def lex_virtual_register(text, pos, source):
+    m = RE_VIRTUAL_REGISTER.match(text, pos)
+    if m is None or not is_token_end(text, m.end()):
+        return None
+    return VirtualRegisterToken(Span(pos, m.end(), source), m.group()), m.end()
+
+def lex_float(text, pos, source):
+    m = RE_FLOAT.match(text, pos)
+    if m is None or not is_token_end(text, m.end()):
+        return None
+    return FloatToken(Span(pos, m.end(), source), float(m.group())), m.end()
+
+def lex_integer(text, pos, source):
+    m = RE_INTEGER.match(text, pos)
+    if m is None or not is_token_end(text, m.end()):
+        return None
+    value = int(m.group())
+    if value >= INTEGER_LIMIT:
+        return None
+    return IntegerToken(Span(pos, m.end(), source), value), m.end()
+
+def unescape_string(inner):
+    # The value of a string literal, given what is between its quotes
+    return RE_STRING_ESCAPE.sub(lambda esc: Char.ESCAPE_TABLE[esc.group(1)], inner)
+
+def lex_string(text, pos, source):
+    m = RE_STRING.match(text, pos)
+    if m is None or not is_token_end(text, m.end()):
+        return None
+    return StringToken(Span(pos, m.end(), source), unescape_string(m.group(1))), m.end()
+
+def lex_instruction(text, pos, source):
+    m = RE_INSTRUCTION.match(text, pos)
+    if m is None or not is_token_end(text, m.end()):
+        return None
+    return AssemblyInstructionToken(Span(pos, m.end(), source), m.group()), m.end()
+
+def lex_comment(text, pos, source):
+    m = RE_COMMENT.match(text, pos)
+    if m is None or not is_token_end(text, m.end()):
+        return None
+    return CommentToken(Span(pos, m.end(), source)), m.end()
+
+LEXER_DISPATCH = {}
+for ch in "abcdefghijklmnopqrstuvwxyz_":
+    LEXER_DISPATCH[ch] = (lex_instruction,)
+LEXER_DISPATCH["r"] = (lex_register, lex_instruction)
+LEXER_DISPATCH["v"] = (lex_virtual_register, lex_instruction)
+for ch in "0123456789":
+    LEXER_DISPATCH[ch] = (lex_float, lex_integer)
+LEXER_DISPATCH["@"] = (lex_macro,)
+LEXER_DISPATCH[")"] = (lex_macro_end,)
+LEXER_DISPATCH["'"] = (lex_string,)
+LEXER_DISPATCH[";"] = (lex_comment,)
+
+def lex_all(inp, diagnostics=None):
+    source = inp.source
+    text = source.text
+    pos = inp.cursor
+
+    while True:
+        pos = RE_SPACES.match(text, pos).end()
+        if pos == len(text):
+            return
+
+        for lexer in LEXER_DISPATCH.get(text[pos], ()):
+            lexed = lexer(text, pos, source)
+            if lexed is not None:
+                break
+        else:
+            try:
+                token, rest = parse_one(ParseInput(source, pos))
+            except ParseException as e:
+                pos = recover(e, diagnostics, text, pos)
+                continue
+            lexed = token, rest.cursor
+
+        token, pos = lexed
+        yield token
+
+def parse_all(inp, combinator=None, diagnostics=None):
+    if combinator is None:
+        combinator = USE_COMBINATOR_LEXER
+
+    if combinator:
+        return parse_all_combinator(inp, diagnostics)
+    return lex_all(inp, diagnostics)
+
+def token_key(token):
+    return (type(token).__name__, token.span.start, token.span.end, repr(token))
+
+def lexer_differences(file_cont):
+    fast = [token_key(token) for token in parse_all(ParseInput(file_cont), combinator=False)]
+    combinator = [token_key(token) for token in parse_all(ParseInput(file_cont), combinator=True)]
+
+    differences = []
+    for idx in range(max(len(fast), len(combinator))):
+        fast_key = fast[idx] if idx < len(fast) else None
+        combinator_key = combinator[idx] if idx < len(combinator) else None
+        if fast_key != combinator_key:
+            differences.append((idx, fast_key, combinator_key))
+
+    return differences
 
 if __name__ == "__main__":
-    inp_text = open("../test_1.dig").read()
+    import sys
+
+    paths = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    inp_text = open(paths[0] if len(paths) > 0 else "../examples/test_1.dig").read()
+    if "--differential" in sys.argv[1:]:
+        for idx, fast_key, combinator_key in lexer_differences(inp_text):
+            print(f"Token {idx}: fast={fast_key} combinator={combinator_key}")
+        sys.exit()
+
     inp_pi = ParseInput(inp_text)
     try:
         for thing in parse_all(inp_pi):
@@ -1,37 +1,256 @@
 from abc import ABC, abstractmethod
 
-import random
-
 import struct
 
 import tokenizer
 
-class CompileOutput:
+class Relocation:
+    def __init__(self, offset, fmt, symbol, span):
+        self.offset = offset
+        self.fmt = fmt
+        self.symbol = symbol
+        self.span = span
+
+    def width(self):
+        return struct.calcsize(self.fmt)
+
+    def __str__(self):
+        return f"Relocation(offset={self.offset}, fmt={repr(self.fmt)}, symbol={repr(self.symbol)})"
+
+    __repr__ = __str__
+
+class ConstantPool:
+    # Constants stored once in the output, keyed by constant_key, with where the stored copy is.
+    # Every use of a copy instead of a new one is counted with the bytes it saved
     def __init__(self):
-        self.output = b''
+        self.entries = {}
+
+        self.shared = 0
+        self.bytes_saved = 0
+
+    def lookup(self, key):
+        return self.entries.get(key)
+
+    def add(self, key, entry):
+        self.entries[key] = entry
+
+    def share(self, size):
+        self.shared += 1
+        self.bytes_saved += size
+
+    def counts(self):
+        return {"constants": len(self.entries), "shared": self.shared, "bytes_saved": self.bytes_saved}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        return f"ConstantPool(constants={len(self.entries)}, shared={self.shared}, bytes_saved={self.bytes_saved})"
+
+    __repr__ = __str__
+
+class DataRun:
+    # dw's and ds's written one after another, starting at a label
+    def __init__(self, labels, start, n_relocations):
+        self.labels = labels
+        self.start = start
+        self.n_relocations = n_relocations
+        self.values = []
+
+    def key(self):
+        keys = tuple(constant_key(value) for value in self.values)
+        return None if None in keys else ("run",) + keys
 
-        self.tracked_ids = {}
+    def __str__(self):
+        return f"DataRun(labels={self.labels}, start={self.start}, values={len(self.values)})"
+
+    __repr__ = __str__
+
+class CompileOutput:
+    # With share_data, a run of dw and ds that repeats an earlier one is left out and the labels
+    # naming it point at the earlier copy instead. A run starts at a label and goes on up to the
+    # next label or instruction, and is only shared when all of it matches, since anything reading
+    # from the label can read all of it. Only data named by labels that are free to move is
+    # shared. A label in pinned, like the start or end of a program in the table, is a position in
+    # the file and not just a pointer to the data after it, so data at a pinned label is always
+    # written
+    def __init__(self, share_data=False, debug=False):
+        self.output = bytearray()
+
+        self.relocations = []
         self.variables = {}
+        # (category, span) of every @inc of a category that wasn't declared
+        self.undeclared = []
+
+        # With debug, (position, relocations before it, span) of every instruction, see debugmap.py
+        self.marks = [] if debug else None
+
+        self.share_data = share_data
+        self.constants = ConstantPool()
+        self.pinned = set()
+        # Labels defined at the current position, and the run of data being written
+        self.labels_here = []
+        self.run = None
 
     def write_bytes(self, b):
         addr = len(self.output)
-        self.output = self.output + b
+        self.output += b
+        if len(b) > 0:
+            self.labels_here = []
 
         return addr
 
+    def write_integer(self, value):
+        self.write_bytes(struct.pack("Q", value))
+
+    def write_float(self, value):
+        self.write_bytes(struct.pack("d", value))
+
+    def write_string(self, text):
+        enc_bytes = text.encode("utf-8")
+        self.write_bytes(struct.pack("Q", len(enc_bytes)) + enc_bytes)
+
+    def write_opcode(self, bytecode):
+        self.end_data_run()
+        self.write_bytes(bytecode)
+
+    def write_data(self, value):
+        # dw and ds. The data is written right away, and taken back by end_data_run if its run turns
+        # out to repeat an earlier one
+        if self.share_data:
+            if self.run is None and len(self.labels_here) > 0:
+                self.run = DataRun(self.labels_here, len(self.output), len(self.relocations))
+            if self.run is not None:
+                self.run.values.append(value)
+
+        value.compile_to_bytecode(self)
+
+    def end_data_run(self):
+        run = self.run
+        if run is None:
+            return
+        self.run = None
+
+        key = run.key()
+        if key is None:
+            return
+        shared = self.constants.lookup(key)
+        if shared is None:
+            self.constants.add(key, run.labels[0])
+            return
+        if not self.pinned.isdisjoint(run.labels):
+            return
+
+        self.truncate(run.start, run.n_relocations)
+        for name in run.labels:
+            self.alias_label(name, shared)
+        self.constants.share(sum(self.encoded_size(value) for value in run.values))
+
+    def truncate(self, position, n_relocations):
+        # Takes back everything written since position. Instructions marked since then now write
+        # nothing, see debugmap.py
+        del self.output[position:]
+        del self.relocations[n_relocations:]
+        if self.marks is not None:
+            for idx in range(len(self.marks) - 1, -1, -1):
+                mark_position, n_before, span = self.marks[idx]
+                if mark_position < position or (mark_position == position and n_before <= n_relocations):
+                    break
+                self.marks[idx] = (position, n_relocations, span)
+
+    def encoded_size(self, value):
+        return len(value.get_bytecode())
+
+    def define_label(self, name):
+        self.end_data_run()
+        self.variables[name] = len(self.output)
+        self.labels_here.append(name)
+
+    def mark(self, span):
+        self.marks.append((len(self.output), len(self.relocations), span))
+
+    def debug_entries(self):
+        # (offset in the file, span) of every instruction, once relocations are resolved
+        return [(position, span) for position, _, span in self.marks]
+
+    def alias_label(self, name, target):
+        self.variables[name] = self.variables[target]
+
+    def declare(self, name, value):
+        self.variables[name] = value
+
+    def inc(self, category, name, span=None):
+        if category not in self.variables:
+            # Reported by resolve_relocations. The category counts from 0 so that the variables
+            # it numbers are still defined
+            self.undeclared.append((category, span))
+            self.variables[category] = 0
+
+        self.variables[name] = self.variables[category]
+        self.variables[category] += 1
+
+    def report_undeclared(self, diagnostics):
+        for category, span in self.undeclared:
+            diagnostics.error(f"Category {category} is never declared", span)
+
+    def export(self, name):
+        # Only object files (see objfile.py) have anything to export to
+        pass
+
     def override_inside(self, at, b):
-        self.output = self.output[:at] + b + self.output[at+len(b):]
+        self.output[at:at+len(b)] = b
+
+    def patch(self, fmt, at, *values):
+        struct.pack_into(fmt, self.output, at, *values)
+
+    def add_relocation(self, fmt, symbol, span):
+        # Reserves a zeroed slot at the current position, filled in by resolve_relocations
+        relocation = Relocation(len(self.output), fmt, symbol, span)
+        self.write_bytes(bytes(relocation.width()))
+        self.relocations.append(relocation)
+
+        return relocation
+
+    def resolve_relocations(self, diagnostics):
+        self.report_undeclared(diagnostics)
+        for relocation in self.relocations:
+            if relocation.symbol not in self.variables:
+                diagnostics.error("Variable not found", relocation.span)
+                continue
+
+            self.patch(relocation.fmt, relocation.offset, self.variables[relocation.symbol])
+
+    def counts(self):
+        return {
+            "bytes": len(self.output),
+            "relocations": len(self.relocations),
+            "constants_shared": self.constants.shared,
+            "bytes_saved": self.constants.bytes_saved,
+        }
+
+    def relocation_section(self):
+        # [count:8] then for every relocation [offset:8] [width:1] [symbol:string]
+        section = bytearray(struct.pack("Q", len(self.relocations)))
+        for relocation in self.relocations:
+            enc_symbol = relocation.symbol.encode("utf-8")
+            section += struct.pack("QB", relocation.offset, relocation.width())
+            section += struct.pack("Q", len(enc_symbol)) + enc_symbol
+
+        return bytes(section)
+
+    def getvalue(self):
+        # No copy is made. The output can't grow while the returned view is alive
+        return memoryview(self.output)
 
     def __str__(self):
         return f"CompileOutput(output={self.output})"
 
     def __repr__(self):
-        return f"CompileOutput(output={self.output}, tracked_ids={self.tracked_ids}, variables={self.variables})"
+        return f"CompileOutput(output={self.output}, relocations={self.relocations}, variables={self.variables})"
 
 class Value(ABC):
     def __init__(self, inner):
         self.inner = inner
-        self.track_id = random.getrandbits(64)
 
     @abstractmethod
     def __repr__(self):
@@ -41,14 +260,16 @@ class Value(ABC):
         return repr(self)
 
     def compile_to_bytecode(self, output):
-        addr = output.write_bytes(self.get_bytecode())
-        output.tracked_ids[self.track_id] = addr
+        output.write_bytes(self.get_bytecode())
 
     @abstractmethod
     def get_bytecode(self):
         pass
 
 class String(Value):
+    def compile_to_bytecode(self, output):
+        output.write_string(self.inner.value)
+
     def get_bytecode(self):
         enc_bytes = self.inner.value.encode("utf-8")
         return struct.pack("Q", len(enc_bytes)) + enc_bytes
@@ -57,13 +278,30 @@ class String(Value):
         return f"String(inner={repr(self.inner)})"
 
 class Integer(Value):
+    def compile_to_bytecode(self, output):
+        output.write_integer(self.inner.value)
+
     def get_bytecode(self):
         return struct.pack("Q", self.inner.value)
 
     def __repr__(self):
         return f"Integer(inner={repr(self.inner)})"
 
+class Reference(Integer):
+    def __init__(self, inner, symbol):
+        super(Reference, self).__init__(inner)
+        self.symbol = symbol
+
+    def compile_to_bytecode(self, output):
+        output.add_relocation("Q", self.symbol, self.inner.span)
+
+    def __repr__(self):
+        return f"Reference(symbol={repr(self.symbol)})"
+
 class Float(Value):
+    def compile_to_bytecode(self, output):
+        output.write_float(self.inner.value)
+
     def get_bytecode(self):
         return struct.pack("d", self.inner.value)
 
@@ -77,6 +315,27 @@ class Register(Value):
     def __repr__(self):
         return f"Register(inner={repr(self.inner)})"
 
+class VirtualRegister(Register):
+    # Replaced by a Register by regalloc.allocate_registers
+    def get_bytecode(self):
+        raise ValueError(f"Virtual register {self.inner.name} was never allocated")
+
+    def __repr__(self):
+        return f"VirtualRegister(inner={repr(self.inner)})"
+
+def constant_key(value):
+    # Constants with the same key are written the same way. A reference always resolves to the
+    # same value, so it is keyed by its symbol
+    if isinstance(value, Reference):
+        return ("ref", value.symbol)
+    if isinstance(value, Float):
+        return ("float", struct.pack("<d", value.inner.value))
+    if isinstance(value, Integer):
+        return ("int", value.inner.value)
+    if isinstance(value, String):
+        return ("string", value.inner.value)
+    return None
+
 def upgrade(value):
     if isinstance(value, tokenizer.StringToken):
         return String(value)
@@ -90,4 +349,7 @@ def upgrade(value):
     if isinstance(value, tokenizer.RegisterToken):
         return Register(value)
 
+    if isinstance(value, tokenizer.VirtualRegisterToken):
+        return VirtualRegister(value)
+
     return value
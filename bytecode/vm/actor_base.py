@@ -0,0 +1,115 @@
+import struct
+
+from data import VMError
+from interpreter import DECODERS, CompactEncoding, build_decoders, read_varint
+from program_cache import ProgramCache, DEFAULT_PROGRAM_CACHE
+
+# Compact v2 files start with the magic and a version byte, see vm.txt
+COMPACT_MAGIC = b"\xffACT"
+COMPACT_VERSION = 2
+
+class ParseActorBaseError(Exception):
+    UNEXPECTED_EOF = "UnexpectedEOF"
+    PROGRAM_OUT_OF_RANGE = "ProgramOutOfRange"
+    UNSUPPORTED_VERSION = "UnsupportedVersion"
+
+    def __init__(self, kind, detail=None):
+        super(ParseActorBaseError, self).__init__()
+        self.kind = kind
+        self.detail = detail
+
+    def __str__(self):
+        return f"ParseActorBaseError({self.kind}, {self.detail})"
+
+    __repr__ = __str__
+
+def check_program_range(code, start, end):
+    if start >= len(code):
+        raise ParseActorBaseError(ParseActorBaseError.PROGRAM_OUT_OF_RANGE, start)
+    if end > len(code):
+        raise ParseActorBaseError(ParseActorBaseError.PROGRAM_OUT_OF_RANGE, end)
+
+def parse_varint(code, pos):
+    try:
+        return read_varint(code, pos, len(code))
+    except VMError:
+        raise ParseActorBaseError(ParseActorBaseError.UNEXPECTED_EOF)
+
+class ActorBase:
+    # An actor base file: [n_programs:8] then n_programs pairs of [start:8] [end:8], or a compact
+    # v2 file with a string pool and varints, see vm.txt. strings is the pool of a v2 file, and
+    # None for v1
+    def __init__(self, code, programs, strings=None):
+        self.code = code
+        self.programs = programs
+        self.strings = strings
+        self.digest = ProgramCache.digest(code)
+
+    def parse(data):
+        code = bytes(data)
+        if code.startswith(COMPACT_MAGIC):
+            return ActorBase.parse_compact(code)
+
+        if len(code) < 8:
+            raise ParseActorBaseError(ParseActorBaseError.UNEXPECTED_EOF)
+        (n_programs,) = struct.unpack_from("<Q", code, 0)
+
+        if 8 + 16 * n_programs > len(code):
+            raise ParseActorBaseError(ParseActorBaseError.UNEXPECTED_EOF)
+
+        programs = []
+        for idx in range(n_programs):
+            start, end = struct.unpack_from("<QQ", code, 8 + 16 * idx)
+            check_program_range(code, start, end)
+            programs.append((start, end))
+
+        return ActorBase(code, programs)
+
+    def parse_compact(code):
+        pos = len(COMPACT_MAGIC)
+        if pos >= len(code):
+            raise ParseActorBaseError(ParseActorBaseError.UNEXPECTED_EOF)
+        if code[pos] != COMPACT_VERSION:
+            raise ParseActorBaseError(ParseActorBaseError.UNSUPPORTED_VERSION, code[pos])
+        pos += 1
+
+        n_strings, pos = parse_varint(code, pos)
+        strings = []
+        for _ in range(n_strings):
+            length, pos = parse_varint(code, pos)
+            if pos + length > len(code):
+                raise ParseActorBaseError(ParseActorBaseError.UNEXPECTED_EOF)
+            strings.append(code[pos:pos + length])
+            pos += length
+
+        n_programs, pos = parse_varint(code, pos)
+        programs = []
+        for _ in range(n_programs):
+            start, pos = parse_varint(code, pos)
+            end, pos = parse_varint(code, pos)
+            check_program_range(code, start, end)
+            programs.append((start, end))
+
+        return ActorBase(code, programs, strings)
+
+    def load(path):
+        with open(path, "rb") as f:
+            return ActorBase.parse(f.read())
+
+    def decoders(self):
+        if self.strings is None:
+            return DECODERS
+        return build_decoders(CompactEncoding(self.strings))
+
+    def decoded_programs(self, cache=None):
+        # Every program of the base, decoded up front. Bases with the same code share one decoding
+        # through the cache
+        if cache is None:
+            cache = DEFAULT_PROGRAM_CACHE
+        return cache.get(self)
+
+    def __str__(self):
+        version = 1 if self.strings is None else COMPACT_VERSION
+        return f"ActorBase(size={len(self.code)}, version={version}, programs={self.programs})"
+
+    __repr__ = __str__
@@ -0,0 +1,71 @@
+U64_MASK = (1 << 64) - 1
+
+class Data:
+    # Register contents, the Data enum from vm.txt. Instances are immutable, so registers and
+    # messages can share them freely
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.value == other.value
+
+    def __hash__(self):
+        return hash((type(self).__name__, self.value))
+
+    def __repr__(self):
+        return f"{type(self).__name__}({repr(self.value)})"
+
+    __str__ = __repr__
+
+class ActorAddr(Data):
+    __slots__ = ()
+
+    def __repr__(self):
+        return f"@{self.value:x}"
+
+class Integer(Data):
+    __slots__ = ()
+
+class Float(Data):
+    __slots__ = ()
+
+class String(Data):
+    __slots__ = ()
+
+class Atom(Data):
+    __slots__ = ()
+
+    def __repr__(self):
+        return f"Atom(0x{self.value:x})"
+
+ZERO = Integer(0)
+
+class VMError(Exception):
+    OUT_OF_BOUNDS = "OutOfBounds"
+    NO_SUCH_INSTRUCTION = "NoSuchInstruction"
+    WRONG_VALUE_TYPE = "WrongValueType"
+    INVALID_UTF8 = "InvalidUTF8Error"
+
+    def __init__(self, kind, detail=None):
+        super(VMError, self).__init__()
+        self.kind = kind
+        self.detail = detail
+
+    def __eq__(self, other):
+        return isinstance(other, VMError) and (self.kind, self.detail) == (other.kind, other.detail)
+
+    def __hash__(self):
+        return hash((self.kind, repr(self.detail)))
+
+    def __reduce__(self):
+        # Errors are pickled when they are sent between processes
+        return (VMError, (self.kind, self.detail))
+
+    def __str__(self):
+        if self.detail is None:
+            return f"VMError({self.kind})"
+        return f"VMError({self.kind}({repr(self.detail)}))"
+
+    __repr__ = __str__
@@ -0,0 +1,328 @@
+import math
+import struct
+
+from data import U64_MASK, ActorAddr, Integer, Float, String, Atom, VMError
+
+# Programs are decoded once into a tuple of closures, one per instruction, with the operands
+# already bound. Running a program is then a loop calling each closure, with no parsing of the
+# bytestream. How integers and strings are read depends on the format of the file, see Encoding.
+
+def read_u8(code, pos, end):
+    if pos >= end:
+        raise VMError(VMError.OUT_OF_BOUNDS)
+    return code[pos], pos + 1
+
+def read_u64(code, pos, end):
+    if pos + 8 > end:
+        raise VMError(VMError.OUT_OF_BOUNDS)
+    return struct.unpack_from("<Q", code, pos)[0], pos + 8
+
+def read_f64(code, pos, end):
+    if pos + 8 > end:
+        raise VMError(VMError.OUT_OF_BOUNDS)
+    return struct.unpack_from("<d", code, pos)[0], pos + 8
+
+def read_varint(code, pos, end):
+    # LEB128, at most 64 bits
+    value = 0
+    shift = 0
+    while shift < 64:
+        if pos >= end:
+            raise VMError(VMError.OUT_OF_BOUNDS)
+        byte = code[pos]
+        value |= (byte & 0x7f) << shift
+        pos += 1
+        if byte < 0x80:
+            return value & U64_MASK, pos
+        shift += 7
+    raise VMError(VMError.OUT_OF_BOUNDS)
+
+def decode_utf8(raw):
+    try:
+        return raw.decode("utf-8")
+    except UnicodeDecodeError:
+        raise VMError(VMError.INVALID_UTF8, raw)
+
+def read_str(code, pos, end):
+    length, pos = read_u64(code, pos, end)
+    if pos + length > end:
+        raise VMError(VMError.OUT_OF_BOUNDS)
+
+    return decode_utf8(bytes(code[pos:pos + length])), pos + length
+
+class Encoding:
+    # The v1 format: integers are 8 bytes and strings are length-prefixed
+    def read_int(self, code, pos, end):
+        return read_u64(code, pos, end)
+
+    def read_string(self, code, pos, end):
+        return read_str(code, pos, end)
+
+class CompactEncoding(Encoding):
+    # The compact v2 format: integers are varints and strings are varint indices into the string
+    # pool at the start of the file
+    def __init__(self, strings):
+        self.strings = strings
+
+    def read_int(self, code, pos, end):
+        return read_varint(code, pos, end)
+
+    def read_string(self, code, pos, end):
+        idx, pos = read_varint(code, pos, end)
+        if idx >= len(self.strings):
+            raise VMError(VMError.OUT_OF_BOUNDS)
+        return decode_utf8(self.strings[idx]), pos
+
+class Handler:
+    def __init__(self, program_idx, presets, atom_name):
+        self.program_idx = program_idx
+        self.presets = presets
+        self.atom_name = atom_name
+
+    def __eq__(self, other):
+        return isinstance(other, Handler) and \
+            (self.program_idx, self.presets, self.atom_name) == (other.program_idx, other.presets, other.atom_name)
+
+    def __str__(self):
+        return f"Handler(program_idx={self.program_idx}, presets={self.presets}, atom_name={repr(self.atom_name)})"
+
+    __repr__ = __str__
+
+def ieee_div(a, b):
+    # Python raises on division by zero where the Rust VM follows IEEE 754
+    if b == 0.0:
+        if a == 0.0 or math.isnan(a):
+            return math.nan
+        return math.copysign(math.inf, a) * math.copysign(1.0, b)
+    return a / b
+
+def make_raise(error):
+    # The program is shared by every actor running it, so every run raises an error of its own
+    # instead of piling tracebacks onto one instance
+    kind, detail = error.kind, error.detail
+
+    def run(regs, ctx):
+        raise VMError(kind, detail)
+    return run
+
+def make_set_self_addr(dest):
+    def run(regs, ctx):
+        regs[dest] = ctx.self_addr
+    return run
+
+def make_set_const(dest, value):
+    def run(regs, ctx):
+        regs[dest] = value
+    return run
+
+def make_copy(dest, source):
+    def run(regs, ctx):
+        regs[dest] = regs[source]
+    return run
+
+def make_generate_atom(dest):
+    def run(regs, ctx):
+        regs[dest] = Atom(ctx.rng.getrandbits(64))
+    return run
+
+def make_integer_to_atom(reg):
+    def run(regs, ctx):
+        value = regs[reg]
+        if type(value) is not Integer:
+            raise VMError(VMError.WRONG_VALUE_TYPE, value)
+        regs[reg] = Atom(value.value)
+    return run
+
+def make_int_op(op):
+    def make(dest, source):
+        def run(regs, ctx):
+            source_val = regs[source]
+            if type(source_val) is not Integer:
+                raise VMError(VMError.WRONG_VALUE_TYPE, source_val)
+            dest_val = regs[dest]
+            if type(dest_val) is not Integer:
+                raise VMError(VMError.WRONG_VALUE_TYPE, dest_val)
+            regs[dest] = Integer(op(dest_val.value, source_val.value) & U64_MASK)
+        return run
+
+    return make
+
+def make_float_op(op):
+    def make(dest, source):
+        def run(regs, ctx):
+            source_val = regs[source]
+            if type(source_val) is not Float:
+                raise VMError(VMError.WRONG_VALUE_TYPE, source_val)
+            dest_val = regs[dest]
+            if type(dest_val) is not Float:
+                raise VMError(VMError.WRONG_VALUE_TYPE, dest_val)
+            regs[dest] = Float(op(dest_val.value, source_val.value))
+        return run
+
+    return make
+
+def make_send_message(receiver, delay, atom, arguments):
+    def run(regs, ctx):
+        to = regs[receiver]
+        if type(to) is not ActorAddr:
+            raise VMError(VMError.WRONG_VALUE_TYPE, to)
+        atom_val = regs[atom]
+        if type(atom_val) is not Atom:
+            raise VMError(VMError.WRONG_VALUE_TYPE, atom_val)
+
+        ctx.send_message(to, regs[delay], atom_val, [regs[reg] for reg in arguments])
+    return run
+
+def make_add_handler(atom, program_idx, atom_name, presets):
+    def run(regs, ctx):
+        atom_val = regs[atom]
+        if type(atom_val) is not Atom:
+            raise VMError(VMError.WRONG_VALUE_TYPE, atom_val)
+
+        ctx.add_handler(atom_val, Handler(program_idx, [(idx, regs[reg]) for idx, reg in presets], atom_name))
+    return run
+
+def make_remove_handler(atom):
+    def run(regs, ctx):
+        atom_val = regs[atom]
+        if type(atom_val) is not Atom:
+            raise VMError(VMError.WRONG_VALUE_TYPE, atom_val)
+
+        ctx.remove_handler(atom_val)
+    return run
+
+def float_value_reader(encoding):
+    def read(code, pos, end):
+        value, pos = read_f64(code, pos, end)
+        return Float(value), pos
+    return read
+
+def integer_value_reader(encoding):
+    def read(code, pos, end):
+        value, pos = encoding.read_int(code, pos, end)
+        return Integer(value), pos
+    return read
+
+def string_value_reader(encoding):
+    def read(code, pos, end):
+        value, pos = encoding.read_string(code, pos, end)
+        return String(value), pos
+    return read
+
+# Operand layouts: r = register, f = imm-8 float, i = integer, s = string. Immediates are turned
+# into register values at decode time.
+LAYOUT_READERS = {
+    "r": lambda encoding: read_u8,
+    "f": float_value_reader,
+    "i": integer_value_reader,
+    "s": string_value_reader,
+}
+
+# Every decoder is built for an Encoding, and reads one instruction after its opcode
+
+def make_layout_decoder(layout, make_inst):
+    def build(encoding):
+        readers = [LAYOUT_READERS[ch](encoding) for ch in layout]
+        def decode(code, pos, end):
+            operands = []
+            for reader in readers:
+                operand, pos = reader(code, pos, end)
+                operands.append(operand)
+            return make_inst(*operands), pos
+
+        return decode
+
+    return build
+
+def send_message_decoder(encoding):
+    read_int = encoding.read_int
+    def decode(code, pos, end):
+        receiver, pos = read_u8(code, pos, end)
+        delay, pos = read_u8(code, pos, end)
+        atom, pos = read_u8(code, pos, end)
+        n_arguments, pos = read_int(code, pos, end)
+
+        arguments = []
+        for _ in range(n_arguments):
+            reg, pos = read_u8(code, pos, end)
+            arguments.append(reg)
+
+        return make_send_message(receiver, delay, atom, tuple(arguments)), pos
+
+    return decode
+
+def add_handler_decoder(encoding):
+    read_int = encoding.read_int
+    def decode(code, pos, end):
+        atom, pos = read_u8(code, pos, end)
+        program_idx, pos = read_int(code, pos, end)
+        str_ref, pos = read_int(code, pos, end)
+        atom_name, _ = encoding.read_string(code, str_ref, len(code))
+        n_presets, pos = read_int(code, pos, end)
+
+        presets = []
+        for _ in range(n_presets):
+            idx, pos = read_u8(code, pos, end)
+            reg, pos = read_u8(code, pos, end)
+            presets.append((idx, reg))
+
+        return make_add_handler(atom, program_idx, atom_name, tuple(presets)), pos
+
+    return decode
+
+OPCODES = \
+    [ (0x00, "set_self_addr", make_layout_decoder("r", make_set_self_addr))
+    , (0x01, "set_float", make_layout_decoder("rf", make_set_const))
+    , (0x02, "set_integer", make_layout_decoder("ri", make_set_const))
+    , (0x03, "set_string", make_layout_decoder("rs", make_set_const))
+    , (0x04, "copy", make_layout_decoder("rr", make_copy))
+    , (0x05, "generate_atom", make_layout_decoder("r", make_generate_atom))
+    , (0x06, "integer_to_atom", make_layout_decoder("r", make_integer_to_atom))
+
+    , (0x10, "add_int", make_layout_decoder("rr", make_int_op(lambda a, b: a + b)))
+    , (0x11, "sub_int", make_layout_decoder("rr", make_int_op(lambda a, b: a - b)))
+    , (0x12, "mul_int", make_layout_decoder("rr", make_int_op(lambda a, b: a * b)))
+
+    , (0x20, "add_float", make_layout_decoder("rr", make_float_op(lambda a, b: a + b)))
+    , (0x21, "sub_float", make_layout_decoder("rr", make_float_op(lambda a, b: a - b)))
+    , (0x22, "mul_float", make_layout_decoder("rr", make_float_op(lambda a, b: a * b)))
+    , (0x23, "div_float", make_layout_decoder("rr", make_float_op(ieee_div)))
+
+    , (0x80, "send_message", send_message_decoder)
+    , (0x81, "add_handler", add_handler_decoder)
+    , (0x82, "remove_handler", make_layout_decoder("r", make_remove_handler))
+    ]
+
+MNEMONICS = {opcode: mnemonic for opcode, mnemonic, _ in OPCODES}
+
+def build_decoders(encoding):
+    decoders = [None] * 256
+    for opcode, _, build in OPCODES:
+        decoders[opcode] = build(encoding)
+    return decoders
+
+DECODERS = build_decoders(Encoding())
+
+def decode_program(code, start, end, decoders=DECODERS):
+    # A decoding error becomes an instruction raising it, so everything before it still runs, like
+    # when the bytecode is interpreted directly
+    program = []
+    pos = start
+    while pos < end:
+        decoder = decoders[code[pos]]
+        if decoder is None:
+            program.append(make_raise(VMError(VMError.NO_SUCH_INSTRUCTION, code[pos])))
+            break
+
+        try:
+            inst, pos = decoder(code, pos + 1, end)
+        except VMError as e:
+            program.append(make_raise(e))
+            break
+        program.append(inst)
+
+    return tuple(program)
+
+def run_program(program, regs, ctx):
+    for inst in program:
+        inst(regs, ctx)
@@ -0,0 +1,52 @@
+import hashlib
+from collections import OrderedDict
+
+from interpreter import decode_program
+
+DEFAULT_MAX_BASES = 256
+
+class ProgramCache:
+    # Decoded programs of actor bases, keyed by a digest of the base's code so that bases loaded
+    # more than once share one decoding. The least recently used bases are evicted once more than
+    # max_bases are cached.
+    def __init__(self, max_bases=DEFAULT_MAX_BASES):
+        self.max_bases = max_bases
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def digest(code):
+        return hashlib.blake2b(code, digest_size=16).digest()
+
+    def get(self, base):
+        programs = self.entries.get(base.digest)
+        if programs is not None:
+            self.entries.move_to_end(base.digest)
+            self.hits += 1
+            return programs
+
+        self.misses += 1
+        decoders = base.decoders()
+        programs = tuple(decode_program(base.code, start, end, decoders) for start, end in base.programs)
+        self.entries[base.digest] = programs
+
+        while len(self.entries) > self.max_bases:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+        return programs
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        return f"ProgramCache(bases={len(self.entries)}, hits={self.hits}, misses={self.misses}, evictions={self.evictions})"
+
+    __repr__ = __str__
+
+DEFAULT_PROGRAM_CACHE = ProgramCache()
@@ -0,0 +1,276 @@
+import random
+from collections import deque
+
+from data import ZERO, ActorAddr, Integer, Float, Atom, VMError
+from interpreter import Handler, run_program
+from timers import TimerWheel, WallClock
+
+class Message:
+    __slots__ = ("to", "atom", "data", "delay")
+
+    def __init__(self, to, atom, data, delay=None):
+        self.to = to
+        self.atom = atom
+        self.data = data
+        self.delay = delay
+
+    def __str__(self):
+        return f"Message(to={self.to}, atom={self.atom}, data={self.data}, delay={self.delay})"
+
+    __repr__ = __str__
+
+def delay_seconds(delay):
+    # The delay register of a send_message, in seconds. Registers start out as Integer(0), so
+    # anything that isn't a positive number means no delay
+    if type(delay) is Float or type(delay) is Integer:
+        if delay.value > 0:
+            return delay.value
+    return 0
+
+class ExecContext:
+    # What a running handler can see and do. Effects are collected and applied by the runtime once
+    # the handler is done
+    def __init__(self, self_addr, rng):
+        self.self_addr = self_addr
+        self.rng = rng
+
+        self.sent = []
+        self.handler_changes = {}
+
+    def send_message(self, to, delay, atom, data):
+        self.sent.append(Message(to, atom, data, delay))
+
+    def add_handler(self, atom, handler):
+        self.handler_changes[atom] = handler
+
+    def remove_handler(self, atom):
+        self.handler_changes[atom] = None
+
+class Actor:
+    # An actor running bytecode from an actor base, like Dactor in src/actors/dactor.rs
+    def __init__(self, base, addr, program_cache=None):
+        self.base = base
+        self.addr = addr
+        self.handlers = {}
+
+        self.programs = base.decoded_programs(program_cache)
+
+    def start(self, rng):
+        # Like Dactor::new, program 0 runs without an address and messages it sends are dropped
+        ctx = ExecContext(ActorAddr(0), rng)
+        error = self.run_handler(Handler(0, [], "start-all"), [], ctx)
+        self.apply_handler_changes(ctx.handler_changes)
+        return error
+
+    def run_handler(self, handler, data, ctx):
+        if handler.program_idx >= len(self.programs):
+            return VMError(VMError.OUT_OF_BOUNDS, handler.program_idx)
+
+        regs = [ZERO] * 256
+        for idx, value in handler.presets:
+            regs[idx] = value
+        for idx, value in enumerate(data):
+            regs[idx] = value
+
+        try:
+            run_program(self.programs[handler.program_idx], regs, ctx)
+        except VMError as e:
+            return e
+        return None
+
+    def apply_handler_changes(self, handler_changes):
+        for atom, handler in handler_changes.items():
+            if handler is None:
+                self.handlers.pop(atom, None)
+            else:
+                self.handlers[atom] = handler
+
+    def handle_message(self, message, runtime):
+        handler = self.handlers.get(message.atom)
+        if handler is None:
+            return
+
+        ctx = ExecContext(self.addr, runtime.rng)
+        error = self.run_handler(handler, message.data, ctx)
+
+        # Effects from before an error still happen
+        for sent in ctx.sent:
+            runtime.deliver(sent)
+        self.apply_handler_changes(ctx.handler_changes)
+
+        if error is not None:
+            runtime.errors.append((self.addr, message.atom, error))
+
+    def __str__(self):
+        return f"Actor(addr={self.addr}, handlers={self.handlers})"
+
+    __repr__ = __str__
+
+class NativeActor:
+    # An actor implemented in Python. handle_fn(message, runtime) is called for every message
+    def __init__(self, addr, handle_fn):
+        self.addr = addr
+        self.handle_fn = handle_fn
+
+    def handle_message(self, message, runtime):
+        self.handle_fn(message, runtime)
+
+class Runtime:
+    # A single-threaded scheduler delivering messages in the order they were sent. Delayed
+    # messages wait in a timer wheel until they are due, and are then delivered in order after the
+    # messages already queued. With a VirtualClock, waiting for them takes no time
+    def __init__(self, seed=None, program_cache=None, clock=None):
+        self.rng = random.Random(seed)
+        self.program_cache = program_cache
+        self.clock = WallClock() if clock is None else clock
+        self.actors = {}
+        self.queue = deque()
+        self.timers = TimerWheel()
+
+        self.delivered = 0
+        self.dropped = 0
+        self.delayed = 0
+        self.errors = []
+
+    def new_addr(self):
+        while True:
+            addr = ActorAddr(self.rng.getrandbits(32))
+            if addr not in self.actors:
+                return addr
+
+    def spawn(self, base, addr=None):
+        if addr is None:
+            addr = self.new_addr()
+        actor = Actor(base, addr, self.program_cache)
+        error = actor.start(self.rng)
+        if error is not None:
+            self.errors.append((actor.addr, Atom(0), error))
+
+        self.actors[actor.addr] = actor
+        return actor.addr
+
+    def add_native_actor(self, handle_fn):
+        actor = NativeActor(self.new_addr(), handle_fn)
+        self.actors[actor.addr] = actor
+        return actor.addr
+
+    def deliver(self, message):
+        delay = delay_seconds(message.delay)
+        if delay > 0:
+            self.timers.insert(self.clock.now() + delay, message)
+            self.delayed += 1
+        else:
+            self.route(message)
+
+    def deliver_many(self, messages):
+        now = self.clock.now()
+        delayed = []
+        for message in messages:
+            delay = delay_seconds(message.delay)
+            if delay > 0:
+                delayed.append((now + delay, message))
+            else:
+                self.route(message)
+
+        self.timers.insert_many(delayed)
+        self.delayed += len(delayed)
+
+    def route(self, message):
+        # Queues a message that is due
+        self.queue.append(message)
+
+    def release_due(self):
+        for message in self.timers.pop_due(self.clock.now()):
+            self.route(message)
+
+    def send(self, to, atom, data=(), delay=None):
+        self.deliver(Message(to, atom, list(data), delay))
+
+    def step_once(self):
+        if len(self.timers) > 0 and self.timers.next_due() <= self.clock.now():
+            self.release_due()
+        if len(self.queue) == 0:
+            return False
+
+        message = self.queue.popleft()
+        actor = self.actors.get(message.to)
+        if actor is None:
+            self.dropped += 1
+        else:
+            self.delivered += 1
+            actor.handle_message(message, self)
+        return True
+
+    def run(self, max_messages=None, wait=True):
+        # With wait, sleeps until the next delayed message is due when there is nothing else to do,
+        # so only stops once no messages are left at all
+        handled = 0
+        while max_messages is None or handled < max_messages:
+            if not self.step_once():
+                if not wait or len(self.timers) == 0:
+                    break
+                self.clock.sleep_until(self.timers.next_due())
+                continue
+            handled += 1
+
+        return handled
+
+    def __str__(self):
+        return f"Runtime(actors={len(self.actors)}, queued={len(self.queue)}, waiting={len(self.timers)}, delivered={self.delivered}, dropped={self.dropped}, errors={len(self.errors)})"
+
+    __repr__ = __str__
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    from actor_base import ActorBase
+    from timers import VirtualClock
+
+    PRINT_ATOM = Atom(1)
+
+    arg_parser = argparse.ArgumentParser(description="Run an actor base in the Python VM")
+    arg_parser.add_argument("actor_base", help="Path to an .act file")
+    arg_parser.add_argument(
+        "--send",
+        action="append",
+        default=[],
+        help="Atom to send to the actor, e.g. 0x333302. Append ',reply' to pass a printing actor's address and atom as arguments",
+    )
+    arg_parser.add_argument("--repeat", type=int, default=1, help="Send the messages this many times")
+    arg_parser.add_argument("--delay", type=float, default=None, help="Delay in seconds for the sent messages")
+    arg_parser.add_argument("--virtual-time", action="store_true", help="Simulate delays instead of waiting for them")
+    arg_parser.add_argument("--seed", type=int, default=None)
+    arg_parser.add_argument("-q", "--quiet", action="store_true", help="Don't print replies")
+    args = arg_parser.parse_args()
+
+    clock = VirtualClock() if args.virtual_time else None
+    runtime = Runtime(args.seed, clock=clock)
+    clock_start = runtime.clock.now()
+    actor_addr = runtime.spawn(ActorBase.load(args.actor_base))
+
+    def print_reply(message, runtime):
+        if not args.quiet:
+            print(f"Got {message.atom} {message.data}")
+    printer_addr = runtime.add_native_actor(print_reply)
+
+    messages = []
+    for spec in args.send:
+        atom_text, _, option = spec.partition(",")
+        data = [printer_addr, PRINT_ATOM] if option == "reply" else []
+        messages.append((Atom(int(atom_text, 0)), data))
+
+    delay = None if args.delay is None else Float(args.delay)
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for atom, data in messages:
+            runtime.send(actor_addr, atom, data, delay)
+            runtime.run()
+    duration = time.perf_counter() - start
+
+    for addr, atom, error in runtime.errors:
+        print(f"Handler for {atom} on {addr} received error: {error}")
+    rate = runtime.delivered / duration if duration > 0 else 0
+    print(f"{runtime.delivered} messages delivered, {runtime.dropped} dropped in {duration:.3f} s ({rate:.0f} messages/s)")
+    if runtime.delayed > 0:
+        print(f"{runtime.delayed} messages delayed, {runtime.clock.now() - clock_start:.3f} s of {'simulated' if args.virtual_time else 'wall'} time")
@@ -0,0 +1,514 @@
+import multiprocessing
+import queue
+import random
+import struct
+import time
+from multiprocessing import shared_memory
+
+from data import ActorAddr, Integer, Float, String, Atom
+from actor_base import ActorBase
+from runtime import Message, NativeActor, Runtime
+from timers import TimerWheel, DEFAULT_RESOLUTION
+
+# A simulation runtime running actors in several processes. Actors are sharded by address, every
+# shard is a Runtime with its own mailbox, and messages to actors on other shards go through
+# shared memory ring buffers, one per pair of shards. Delayed messages wait in the timer wheel of
+# the sending shard, and a shard with nothing to do sleeps until it is sent something or its next
+# timer is due. Shards always run on the wall clock.
+
+DEFAULT_RING_CAPACITY = 1 << 20
+BATCH_SIZE = 256
+RETRY_INTERVAL = 0.001
+POLL_INTERVAL = 0.05
+PARENT_CHECK_INTERVAL = 1.0
+
+def shard_of(addr, n_shards):
+    return addr.value % n_shards
+
+RING_HEADER = struct.Struct("<QQ")
+RING_TAIL_OFFSET = 8
+RECORD_LENGTH = struct.Struct("<I")
+
+class RingBuffer:
+    # A single-producer single-consumer ring of length-prefixed records in shared memory. The
+    # header has the read position (head), written only by the consumer, and the write position
+    # (tail), written only by the producer. Both only ever grow. A position is published after the
+    # records it covers are written, so neither side ever sees a half-written record.
+    def __init__(self, shm):
+        self.shm = shm
+        self.capacity = shm.size - RING_HEADER.size
+
+    def create(capacity):
+        shm = shared_memory.SharedMemory(create=True, size=RING_HEADER.size + capacity)
+        RING_HEADER.pack_into(shm.buf, 0, 0, 0)
+        return RingBuffer(shm)
+
+    def attach(name):
+        return RingBuffer(shared_memory.SharedMemory(name=name))
+
+    def name(self):
+        return self.shm.name
+
+    def write_at(self, pos, data):
+        buf = self.shm.buf
+        offset = pos % self.capacity
+        first = min(len(data), self.capacity - offset)
+
+        start = RING_HEADER.size + offset
+        buf[start:start + first] = data[:first]
+        if first < len(data):
+            buf[RING_HEADER.size:RING_HEADER.size + len(data) - first] = data[first:]
+
+    def read_at(self, pos, length):
+        buf = self.shm.buf
+        offset = pos % self.capacity
+        first = min(length, self.capacity - offset)
+
+        start = RING_HEADER.size + offset
+        data = bytes(buf[start:start + first])
+        if first < length:
+            data += bytes(buf[RING_HEADER.size:RING_HEADER.size + length - first])
+        return data
+
+    def push_many(self, payloads):
+        # Writes as many of the payloads as fit and returns how many that was
+        head, tail = RING_HEADER.unpack_from(self.shm.buf, 0)
+
+        pushed = 0
+        for payload in payloads:
+            size = RECORD_LENGTH.size + len(payload)
+            if size > self.capacity:
+                raise ValueError(f"Message of {len(payload)} bytes doesn't fit in a ring of {self.capacity} bytes")
+            if size > self.capacity - (tail - head):
+                break
+
+            self.write_at(tail, RECORD_LENGTH.pack(len(payload)))
+            self.write_at(tail + RECORD_LENGTH.size, payload)
+            tail += size
+            pushed += 1
+
+        if pushed > 0:
+            struct.pack_into("<Q", self.shm.buf, RING_TAIL_OFFSET, tail)
+        return pushed
+
+    def pop_all(self):
+        head, tail = RING_HEADER.unpack_from(self.shm.buf, 0)
+
+        payloads = []
+        while head < tail:
+            (length,) = RECORD_LENGTH.unpack(self.read_at(head, RECORD_LENGTH.size))
+            payloads.append(self.read_at(head + RECORD_LENGTH.size, length))
+            head += RECORD_LENGTH.size + length
+
+        if len(payloads) > 0:
+            struct.pack_into("<Q", self.shm.buf, 0, head)
+        return payloads
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.close()
+        self.shm.unlink()
+
+# Messages in the rings: [to:8] [atom:8] [n_data:4], then per value a tag byte and an 8 byte
+# payload, or for strings an 8 byte length and the UTF-8 bytes
+MESSAGE_HEADER = struct.Struct("<QQI")
+TAGGED_U64 = struct.Struct("<BQ")
+TAGGED_F64 = struct.Struct("<Bd")
+
+VALUE_TYPES = [ActorAddr, Integer, Float, String, Atom]
+VALUE_TAGS = {value_type: tag for tag, value_type in enumerate(VALUE_TYPES)}
+TAG_FLOAT = VALUE_TAGS[Float]
+TAG_STRING = VALUE_TAGS[String]
+
+def encode_message(message):
+    parts = [MESSAGE_HEADER.pack(message.to.value, message.atom.value, len(message.data))]
+    for value in message.data:
+        tag = VALUE_TAGS[type(value)]
+        if tag == TAG_STRING:
+            raw = value.value.encode("utf-8")
+            parts.append(TAGGED_U64.pack(tag, len(raw)))
+            parts.append(raw)
+        elif tag == TAG_FLOAT:
+            parts.append(TAGGED_F64.pack(tag, value.value))
+        else:
+            parts.append(TAGGED_U64.pack(tag, value.value))
+
+    return b"".join(parts)
+
+def decode_message(payload):
+    to, atom, n_data = MESSAGE_HEADER.unpack_from(payload, 0)
+    pos = MESSAGE_HEADER.size
+
+    data = []
+    for _ in range(n_data):
+        if payload[pos] == TAG_FLOAT:
+            _, value = TAGGED_F64.unpack_from(payload, pos)
+            data.append(Float(value))
+            pos += TAGGED_F64.size
+        else:
+            tag, value = TAGGED_U64.unpack_from(payload, pos)
+            pos += TAGGED_U64.size
+            if tag == TAG_STRING:
+                data.append(String(payload[pos:pos + value].decode("utf-8")))
+                pos += value
+            else:
+                data.append(VALUE_TYPES[tag](value))
+
+    return Message(ActorAddr(to), Atom(atom), data)
+
+class Control:
+    # Counters in shared memory the coordinator uses to tell when the simulation is done. Every
+    # shard has a busy flag and counts the messages it has pushed to and popped from rings
+    FIELDS = 3
+
+    def __init__(self, n_shards):
+        self.n_shards = n_shards
+        self.values = multiprocessing.Array("q", self.FIELDS * n_shards + 1, lock=False)
+
+    def busy(self, shard):
+        return self.FIELDS * shard
+
+    def routed(self, shard):
+        return self.FIELDS * shard + 1
+
+    def received(self, shard):
+        return self.FIELDS * shard + 2
+
+    def stop_flag(self):
+        return self.FIELDS * self.n_shards
+
+    def snapshot(self):
+        return self.values[:self.FIELDS * self.n_shards]
+
+    def is_quiescent(self, snapshot):
+        busy = snapshot[0::self.FIELDS]
+        routed = snapshot[1::self.FIELDS]
+        received = snapshot[2::self.FIELDS]
+        return not any(busy) and sum(routed) == sum(received)
+
+class ShardConfig:
+    def __init__(self, shard_idx, n_shards, seed, resolution):
+        self.shard_idx = shard_idx
+        self.n_shards = n_shards
+        self.seed = seed
+        self.resolution = resolution
+
+        self.inbound = []
+        self.outbound = {}
+
+        self.spawns = []
+        self.sinks = []
+        self.messages = []
+
+class ShardResult:
+    def __init__(self, shard_idx, runtime):
+        self.shard_idx = shard_idx
+        self.actors = len(runtime.actors)
+        self.delivered = runtime.delivered
+        self.dropped = runtime.dropped
+        self.errors = runtime.errors
+        self.sunk = runtime.sunk
+        self.cross_sent = runtime.cross_sent
+        self.delayed = runtime.delayed
+        self.pending = len(runtime.queue) + len(runtime.timers)
+
+    def __str__(self):
+        return f"ShardResult(shard={self.shard_idx}, actors={self.actors}, delivered={self.delivered}, dropped={self.dropped}, errors={len(self.errors)}, cross_sent={self.cross_sent}, delayed={self.delayed}, pending={self.pending})"
+
+    __repr__ = __str__
+
+class ShardRuntime(Runtime):
+    def __init__(self, config, control, events, wake):
+        super(ShardRuntime, self).__init__(None if config.seed is None else config.seed + config.shard_idx)
+        self.shard_idx = config.shard_idx
+        self.n_shards = config.n_shards
+
+        self.control = control
+        self.events = events
+        self.wake = wake
+
+        self.inbound = [RingBuffer.attach(name) for name in config.inbound]
+        self.outbound = {shard: RingBuffer.attach(name) for shard, name in config.outbound.items()}
+        self.outgoing = {shard: [] for shard in config.outbound}
+        self.timers = TimerWheel(config.resolution)
+
+        self.sunk = []
+        self.cross_sent = 0
+
+        bases = {}
+        for addr, code in config.spawns:
+            base = bases.get(code)
+            if base is None:
+                base = bases[code] = ActorBase.parse(code)
+            # Addresses are handed out by the coordinator, so they land on the right shard
+            self.spawn(base, addr)
+        for addr in config.sinks:
+            self.actors[addr] = NativeActor(addr, self.sink)
+        self.deliver_many(config.messages)
+
+    def sink(self, message, runtime):
+        self.sunk.append(message)
+
+    def route(self, message):
+        shard = shard_of(message.to, self.n_shards)
+        if shard == self.shard_idx:
+            self.queue.append(message)
+        else:
+            self.outgoing[shard].append(encode_message(message))
+
+    def flush_outgoing(self):
+        # Returns whether everything was pushed. Whatever didn't fit is retried later rather than
+        # waited on, as the receiving shard might itself be waiting to push to us
+        flushed = True
+        for shard, payloads in self.outgoing.items():
+            if len(payloads) == 0:
+                continue
+
+            pushed = self.outbound[shard].push_many(payloads)
+            if pushed > 0:
+                del payloads[:pushed]
+                self.cross_sent += pushed
+                self.control.values[self.control.routed(self.shard_idx)] += pushed
+                self.events[shard].set()
+            if len(payloads) > 0:
+                flushed = False
+
+        return flushed
+
+    def receive(self):
+        received = 0
+        for ring in self.inbound:
+            for payload in ring.pop_all():
+                self.queue.append(decode_message(payload))
+                received += 1
+
+        if received > 0:
+            # Marked busy before the messages are counted, so the coordinator can't see them
+            # received by an idle shard
+            self.control.values[self.control.busy(self.shard_idx)] = 1
+            self.control.values[self.control.received(self.shard_idx)] += received
+        return received
+
+    def stopped(self):
+        return self.control.values[self.control.stop_flag()] != 0
+
+    def serve(self):
+        event = self.events[self.shard_idx]
+        while not self.stopped():
+            self.receive()
+            self.release_due()
+
+            self.run(BATCH_SIZE, wait=False)
+            flushed = self.flush_outgoing()
+            if len(self.queue) > 0:
+                continue
+
+            if flushed and len(self.timers) == 0:
+                self.control.values[self.control.busy(self.shard_idx)] = 0
+                self.wake.set()
+
+            # Anything sent or a stop after the clear sets the event again, so it can't be missed
+            event.clear()
+            if self.receive() > 0 or self.stopped():
+                continue
+
+            if not flushed:
+                timeout = RETRY_INTERVAL
+            elif len(self.timers) > 0:
+                timeout = min(max(0, self.timers.next_due() - self.clock.now()), PARENT_CHECK_INTERVAL)
+            else:
+                timeout = PARENT_CHECK_INTERVAL
+            if not event.wait(timeout) and not multiprocessing.parent_process().is_alive():
+                break
+
+    def close(self):
+        for ring in self.inbound:
+            ring.close()
+        for ring in self.outbound.values():
+            ring.close()
+
+def run_shard(config, control, events, wake, results):
+    runtime = ShardRuntime(config, control, events, wake)
+    try:
+        runtime.serve()
+    finally:
+        runtime.close()
+        results.put(ShardResult(config.shard_idx, runtime))
+
+class SimulationResult:
+    def __init__(self, shards, duration, timed_out):
+        self.shards = sorted(shards, key=lambda shard: shard.shard_idx)
+        self.duration = duration
+        self.timed_out = timed_out
+
+        self.delivered = sum(shard.delivered for shard in self.shards)
+        self.dropped = sum(shard.dropped for shard in self.shards)
+        self.cross_sent = sum(shard.cross_sent for shard in self.shards)
+        self.delayed = sum(shard.delayed for shard in self.shards)
+        self.errors = [error for shard in self.shards for error in shard.errors]
+        self.sunk = [message for shard in self.shards for message in shard.sunk]
+
+    def __str__(self):
+        return f"SimulationResult(shards={len(self.shards)}, delivered={self.delivered}, dropped={self.dropped}, cross_sent={self.cross_sent}, delayed={self.delayed}, errors={len(self.errors)}, timed_out={self.timed_out})"
+
+    __repr__ = __str__
+
+class ShardedRuntime:
+    # Sets up a simulation and runs it until no shard has anything left to do. Actors and initial
+    # messages are added before run() and handed to the shards when they start
+    def __init__(self, n_shards, seed=None, ring_capacity=DEFAULT_RING_CAPACITY, resolution=DEFAULT_RESOLUTION):
+        self.n_shards = n_shards
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.ring_capacity = ring_capacity
+
+        self.configs = [ShardConfig(idx, n_shards, seed, resolution) for idx in range(n_shards)]
+        self.addrs = set()
+
+    def new_addr(self):
+        while True:
+            addr = ActorAddr(self.rng.getrandbits(32))
+            if addr not in self.addrs:
+                self.addrs.add(addr)
+                return addr
+
+    def config_of(self, addr):
+        return self.configs[shard_of(addr, self.n_shards)]
+
+    def spawn(self, base):
+        addr = self.new_addr()
+        self.config_of(addr).spawns.append((addr, base.code))
+        return addr
+
+    def add_sink(self):
+        # An actor recording every message it gets, returned in SimulationResult.sunk
+        addr = self.new_addr()
+        self.config_of(addr).sinks.append(addr)
+        return addr
+
+    def send(self, to, atom, data=(), delay=None):
+        self.config_of(to).messages.append(Message(to, atom, list(data), delay))
+
+    def run(self, timeout=None):
+        control = Control(self.n_shards)
+        events = [multiprocessing.Event() for _ in range(self.n_shards)]
+        wake = multiprocessing.Event()
+        results = multiprocessing.Queue()
+
+        rings = []
+        for src in self.configs:
+            for dst in self.configs:
+                if src is dst:
+                    continue
+                ring = RingBuffer.create(self.ring_capacity)
+                rings.append(ring)
+                src.outbound[dst.shard_idx] = ring.name()
+                dst.inbound.append(ring.name())
+
+        for shard in range(self.n_shards):
+            control.values[control.busy(shard)] = 1
+
+        processes = [
+            multiprocessing.Process(target=run_shard, args=(config, control, events, wake, results))
+            for config in self.configs
+        ]
+
+        start = time.monotonic()
+        timed_out = False
+        try:
+            for process in processes:
+                process.start()
+
+            previous = None
+            while True:
+                wake.wait(POLL_INTERVAL)
+                wake.clear()
+
+                # Quiescent twice in a row with nothing changed in between, so no message was in
+                # flight in between either
+                snapshot = control.snapshot()
+                if control.is_quiescent(snapshot):
+                    if snapshot == previous:
+                        break
+                    previous = snapshot
+                else:
+                    previous = None
+
+                if timeout is not None and time.monotonic() - start > timeout:
+                    timed_out = True
+                    break
+                if any(process.exitcode is not None for process in processes):
+                    break
+        finally:
+            control.values[control.stop_flag()] = 1
+            for event in events:
+                event.set()
+
+            started = [process for process in processes if process.pid is not None]
+            shards = []
+            while len(shards) < len(started):
+                try:
+                    shards.append(results.get(timeout=POLL_INTERVAL))
+                except queue.Empty:
+                    if all(process.exitcode is not None for process in started):
+                        break
+
+            for process in started:
+                process.join()
+
+            for ring in rings:
+                ring.unlink()
+
+        return SimulationResult(shards, time.monotonic() - start, timed_out)
+
+if __name__ == "__main__":
+    import argparse
+
+    PRINT_ATOM = Atom(1)
+
+    arg_parser = argparse.ArgumentParser(description="Run actors from an actor base sharded across processes")
+    arg_parser.add_argument("actor_base", help="Path to an .act file")
+    arg_parser.add_argument("--shards", type=int, default=multiprocessing.cpu_count())
+    arg_parser.add_argument("--actors", type=int, default=1, help="Number of actors to spawn")
+    arg_parser.add_argument(
+        "--send",
+        action="append",
+        default=[],
+        help="Atom to send to every actor, e.g. 0x333302. Append ',reply' to pass a recording actor's address and atom as arguments",
+    )
+    arg_parser.add_argument("--repeat", type=int, default=1, help="Send the messages this many times")
+    arg_parser.add_argument("--delay", type=float, default=None, help="Delay in seconds for the sent messages")
+    arg_parser.add_argument("--timeout", type=float, default=None, help="Stop the simulation after this many seconds")
+    arg_parser.add_argument("--seed", type=int, default=None)
+    arg_parser.add_argument("--ring-capacity", type=int, default=DEFAULT_RING_CAPACITY)
+    arg_parser.add_argument("-q", "--quiet", action="store_true", help="Don't print replies")
+    args = arg_parser.parse_args()
+
+    runtime = ShardedRuntime(args.shards, args.seed, args.ring_capacity)
+    base = ActorBase.load(args.actor_base)
+    actor_addrs = [runtime.spawn(base) for _ in range(args.actors)]
+    sink_addr = runtime.add_sink()
+
+    delay = None if args.delay is None else Float(args.delay)
+    for _ in range(args.repeat):
+        for spec in args.send:
+            atom_text, _, option = spec.partition(",")
+            data = [sink_addr, PRINT_ATOM] if option == "reply" else []
+            for addr in actor_addrs:
+                runtime.send(addr, Atom(int(atom_text, 0)), data, delay)
+
+    result = runtime.run(args.timeout)
+
+    if not args.quiet:
+        for message in result.sunk:
+            print(f"Got {message.atom} {message.data}")
+    for addr, atom, error in result.errors:
+        print(f"Handler for {atom} on {addr} received error: {error}")
+    for shard in result.shards:
+        print(shard)
+
+    rate = result.delivered / result.duration if result.duration > 0 else 0
+    timed_out = " (timed out)" if result.timed_out else ""
+    print(f"{result.delivered} messages delivered, {result.dropped} dropped, {result.cross_sent} across shards in {result.duration:.3f} s{timed_out} ({rate:.0f} messages/s)")
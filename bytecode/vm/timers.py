@@ -0,0 +1,99 @@
+import heapq
+import math
+import time
+
+DEFAULT_RESOLUTION = 0.001
+
+class WallClock:
+    def now(self):
+        return time.monotonic()
+
+    def sleep_until(self, deadline):
+        delay = deadline - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+class VirtualClock:
+    # Simulated time that jumps straight to a deadline instead of waiting for it, so hours of
+    # delays finish as fast as the messages can be handled. Handling a message takes no time
+    def __init__(self, start=0.0):
+        self.time = start
+
+    def now(self):
+        return self.time
+
+    def sleep_until(self, deadline):
+        self.time = max(self.time, deadline)
+
+    def advance(self, seconds):
+        self.time += seconds
+
+class TimerWheel:
+    # A hashed timing wheel for delayed messages. Times are cut into ticks of `resolution`
+    # seconds and every tick with something due has a slot, so inserting into an occupied tick is
+    # an append. A heap of the occupied ticks gives the next deadline without scanning empty slots,
+    # which is what lets a scheduler sleep until then instead of requeueing messages that aren't
+    # due yet. Items due in the same tick come out in insertion order.
+    def __init__(self, resolution=DEFAULT_RESOLUTION):
+        self.resolution = resolution
+        self.slots = {}
+        self.ticks = []
+
+        self.count = 0
+
+    def tick_of(self, due):
+        return math.ceil(due / self.resolution)
+
+    def insert(self, due, item):
+        tick = self.tick_of(due)
+        slot = self.slots.get(tick)
+        if slot is None:
+            slot = self.slots[tick] = []
+            heapq.heappush(self.ticks, tick)
+
+        slot.append(item)
+        self.count += 1
+
+    def insert_many(self, entries):
+        # Inserts (due, item) pairs. New ticks are heapified once instead of pushed one by one when
+        # there are more of them than the heap has
+        new_ticks = []
+        for due, item in entries:
+            tick = self.tick_of(due)
+            slot = self.slots.get(tick)
+            if slot is None:
+                slot = self.slots[tick] = []
+                new_ticks.append(tick)
+
+            slot.append(item)
+            self.count += 1
+
+        if len(new_ticks) > len(self.ticks):
+            self.ticks.extend(new_ticks)
+            heapq.heapify(self.ticks)
+        else:
+            for tick in new_ticks:
+                heapq.heappush(self.ticks, tick)
+
+    def next_due(self):
+        # The time the earliest item is due, or None if the wheel is empty
+        if len(self.ticks) == 0:
+            return None
+        return self.ticks[0] * self.resolution
+
+    def pop_due(self, now):
+        # Removes and returns every item due at or before now, earliest first
+        due = []
+        while len(self.ticks) > 0 and self.ticks[0] * self.resolution <= now:
+            due.extend(self.slots.pop(heapq.heappop(self.ticks)))
+
+        self.count -= len(due)
+        return due
+
+    def __len__(self):
+        return self.count
+
+    def __str__(self):
+        return f"TimerWheel(resolution={self.resolution}, pending={self.count}, slots={len(self.slots)})"
+
+    __repr__ = __str__